@@ -1,36 +1,100 @@
 import argparse
-import yaml
+import os
 import sys
+from collections import Counter
+from typing import Iterable, Iterator, List, Tuple
 
-from sklearn.cluster import KMeans
-import numpy as np
+import joblib
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
+
+from utils.func_words import FuncWordVocab, default_csv
+from utils.general_utils import chunked
 
 
 def setup_argparse():
-    p = argparse.ArgumentParser()
-    p.add_argument('-c', dest='config_file', default='../config/zotero.yaml',
-                   help='a yaml config containing necessary API information')
-    #p.add_argument('-d', dest='output_dir', default='../outputs/D4/', help='dir to write output summaries to')
-    #p.add_argument('-m', dest='model_path', default='', help='path for a pre-trained embedding model')
+    p = argparse.ArgumentParser(description="cluster sentences by their function word usage")
+    p.add_argument('-f', dest='files', nargs='+', required=True, help='files of one sentence per line to cluster')
+    p.add_argument('-o', dest='output_dir', default='clusters',
+                   help='dir to write the model and a {file}.clusters label file per input to')
+    p.add_argument('--func_words', help='csv of function words, defaults to the one in data/ for the casing')
+    p.add_argument('--cased', action='store_true',
+                   help='match function words from the cased csv exactly, rather than case folded ones')
+    p.add_argument('--vocab', help='a vocabulary compiled with utils.func_words, instead of compiling the csv')
+    p.add_argument('--langs', nargs='+', help='languages whose function words are features, defaults to all in the csv')
+    p.add_argument('-k', dest='num_clusters', type=int, default=2)
+    p.add_argument('--chunk_size', type=int, default=10000, help='sentences vectorized and fitted at a time')
+    p.add_argument('--epochs', type=int, default=1, help='passes over the files while fitting')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--model', help="a model.joblib from an earlier run (with its vocab.npz alongside), to only assign "
+                                   "clusters with")
     return p.parse_args()
 
 
-def read_yaml_config(config_file):
-    return yaml.load(open(config_file))
+def iter_chunks(files: Iterable[str], chunk_size: int) -> Iterator[Tuple[str, List[str]]]:
+    """yields (filepath, lines) with up to chunk_size lines at a time, streaming every file in turn"""
+    for filepath in files:
+        with open(filepath, "r") as fin:
+            for lines in chunked(fin, chunk_size):
+                yield filepath, lines
+
+
+def vectorize(vocab: FuncWordVocab, lines: List[str]):
+    """sparse function word counts, l2 normalized so that sentence length doesn't decide the cluster"""
+    return normalize(vocab.transform_lines(lines))
+
 
-def load_corpus(data, tokenized=True):
-    if tokenized
+def fit(files: List[str], vocab: FuncWordVocab, num_clusters: int, chunk_size: int, epochs: int = 1,
+        seed: int = 0) -> MiniBatchKMeans:
+    """fits k-means a chunk at a time with partial_fit, so only one chunk of sentences is ever in memory"""
+    model = MiniBatchKMeans(n_clusters=num_clusters, random_state=seed, batch_size=chunk_size, n_init=3)
+    fitted = False
+    for epoch in range(epochs):
+        for _, lines in iter_chunks(files, chunk_size):
+            if not fitted and len(lines) < num_clusters:
+                continue  # the first partial_fit initializes the centers and needs a sample per cluster
+            model.partial_fit(vectorize(vocab, lines))
+            fitted = True
+    if not fitted:
+        raise ValueError("Need a chunk of at least {} sentences to fit {} clusters".format(num_clusters, num_clusters))
+    return model
+
+
+def assign(files: List[str], vocab: FuncWordVocab, model: MiniBatchKMeans, chunk_size: int,
+           output_dir: str) -> Counter:
+    """writes the cluster of every line of each file to {output_dir}/{file name}.clusters, returns cluster sizes"""
+    sizes = Counter()
+    for filepath in files:
+        out_path = os.path.join(output_dir, os.path.basename(filepath) + ".clusters")
+        with open(out_path, "w") as fout:
+            for _, lines in iter_chunks([filepath], chunk_size):
+                labels = model.predict(vectorize(vocab, lines))
+                sizes.update(labels.tolist())
+                fout.write("".join("{}\n".format(label) for label in labels))
+    return sizes
 
 
 if __name__ == "__main__":
     args = setup_argparse()
+    os.makedirs(args.output_dir, exist_ok=True)
 
-    print("Reading config...")
-    config = read_yaml_config(args.config_file)
-
-    num_clusters = 2
-    data = []
-    kmeans = KMeans(n_clusters=num_clusters, random_state=0).fit(data)
-    kmeans.predict
-    kmeans.labels
+    if args.model:
+        model = joblib.load(args.model)
+        vocab = FuncWordVocab.load(os.path.join(os.path.dirname(args.model), "vocab.npz"))
+    else:
+        if args.vocab:
+            vocab = FuncWordVocab.load(args.vocab)
+        else:
+            vocab = FuncWordVocab.compile(args.func_words or default_csv(not args.cased), not args.cased, args.langs)
+        print("Fitting {} clusters on {} function words...".format(args.num_clusters, len(vocab)), file=sys.stderr)
+        model = fit(args.files, vocab, args.num_clusters, args.chunk_size, args.epochs, args.seed)
+        model_path = os.path.join(args.output_dir, "model.joblib")
+        joblib.dump(model, model_path)
+        vocab.save(os.path.join(args.output_dir, "vocab.npz"))
+        print("Saved the model and its vocabulary to {}".format(args.output_dir), file=sys.stderr)
 
+    sizes = assign(args.files, vocab, model, args.chunk_size, args.output_dir)
+    total = sum(sizes.values())
+    for cluster in range(model.n_clusters):
+        print("cluster {}: {} sentences ({:.2f}%)".format(cluster, sizes[cluster],
+                                                           sizes[cluster] / total * 100 if total else 0))
@@ -1,43 +1,76 @@
 import argparse
-import string
-import re
 
 import os
 import sys
-import langid
+import time
 from tqdm import tqdm
 
+from utils.corpus_io import is_corpus_file, open_text, output_path, read_lines, strip_compression_ext
+from utils.langid_cache import format_cache_stats
+from utils.langid_utils import restricted_candidates
+from utils.line_index import get_line_index
+from utils.metrics import Metrics, RejectionLog, finish_metrics
+from utils.script_filter import classify_lines
+
+
+WRITE_BUFFER_SIZE = 1 << 20  # bytes buffered per output file before flushing to disk
+CHUNK_SIZE = 2000  # lines classified per batch
+
 
 def setup_argparse():
     p = argparse.ArgumentParser()
     p.add_argument('-d', dest='data_dir', help='a directory containing the files to clean')
     p.add_argument('-f', dest='files', nargs='+', help='files to check, rather than a full directory')
+    p.add_argument('--langid_mode', choices=['full', 'restricted'], default='full',
+                   help="restricted only scores the file's language plus common confusers, faster but less thorough")
+    p.add_argument('--cache', dest='cache_path', help="sqlite file to cache langid predictions in, shared between runs")
+    p.add_argument('--line_index', action='store_true',
+                   help="use (and build) a line offset index of each file, to show progress against its total")
+    p.add_argument('--compress', choices=['gz', 'zst'], help="compress the _cleaned and _cut outputs. Compressed "
+                                                              "inputs (.gz, .zst) are read as they are")
+    p.add_argument('--rejection_log', help="gzip'd json lines file to log cut lines to, instead of printing them")
+    p.add_argument('--rejection_sample', type=float, default=1.0, help="fraction of cut lines to log")
     #p.add_argument('--metrics', action='store_true', help="don't modify files, only print metrics")
 
     return p.parse_args()
 
-def filter_true_language(filepath, lang):
-    pct_stripper = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
-    keep_lines, cut_lines = [], []
+def filter_true_language(filepath, lang, langid_mode="full", cache_path=None, line_index=False, rejections=None,
+                         compress=None):
+    candidate_langs = restricted_candidates({lang}) if langid_mode == "restricted" else None
+    if rejections is None:
+        rejections = RejectionLog()
+    metrics = Metrics()
+    start_time = time.perf_counter()
     print("Lang: {}".format(lang), file=sys.stderr)
-    with open(filepath, "r") as fin:
-        for i, line in enumerate(tqdm(fin,
-                                bar_format='{percentage:3.0f}%|{bar}|{n_fmt}/{total_fmt}')):
-            clean_line = re.sub(r' +', ' ', line.strip().translate(pct_stripper))
-            predict_lang, confidence  = langid.classify(clean_line)
-            #print(predict_lang, confidence)
+    total = None
+    if line_index:
+        try:
+            total = len(get_line_index(filepath))
+        except ValueError as e:
+            sys.exit(str(e))
+    out_path = strip_compression_ext(filepath)
+    # lines are written as they are classified, so memory use doesn't depend on the size of the input. Reading and
+    # classifying are timed by classify_lines, finish_metrics puts the rest down to writing
+    with read_lines(filepath) as fin, \
+         open_text(output_path(out_path+"_cleaned", compress), "w", WRITE_BUFFER_SIZE) as clean_fout, \
+         open_text(output_path(out_path+"_cut", compress), "w", WRITE_BUFFER_SIZE) as cut_fout:
+        for i, (line, predict_lang, confidence) in enumerate(tqdm(classify_lines(fin, 1, CHUNK_SIZE, candidate_langs,
+                                                                                 cache_path, metrics),
+                                total=total, bar_format='{percentage:3.0f}%|{bar}|{n_fmt}/{total_fmt}')):
             if predict_lang != lang:
-                print("Predicted Lang {} (Conf: {:4f}) for line: {}".format(predict_lang, confidence, line.strip()),
-                      file=sys.stderr)
-                cut_lines.append((i,line))
+                rejections.log(filepath, i, predicted=predict_lang, confidence=confidence, text=line.rstrip("\n"))
+                cut_fout.write("{} {}".format(i, line))
+                metrics["cut"] += 1
             else:
-                keep_lines.append((i,line))
-    print("{} cleaned lines and {} cut lines ({:2f}) % were cut".format(len(keep_lines),
-                                                                    len(cut_lines),
-                                                                    (len(cut_lines)/len(keep_lines))*100))
-    with open(filepath+"_cleaned", "w") as clean_fin, open(filepath+"_cut", "w") as cut_fin:
-        clean_fin.write("".join(["{} {}".format(l[0], l[1]) for l in keep_lines]))
-        cut_fin.write("".join(["{} {}".format(l[0], l[1]) for l in cut_lines]))
+                clean_fout.write("{} {}".format(i, line))
+                metrics["kept"] += 1
+    finish_metrics(metrics, time.perf_counter() - start_time, out_path, file=filepath)
+    num_kept, num_cut = metrics["kept"], metrics["cut"]
+    print("{} cleaned lines and {} cut lines ({:2f}) % were cut".format(num_kept,
+                                                                    num_cut,
+                                                                    (num_cut/num_kept)*100 if num_kept else 0))
+    if cache_path:
+        print(format_cache_stats(metrics))
 
 
 if __name__ == "__main__":
@@ -47,10 +80,13 @@ if __name__ == "__main__":
         with os.scandir(args.data_dir) as source_dir:
             files = sorted([file.path for file in source_dir if file.is_file()
                             and not file.name.startswith('.')
-                            and file.name.endswith('.txt')])
+                            and is_corpus_file(file.name, '.txt')])
     elif args.files:
         files = args.files
 
-    for filepath in files:
-        this_lang = os.path.splitext(os.path.split(filepath)[1])[0] # filename will be lang.txt, so this grabs lang
-        filter_true_language(filepath, this_lang)
+    with RejectionLog(args.rejection_log, args.rejection_sample) as rejections:
+        for filepath in files:
+            # filename will be lang.txt (or lang.txt.gz), so this grabs lang
+            this_lang = os.path.splitext(os.path.split(strip_compression_ext(filepath))[1])[0]
+            filter_true_language(filepath, this_lang, args.langid_mode, args.cache_path, args.line_index, rejections,
+                                 args.compress)
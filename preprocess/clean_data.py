@@ -1,11 +1,23 @@
 import argparse
-import string
-import re
+import itertools
 import os
 import sys
-import langid
+import time
 from tqdm import tqdm
 
+from utils.corpus_io import is_corpus_file, open_text, output_path, read_lines, strip_compression_ext
+from utils.langid_cache import format_cache_stats
+from utils.langid_utils import restricted_candidates
+from utils.line_index import check_aligned, get_line_index, is_index_file
+from utils.metrics import Metrics, RejectionLog, finish_metrics, is_metrics_file
+from utils.run_manifest import RunManifest
+from utils.script_filter import ScriptPrefilter, classify_lines, format_prefilter_stats
+from utils.shard_spec import load_shard, mark_shard_done, shard_dir
+
+
+WRITE_BUFFER_SIZE = 1 << 20  # bytes buffered per output file before flushing to disk
+CHECKPOINT_LINES = 1000000  # lines (or line pairs) cleaned between checkpoints, with a manifest
+
 
 def setup_argparse():
     p = argparse.ArgumentParser()
@@ -14,86 +26,256 @@ def setup_argparse():
     p.add_argument('-t', dest='filetype', choices=['wikimatrix','os'], help='whether file is wikimatrix or opensubs')
     p.add_argument('-o', dest='output_dir')
     p.add_argument('--strict_filter', action='store_true', help="require bitext and that both lines in bitext be ok else toss")
+    p.add_argument('--workers', type=int, default=1, help="number of processes to use for language identification")
+    p.add_argument('--chunk_size', type=int, default=2000, help="lines classified per batch (and sent to a worker at a time)")
+    p.add_argument('--langid_mode', choices=['full', 'restricted'], default='full',
+                   help="full scores every language langid knows. restricted only scores the ok languages plus "
+                        "common confusers, which is much faster but can miss lines in other languages")
+    p.add_argument('--confusers', nargs='+', help="languages to score alongside the ok languages in restricted mode, "
+                                                  "defaults to utils.langid_utils.COMMON_CONFUSERS")
+    p.add_argument('--cache', dest='cache_path', help="sqlite file to cache langid predictions in, shared between "
+                                                      "runs and languages")
+    p.add_argument('--line_index', action='store_true',
+                   help="use (and build) line offset indices of the inputs, to check bitext sides have the same "
+                        "number of lines before starting and to show progress against the total")
+    p.add_argument('--script_prefilter', action='store_true',
+                   help="accept or reject lines whose unicode scripts settle their language before langid, which "
+                        "then only sees the rest (see utils.script_filter)")
+    p.add_argument('--prefilter_audit', type=float, default=0.0,
+                   help="fraction of lines the script prefilter decides that langid checks too, to measure agreement")
+    p.add_argument('--compress', choices=['gz', 'zst'], help="compress the _cleaned and _cut outputs. Compressed "
+                                                              "inputs (.gz, .zst) are read as they are")
+    p.add_argument('--manifest', help="sqlite run manifest. Files already cleaned with the same contents and "
+                                      "parameters are skipped, and a file that was cut short resumes from its last "
+                                      "checkpoint (see utils.run_manifest)")
+    p.add_argument('--checkpoint_lines', type=int, default=CHECKPOINT_LINES,
+                   help="lines cleaned between checkpoints, with --manifest")
+    p.add_argument('--shard_spec', help="clean one shard of a plan from scripts/shard_plan.py instead of -d/-f. "
+                                        "Outputs go to a part_{n} dir in -o (put a --rejection_log there too to "
+                                        "have it merged), for scripts/shard_plan.py merge to combine")
+    p.add_argument('--shard', type=int, help="which shard of --shard_spec to clean")
+    p.add_argument('--rejection_log', help="gzip'd json lines file to log cut lines to, instead of printing them")
+    p.add_argument('--rejection_sample', type=float, default=1.0,
+                   help="fraction of cut lines to log, picked by file and line number so runs log the same ones")
 
     return p.parse_args()
 
 
-def strict_filter_true_language(files, langs, output_dir):
+def get_out_path(filepath: str, output_dir) -> str:
+    """
+    where the _cleaned and _cut files for filepath go, next to the input unless an output_dir is given. Any
+    compression extension of the input is dropped, so en.txt.gz gives en.txt_cleaned
+    """
+    filepath = strip_compression_ext(filepath)
+    if output_dir:
+        filename = os.path.split(filepath)[1]
+        filepath = os.path.join(output_dir, filename)
+    return filepath
+
+
+def print_summary(num_kept: int, num_cut: int, cache_stats=None):
+    percent_cut = num_cut / (num_kept + num_cut) * 100 if num_kept else 0
+    print("{} cleaned lines and {} cut lines ({:2f}) % were cut".format(num_kept, num_cut, percent_cut))
+    if cache_stats:
+        print(format_cache_stats(cache_stats))
+
+
+class CheckpointedOutputs(object):
+    """
+    The _cleaned and _cut files of a clean, which can be checkpointed: checkpoint() closes them (ending the gzip
+    member or zstd frame of compressed ones) and reopens them for appending, returning their sizes. Opening with
+    the sizes of a checkpoint truncates the files back to them, to resume from there.
+    """
+
+    def __init__(self, paths, sizes=None):
+        self.paths = paths
+        if sizes is not None:
+            for path in paths:
+                os.truncate(path, sizes[path])
+        self.files = [open_text(path, "a" if sizes is not None else "w", WRITE_BUFFER_SIZE) for path in paths]
+
+    def __getitem__(self, i):
+        return self.files[i]
+
+    def checkpoint(self) -> dict:
+        self.close()
+        self.files = [open_text(path, "a", WRITE_BUFFER_SIZE) for path in self.paths]
+        return {path: os.path.getsize(path) for path in self.paths}
 
-    pct_stripper = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
-    keep_lines, cut_lines = [], []
+    def close(self):
+        for fout in self.files:
+            fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def start_unit(manifest, unit, fingerprint, params):
+    """
+    (done, start, state) for a unit of a clean with a manifest: whether it is already up to date, and otherwise
+    where to start it from (0, or its last checkpoint's position) with the checkpoint's state
+    """
+    if manifest is None:
+        return False, 0, {}
+    if manifest.lookup(unit, fingerprint, params) is not None:
+        print("Up to date, skipping: {}".format(unit), file=sys.stderr)
+        return True, 0, {}
+    checkpoint = manifest.load_checkpoint(unit, fingerprint, params)
+    if checkpoint is None:
+        return False, 0, {}
+    print("Resuming {} from line {}".format(unit, checkpoint[0]), file=sys.stderr)
+    return False, checkpoint[0], checkpoint[1]
+
+
+def save_checkpoint(manifest, unit, fingerprint, params, position, outputs, metrics):
+    """
+    checkpoints the outputs and saves where the unit got to. Only kept and cut carry over to a resumed run, the
+    other metrics are of the work each run did
+    """
+    state = dict(sizes=outputs.checkpoint(), counts={name: metrics[name] for name in ("kept", "cut")})
+    manifest.save_checkpoint(unit, fingerprint, params, position, state)
+
+
+def strict_filter_true_language(files, langs, output_dir, workers=1, chunk_size=2000, candidate_langs=None,
+                                cache_path=None, line_index=False, rejections=None, compress=None,
+                                script_prefilter=False, prefilter_audit=0.0, manifest=None,
+                                checkpoint_lines=CHECKPOINT_LINES, byte_ranges=None, first_line=0):
+    """
+    keeps the line pairs of a bitext where both sides are in an ok language. Cut pairs are logged to the
+    rejections RejectionLog (per side, under the side's file) if one is given. With a RunManifest the bitext is
+    skipped if it is up to date, and checkpointed every checkpoint_lines pairs otherwise.
+    With byte_ranges only those (start, end) ranges of the sides are cleaned, which must hold the same lines of
+    each side starting from line first_line (see utils.shard_spec)
+    """
+    if rejections is None:
+        rejections = RejectionLog()
+    out_files = [get_out_path(filepath, output_dir) for filepath in files]
+    out_paths = [output_path(out_file + suffix, compress) for suffix in ("_cleaned", "_cut") for out_file in out_files]
+    unit = "\t".join(os.path.abspath(filepath) for filepath in files[:2])
+    if byte_ranges:
+        unit += "\t" + "\t".join("{}:{}".format(*byte_range) for byte_range in byte_ranges[:2])
+    fingerprint = manifest.fingerprints(files[:2]) if manifest is not None else None
+    params = dict(stage="strict_filter", langs=langs[:2], candidate_langs=candidate_langs, outputs=out_paths,
+                  script_prefilter=script_prefilter)
+    done, start, state = start_unit(manifest, unit, fingerprint, params)
+    if done:
+        return
+    metrics = Metrics(state.get("counts", {}))
+    start_time = time.perf_counter()
     print("Langs: {}".format(langs), file=sys.stderr)
-    with open(files[0], "r") as fin1, open(files[1], "r") as fin2:
-        for line1, line2 in zip(fin1, fin2):
-            clean_line1 = re.sub(r' +', ' ', line1.strip().translate(pct_stripper))
-            clean_line2 = re.sub(r' +', ' ', line2.strip().translate(pct_stripper))
-            predict_lang1, confidence1 = langid.classify(clean_line1)
-            predict_lang2, confidence2 = langid.classify(clean_line2)
-            # print(predict_lang, confidence)
+    total = None
+    if line_index and not byte_ranges:
+        # zip would otherwise stop quietly at the end of the shorter side
+        try:
+            total = len(check_aligned(files[:2])[0])
+        except ValueError as e:
+            sys.exit(str(e))
+    prefilter = None
+    if script_prefilter:
+        prefilter = ScriptPrefilter(langs[:2], candidate_langs, prefilter_audit)
+        chunk_size += chunk_size % 2  # so every chunk starts on the first side, as the prefilter's ok_langs do
+    # lines are written as they are classified, so memory use doesn't depend on the size of the input
+    byte_ranges = byte_ranges or [None, None]
+    with read_lines(files[0], byte_range=byte_ranges[0]) as fin1, \
+         read_lines(files[1], byte_range=byte_ranges[1]) as fin2, \
+         CheckpointedOutputs(out_paths, state.get("sizes")) as outputs:
+        clean_fout1, clean_fout2, cut_fout1, cut_fout2 = outputs
+        # interleave the two sides so one stream of predictions keeps the bitext aligned
+        pairs = itertools.islice(zip(fin1, fin2), start, None)
+        classified = classify_lines(itertools.chain.from_iterable(pairs), workers, chunk_size,
+                                    candidate_langs, cache_path, metrics, prefilter)
+        for i, ((line1, predict_lang1, confidence1), (line2, predict_lang2, confidence2)) in \
+                enumerate(tqdm(zip(classified, classified), initial=start, total=total, disable=total is None),
+                          first_line + start):
             if predict_lang1 not in langs[0] or predict_lang2 not in langs[1]:
-                print(
-                    "Pair:\n"
-                    "Predicted Lang {} (Conf: {:4f}) for line: {} \n"
-                    "Predicted Lang {} (Conf: {:4f}) for line: {}".format(
-                        predict_lang1, confidence1, line1.strip(),
-                        predict_lang2, confidence2, line2.strip()),
-                    file=sys.stderr)
-                cut_lines.append((line1, line2))
+                for filepath, line, predict_lang, confidence, ok_langs in (
+                        (files[0], line1, predict_lang1, confidence1, langs[0]),
+                        (files[1], line2, predict_lang2, confidence2, langs[1])):
+                    rejections.log(filepath, i, predicted=predict_lang, confidence=confidence,
+                                   ok=predict_lang in ok_langs, text=line.rstrip("\n"))
+                cut_fout1.write(line1)
+                cut_fout2.write(line2)
+                metrics["cut"] += 1
             else:
-                keep_lines.append((line1, line2))
-
-    percent_kept = len(cut_lines) / (len(keep_lines) + len(cut_lines)) * 100 if keep_lines else 0
-    print("{} cleaned lines and {} cut lines ({:2f}) % were cut".format(len(keep_lines),
-                                                                        len(cut_lines),
-                                                                        percent_kept))
-    if args.output_dir:
-        out_files = []
-        for filepath in files:
-            filename = os.path.split(filepath)[1]
-            filepath = os.path.join(output_dir, filename)
-            out_files.append(filepath)
-    else:
-        out_files = files
+                clean_fout1.write(line1)
+                clean_fout2.write(line2)
+                metrics["kept"] += 1
+            if manifest is not None and (i + 1 - first_line) % checkpoint_lines == 0:
+                save_checkpoint(manifest, unit, fingerprint, params, i + 1 - first_line, outputs, metrics)
+                clean_fout1, clean_fout2, cut_fout1, cut_fout2 = outputs
 
-    with open(out_files[0] + "_cleaned", "w") as clean_fin1, open(out_files[1] + "_cleaned", "w") as clean_fin2:
-        clean_fin1.write("".join([l[0] for l in keep_lines]))
-        clean_fin2.write("".join([l[1] for l in keep_lines]))
+    finish_metrics(metrics, time.perf_counter() - start_time, out_files[0], files=files)
+    if manifest is not None:
+        manifest.record(unit, fingerprint, params, outputs=out_paths + [out_files[0] + ".metrics.json"])
+        manifest.clear_checkpoint(unit)
+    print_summary(metrics["kept"], metrics["cut"], metrics if cache_path else None)
+    if prefilter is not None:
+        print(format_prefilter_stats(metrics))
 
-    with open(out_files[0] + "_cut", "w") as cut_fin1, open(out_files[1] + "_cut", "w") as cut_fin2:
-        cut_fin1.write("".join([l[0] for l in cut_lines]))
-        cut_fin2.write("".join([l[1] for l in cut_lines]))
 
-def filter_true_language(filepath, ok_langs: set, output_dir):
-
-    pct_stripper = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
-    keep_lines, cut_lines = [], []
+def filter_true_language(filepath, ok_langs: set, output_dir, workers=1, chunk_size=2000, candidate_langs=None,
+                         cache_path=None, line_index=False, rejections=None, compress=None, script_prefilter=False,
+                         prefilter_audit=0.0, manifest=None, checkpoint_lines=CHECKPOINT_LINES, byte_range=None,
+                         first_line=0):
+    """
+    keeps the lines of filepath that are in an ok language. Cut lines are logged to rejections if it is given.
+    With a RunManifest the file is skipped if it is up to date, and checkpointed every checkpoint_lines lines otherwise.
+    With a (start, end) byte_range only the lines in it are cleaned, numbered from first_line
+    """
+    if rejections is None:
+        rejections = RejectionLog()
+    out_path = get_out_path(filepath, output_dir)
+    out_paths = [output_path(out_path + "_cleaned", compress), output_path(out_path + "_cut", compress)]
+    unit = os.path.abspath(filepath)
+    if byte_range:
+        unit += "\t{}:{}".format(*byte_range)
+    fingerprint = manifest.fingerprint(filepath) if manifest is not None else None
+    params = dict(stage="filter", ok_langs=ok_langs, candidate_langs=candidate_langs, outputs=out_paths,
+                  script_prefilter=script_prefilter)
+    done, start, state = start_unit(manifest, unit, fingerprint, params)
+    if done:
+        return
+    metrics = Metrics(state.get("counts", {}))
+    start_time = time.perf_counter()
     print("Lang: {}".format(ok_langs), file=sys.stderr)
-    with open(filepath, "r") as fin:
-        for i, line in enumerate(tqdm(fin)):
-            clean_line = re.sub(r' +', ' ', line.strip().translate(pct_stripper))
-            predict_lang, confidence  = langid.classify(clean_line)
-            #print(predict_lang, confidence)
+    total = None
+    if line_index and not byte_range:
+        try:
+            total = len(get_line_index(filepath))
+        except ValueError as e:
+            sys.exit(str(e))
+    prefilter = ScriptPrefilter([ok_langs], candidate_langs, prefilter_audit) if script_prefilter else None
+    with read_lines(filepath, byte_range=byte_range) as fin, CheckpointedOutputs(out_paths, state.get("sizes")) as outputs:
+        clean_fout, cut_fout = outputs
+        classified = classify_lines(itertools.islice(fin, start, None), workers, chunk_size, candidate_langs,
+                                    cache_path, metrics, prefilter)
+        for i, (line, predict_lang, confidence) in enumerate(tqdm(classified, initial=start, total=total),
+                                                             first_line + start):
             if predict_lang not in ok_langs:
-                print("Predicted Lang {} (Conf: {:4f}) for line: {}".format(predict_lang, confidence, line.strip()),
-                      file=sys.stderr)
-                cut_lines.append((i,line))
+                rejections.log(filepath, i, predicted=predict_lang, confidence=confidence, text=line.rstrip("\n"))
+                cut_fout.write("{} {}".format(i, line))
+                metrics["cut"] += 1
             else:
-                keep_lines.append((i,line))
+                clean_fout.write("{} {}".format(i, line))
+                metrics["kept"] += 1
+            if manifest is not None and (i + 1 - first_line) % checkpoint_lines == 0:
+                save_checkpoint(manifest, unit, fingerprint, params, i + 1 - first_line, outputs, metrics)
+                clean_fout, cut_fout = outputs
 
-    percent_kept = len(cut_lines)/(len(keep_lines)+len(cut_lines))*100 if keep_lines else 0
-    print("{} cleaned lines and {} cut lines ({:2f}) % were cut".format(len(keep_lines),
-                                                                    len(cut_lines),
-                                                                        percent_kept))
-    if args.output_dir:
-        filename = os.path.split(filepath)[1]
-        filepath = os.path.join(output_dir, filename)
-        
-    with open(filepath+"_cleaned", "w") as clean_fin, open(filepath+"_cut", "w") as cut_fin:
-        clean_fin.write("".join(["{} {}".format(l[0], l[1]) for l in keep_lines]))
-        cut_fin.write("".join(["{} {}".format(l[0], l[1]) for l in cut_lines]))
+    finish_metrics(metrics, time.perf_counter() - start_time, out_path, file=filepath)
+    if manifest is not None:
+        manifest.record(unit, fingerprint, params, outputs=out_paths + [out_path + ".metrics.json"])
+        manifest.clear_checkpoint(unit)
+    print_summary(metrics["kept"], metrics["cut"], metrics if cache_path else None)
+    if prefilter is not None:
+        print(format_prefilter_stats(metrics))
 
 
 def extract_lang(filepath: str, filetype: str):
+    filepath = strip_compression_ext(filepath)
     if filetype == "wikimatrix":
         this_lang = os.path.splitext(os.path.split(filepath)[1])[1][1:]  # the language is the extension, minus the .
     else:
@@ -121,27 +303,60 @@ if __name__ == "__main__":
         "id" : {"id", "ms"}
     }
     
-    if args.data_dir:
+    byte_ranges, first_lines = None, None
+    if args.shard_spec:
+        if not args.output_dir or args.shard is None:
+            sys.exit("--shard_spec needs --shard and -o, the shard's outputs go to a part_{n} dir in -o")
+        spec, shard = load_shard(args.shard_spec, "clean", args.shard)
+        files, byte_ranges, first_lines = shard["files"], shard["ranges"], shard["first_lines"]
+        if len(set(files)) != len(files):
+            # each file's pieces of a shard would overwrite each other's outputs
+            sys.exit("shard {} of {} has more than one range of a file: {}".format(args.shard, args.shard_spec,
+                                                                                  ", ".join(files)))
+        args.strict_filter = spec["strict"]
+        args.output_dir = shard_dir(args.output_dir, args.shard)
+        os.makedirs(args.output_dir, exist_ok=True)
+    elif args.data_dir:
         with os.scandir(args.data_dir) as source_dir:
             if args.filetype == "wikimatrix":
                 files = sorted([file.path for file in source_dir if file.is_file()
-                                                            and not file.name.startswith('.')])
+                                                            and not file.name.startswith('.')
+                                                            and not is_index_file(file.name)
+                                                            and not is_metrics_file(file.name)])
             else:
                 files = sorted([file.path for file in source_dir if file.is_file()
                             and not file.name.startswith('.')
-                            and file.name.endswith('.txt')])
+                            and is_corpus_file(file.name, '.txt')])
     elif args.files:
         files = args.files
 
+    rejections = RejectionLog(args.rejection_log, args.rejection_sample)
+    manifest = RunManifest(args.manifest) if args.manifest else None
     if args.strict_filter:
         assert len(files) > 1, "need more than one file to strict filter"
         langs = [extract_lang(f, args.filetype) for f in files]
         ok_langs = [expand_lang(this_lang, lang2ok_lang) for this_lang in langs]
-        strict_filter_true_language(files, ok_langs, args.output_dir)
+        # both sides share one stream of predictions, so they share one candidate set
+        candidate_langs = restricted_candidates(set.union(*ok_langs), args.confusers) \
+            if args.langid_mode == "restricted" else None
+        strict_filter_true_language(files, ok_langs, args.output_dir, args.workers, args.chunk_size, candidate_langs,
+                                    args.cache_path, args.line_index, rejections, args.compress,
+                                    args.script_prefilter, args.prefilter_audit, manifest, args.checkpoint_lines,
+                                    byte_ranges, first_lines[0] if first_lines else 0)
 
     else:
-        for filepath in files:
+        for j, filepath in enumerate(files):
             this_lang = extract_lang(filepath, args.filetype)
             ok_langs = expand_lang(this_lang, lang2ok_lang)
 
-            filter_true_language(filepath, ok_langs, args.output_dir)
+            candidate_langs = restricted_candidates(ok_langs, args.confusers) \
+                if args.langid_mode == "restricted" else None
+            filter_true_language(filepath, ok_langs, args.output_dir, args.workers, args.chunk_size, candidate_langs,
+                                 args.cache_path, args.line_index, rejections, args.compress,
+                                 args.script_prefilter, args.prefilter_audit, manifest, args.checkpoint_lines,
+                                 byte_ranges[j] if byte_ranges else None, first_lines[j] if first_lines else 0)
+    rejections.close()
+    if manifest is not None:
+        manifest.close()
+    if args.shard_spec:
+        mark_shard_done(args.output_dir)
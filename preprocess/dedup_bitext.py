@@ -0,0 +1,158 @@
+import argparse
+import itertools
+import os
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+from preprocess.clean_data import WRITE_BUFFER_SIZE, extract_lang, get_out_path
+from utils.corpus_io import compression_ext, open_text, output_path, read_lines
+from utils.dedup import NUM_BANDS, NUM_PERM, MinHasher, first_occurrences, make_seen_set, near_dup_text, \
+    near_duplicates, pair_keys
+from utils.general_utils import chunked
+from utils.metrics import Metrics, write_summary
+
+
+BATCH_SIZE = 10000  # pairs hashed and checked at a time
+ERROR_RATE = 1e-4  # bloom filter false positive rate, ie the fraction of unique pairs wrongly dropped
+SAMPLE_BYTES = 1 << 20  # bytes read to estimate the number of pairs, when sizing a bloom filter
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="drop exact and near duplicate pairs from cleaned bitexts, streaming")
+    p.add_argument('-f', dest='files', nargs='+', required=True,
+                   help='aligned files, two per bitext (ie the _cleaned outputs of clean_data --strict_filter)')
+    p.add_argument('-t', dest='filetype', choices=['wikimatrix', 'os'], default='os',
+                   help='how to get the languages from the file names, as for clean_data')
+    p.add_argument('-o', dest='output_dir', help='dir to write the _dedup files to, next to the inputs otherwise')
+    p.add_argument('--method', choices=['exact', 'bloom'], default='exact',
+                   help="exact keeps every pair's 64 bit hash in a numpy hash table, so memory grows with the number "
+                        "of unique pairs. bloom uses a fixed size bloom filter instead, which drops about "
+                        "--error_rate of the unique pairs as false positives")
+    p.add_argument('--capacity', type=int, help="pairs per bitext to size bloom filters for. Estimated from the file "
+                                                "size if not given, which compressed inputs can't be")
+    p.add_argument('--error_rate', type=float, default=ERROR_RATE)
+    p.add_argument('--near_dup', action='store_true',
+                   help="also drop pairs that minhash lsh finds are near duplicates of an earlier pair, once "
+                        "normalized as for langid (see utils.dedup)")
+    p.add_argument('--num_perm', type=int, default=NUM_PERM, help='minhash permutations')
+    p.add_argument('--num_bands', type=int, default=NUM_BANDS, help='lsh bands the permutations are split into')
+    p.add_argument('--batch_size', type=int, default=BATCH_SIZE)
+    p.add_argument('--write_dups', action='store_true', help='write the dropped pairs to _dup files as well')
+    p.add_argument('--compress', choices=['gz', 'zst'], help="compress the outputs")
+    p.add_argument('--stats', default='dedup_stats.tsv', help='tsv of pairs removed per language pair')
+    return p.parse_args()
+
+
+def estimate_pairs(filepath: str) -> int:
+    """the number of lines in filepath, from its size and the mean length of the lines at its start"""
+    if compression_ext(filepath):
+        sys.exit("can't estimate how many pairs {} has, give --capacity".format(filepath))
+    with open(filepath, "rb") as fin:
+        sample = fin.read(SAMPLE_BYTES)
+    mean_bytes = len(sample) / max(sample.count(b"\n"), 1)
+    return int(os.path.getsize(filepath) / max(mean_bytes, 1)) + 1
+
+
+def aligned_pairs(fin1, fin2, files):
+    """zip for the two sides of a bitext, which says so if one of them runs out first"""
+    for line1, line2 in itertools.zip_longest(fin1, fin2):
+        if line1 is None or line2 is None:
+            print("{} and {} have different numbers of lines, stopped at the end of the shorter".format(*files),
+                  file=sys.stderr)
+            return
+        yield line1, line2
+
+
+def dedup_bitext(files, output_dir, method="exact", capacity=None, error_rate=ERROR_RATE, minhasher=None,
+                 batch_size=BATCH_SIZE, compress=None, write_dups=False) -> Metrics:
+    """
+    keeps the first of every pair of lines of files[0] and files[1] that occurs more than once, writing the kept
+    pairs to _dedup files. A pair is a duplicate if both sides are exactly the same as an earlier pair's, or with a
+    MinHasher if lsh puts it in a bucket with an earlier kept pair. Only hashes are kept in memory, in exact sets
+    or bloom filters (see utils.dedup). Returns the pairs_read, kept, exact_dups and near_dups counts
+    """
+    if method == "bloom" and capacity is None:
+        capacity = estimate_pairs(files[0])
+    metrics = Metrics()
+    start_time = time.perf_counter()
+    exact_seen = make_seen_set(method, capacity, error_rate)
+    near_seen = make_seen_set(method, capacity * minhasher.num_bands if capacity else None, error_rate) \
+        if minhasher else None
+    out_files = [get_out_path(filepath, output_dir) for filepath in files[:2]]
+    suffixes = ("_dedup", "_dup") if write_dups else ("_dedup",)
+    outputs = [open_text(output_path(out_file + suffix, compress), "w", WRITE_BUFFER_SIZE)
+               for suffix in suffixes for out_file in out_files]
+    try:
+        with read_lines(files[0]) as fin1, read_lines(files[1]) as fin2:
+            for batch in tqdm(chunked(aligned_pairs(fin1, fin2, files[:2]), batch_size), unit="batch"):
+                lines1 = [line1.rstrip("\n") for line1, _ in batch]
+                lines2 = [line2.rstrip("\n") for _, line2 in batch]
+                with metrics.timer("hash"):
+                    keys = pair_keys(lines1, lines2)
+                    exact = exact_seen.contains(keys) | ~first_occurrences(keys)
+                    exact_seen.add(keys[~exact])
+                near = np.zeros(len(batch), dtype=bool)
+                if minhasher:
+                    with metrics.timer("minhash"):
+                        band_keys = minhasher.band_keys([near_dup_text(line1, line2)
+                                                         for line1, line2 in zip(lines1, lines2)])
+                        near = near_duplicates(band_keys, near_seen, exact)
+                with metrics.timer("write"):
+                    for (line1, line2), dup in zip(batch, (exact | near).tolist()):
+                        if not dup:
+                            outputs[0].write(line1)
+                            outputs[1].write(line2)
+                        elif write_dups:
+                            outputs[2].write(line1)
+                            outputs[3].write(line2)
+                metrics["pairs_read"] += len(batch)
+                metrics["exact_dups"] += int(exact.sum())
+                metrics["near_dups"] += int(near.sum())
+    finally:
+        for fout in outputs:
+            fout.close()
+
+    metrics["kept"] = metrics["pairs_read"] - metrics["exact_dups"] - metrics["near_dups"]
+    metrics["set_bytes"] = exact_seen.nbytes + (near_seen.nbytes if near_seen is not None else 0)
+    if method == "bloom":
+        metrics["bloom_false_positive_rate"] = exact_seen.false_positive_rate()
+    metrics["seconds_total"] = time.perf_counter() - start_time
+    write_summary(out_files[0] + "_dedup.metrics.json", metrics, files=files[:2], method=method,
+                  near_dup=minhasher is not None)
+    return metrics
+
+
+def write_stats(path: str, lang_pair2metrics):
+    """one row per language pair of pairs read and removed, summed over its bitexts"""
+    with open(path, "w") as fout:
+        fout.write("lang_pair\tpairs_read\texact_dups\tnear_dups\tkept\tpercent_removed\n")
+        for lang_pair, metrics in lang_pair2metrics.items():
+            removed = metrics["exact_dups"] + metrics["near_dups"]
+            fout.write("{}\t{}\t{}\t{}\t{}\t{:.2f}\n".format(
+                lang_pair, metrics["pairs_read"], metrics["exact_dups"], metrics["near_dups"], metrics["kept"],
+                removed / metrics["pairs_read"] * 100 if metrics["pairs_read"] else 0))
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    if len(args.files) % 2:
+        sys.exit("-f takes two aligned files per bitext, got {}".format(len(args.files)))
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+    minhasher = MinHasher(args.num_perm, args.num_bands) if args.near_dup else None
+    lang_pair2metrics = OrderedDict()
+    for i in range(0, len(args.files), 2):
+        files = args.files[i:i + 2]
+        lang_pair = "-".join(sorted(extract_lang(filepath, args.filetype) for filepath in files))
+        print("{}: {}".format(lang_pair, " ".join(files)), file=sys.stderr)
+        metrics = dedup_bitext(files, args.output_dir, args.method, args.capacity, args.error_rate, minhasher,
+                               args.batch_size, args.compress, args.write_dups)
+        print("{} pairs, {} exact and {} near duplicates removed, {} kept".format(
+            metrics["pairs_read"], metrics["exact_dups"], metrics["near_dups"], metrics["kept"]))
+        lang_pair2metrics.setdefault(lang_pair, Metrics()).update(metrics)
+    write_stats(args.stats, lang_pair2metrics)
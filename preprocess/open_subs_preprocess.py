@@ -7,35 +7,118 @@ import argparse
 import glob
 import gzip
 
+import math
 import os
-import pickle
-import string
+import random
+import sys
 import time
+from functools import partial
+from multiprocessing import Pool
 
-import re
 from tqdm import tqdm
 import zipfile
-import langid
 import xml.etree.ElementTree as ET
 
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 
+from utils.langid_cache import format_cache_stats, get_cache
+from utils.langid_utils import langid_code, restricted_candidates
+from utils.metrics import Metrics, RejectionLog, write_summary
+from utils.doc_shards import INDEX_NAME, SHARD_BYTES, ShardWriter
+from utils.overlap_index import index_path, iter_overlap_pairs, load_overlaps, write_overlap_index
+from utils.run_manifest import RunManifest
+from utils.shard_spec import load_shard, mark_shard_done, shard_dir
+from utils.script_filter import format_prefilter_stats, get_prefilter, prefilter_classify
+
+# early exit document language checks, see check_doc_language
+EARLY_EXIT_FIRST_BATCH = 16  # sentences classified before the first check, doubling after each batch
+EARLY_EXIT_MAX_BATCH = 256
+EARLY_EXIT_MIN_SAMPLE = 200  # sentences needed before a document can pass on the confidence bound alone
+EARLY_EXIT_Z = 3.0  # z score for the confidence bound, ~99.9% one sided
+MANIFEST_COMMIT_DOCS = 1000  # document pairs recorded in a run manifest between commits
 
-pct_stripper = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
 
 def setup_argparse():
     p = argparse.ArgumentParser()
     p.add_argument('-s', dest='source_dir', help='source dir for files')
     p.add_argument('-t', dest='target_dir', help='target dir to write extracted text')
-    p.add_argument('-f', '--file_ids', help='source dir for pre-extracted file ids')
+    p.add_argument('-f', '--file_ids', help='source dir for pre-extracted file ids (indices or pickles)')
     p.add_argument('--threshold', type=float, default=100,
                    help="threshold of acceptable inaccuracy in identified language")
     p.add_argument('--langs', nargs="+", help="list of languages to work on, if not given uses all")
+    p.add_argument('--langid_mode', choices=['full', 'restricted'], default='full',
+                   help="restricted only scores en, the target language and common confusers, which is faster")
+    p.add_argument('--workers', type=int, default=1, help="number of processes to use")
+    p.add_argument('--early_exit', action='store_true',
+                   help="stop language IDing a document once it clearly passes or fails --threshold")
+    p.add_argument('--multi', action='store_true',
+                   help="extract all languages in one pass, so each english document is only parsed and classified once")
+    p.add_argument('--script_prefilter', action='store_true',
+                   help="decide sentences whose unicode scripts settle their language before langid (see "
+                        "utils.script_filter)")
+    p.add_argument('--prefilter_audit', type=float, default=0.0,
+                   help="fraction of sentences the script prefilter decides that langid checks too")
+    p.add_argument('--cache', dest='cache_path', help="sqlite file to cache langid predictions in, shared between "
+                                                      "runs and languages")
+    p.add_argument('--shards', action='store_true',
+                   help="append documents to a few large shard files per lang pair dir, with an index.tsv of where "
+                        "each is (see utils.doc_shards), instead of writing en_{i}.txt and {lang}_{i}.txt files")
+    p.add_argument('--shard_bytes', type=int, default=SHARD_BYTES, help="size at which a new shard is started")
+    p.add_argument('--manifest', help="sqlite run manifest. Document pairs already done with the same parameters "
+                                      "(and the same zip entries) are skipped, so a run that died, or one with an "
+                                      "added language, only does what is left (see utils.run_manifest)")
+    p.add_argument('--shard_spec', help="extract one shard (a range of english documents) of a plan from "
+                                        "scripts/shard_plan.py. Output goes to a part_{n} dir in -t, for "
+                                        "scripts/shard_plan.py merge to combine")
+    p.add_argument('--shard', type=int, help="which shard of --shard_spec to extract")
+    p.add_argument('--rejection_log', help="gzip'd json lines file to log sentences and documents in the wrong "
+                                           "language to, with --rejection_sample of the sentences kept")
+    p.add_argument('--rejection_sample', type=float, default=1.0,
+                   help="fraction of rejected sentences to log, picked by document and line so runs log the same ones")
     return p.parse_args()
 
 
-def find_overlapping_files(p, all_files=False, target_dir=''):
+def iter_doc_pairs(alignment_file):
+    """
+    yields (fromDoc, toDoc) for every linkGrp in a gzip'd alignment file. The file is parsed incrementally and
+    elements are thrown away once read, so memory stays flat however big the alignment file is.
+    """
+    with gzip.open(alignment_file, 'rb') as fl:
+        context = ET.iterparse(fl, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if elem.tag != 'linkGrp':
+                continue
+            if event == 'start':
+                # attributes are already there on start, the links inside are never needed
+                yield elem.get('fromDoc'), elem.get('toDoc')
+            else:
+                root.clear()
+
+
+def read_alignment_file(alignment_file, show_progress=True):
+    """returns a list of (en doc, other lang, other doc) for an alignment file, or None if it can't be read"""
+    doc_pairs = []
+    try:
+        for fromDoc, toDoc in tqdm(iter_doc_pairs(alignment_file), desc=alignment_file, disable=not show_progress,
+                                   bar_format='{desc} {n_fmt} docs [{elapsed}]'):
+            # check for .gz ending and strip it
+            fromDoc, f_ext = os.path.splitext(fromDoc)
+            toDoc, t_ext = os.path.splitext(toDoc)
+
+            # fromDoc is always english
+            default_from = 'en'
+            tmp = toDoc
+            toDoc = toDoc if not toDoc.startswith(default_from) else fromDoc
+            fromDoc = fromDoc if fromDoc.startswith(default_from) else tmp
+            doc_pairs.append((fromDoc, toDoc.split('/')[0], toDoc))
+    except (OSError, EOFError, ET.ParseError):
+        return None
+    return doc_pairs
+
+
+def find_overlapping_files(p, all_files=False, target_dir='', workers=1):
     
     if all_files:
         files = glob.glob(p + '*.xml.gz')
@@ -56,40 +139,32 @@ def find_overlapping_files(p, all_files=False, target_dir=''):
     #   }
     # }
     print('Found files {}'.format(files))
-    for i, f in enumerate(files):
+    if workers > 1 and len(files) > 1:
+        # alignment files are independent, results are merged back in file order so the output doesn't change
+        pool = Pool(min(workers, len(files)))
+        results = pool.imap(partial(read_alignment_file, show_progress=False), files)
+    else:
+        pool = None
+        results = map(read_alignment_file, files)
+    for i, (f, doc_pairs) in enumerate(zip(files, results)):
         print('Processing {} | {}/{}'.format(f, i + 1, len(files)))
-        with gzip.open(f, 'rt') as fl:
-            try:
-                tree = ET.parse(fl)
-            except OSError:
-                print('skipping')
-                # os.remove(f)
-                continue
-            root = tree.getroot()
-            linkGrps = root.findall('linkGrp')
-            for linkGrp in tqdm(linkGrps, desc=f,
-                                bar_format='{desc}{percentage:3.0f}%|{bar}|{n_fmt}/{total_fmt}'):
-                # check for .gz ending and strip it
-                fromDoc, f_ext = os.path.splitext(linkGrp.get('fromDoc'))
-                toDoc, t_ext = os.path.splitext(linkGrp.get('toDoc'))
-
-                # fromDoc is always english
-                default_from = 'en'
-                tmp = toDoc
-                toDoc = toDoc if not toDoc.startswith(default_from) else fromDoc
-                fromDoc = fromDoc if fromDoc.startswith(default_from) else tmp
-                #breakpoint()
-                dic[fromDoc].update({toDoc.split('/')[0]: toDoc})
-
-    # 3. Save the dictionary in a file
+        if doc_pairs is None:
+            print('skipping')
+            continue
+        for fromDoc, other_lang, toDoc in doc_pairs:
+            dic[fromDoc].update({other_lang: toDoc})
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # 3. Save the dictionary as a compact index (see utils.overlap_index), which -f reads back
     out_file = os.path.join(target_dir, '{}_file_ids'.format(os.path.split(p)[1])) if not all_files else 'all_file_ids'
-    with open(out_file, 'wb') as f:
-        pickle.dump(dic, f)
+    write_overlap_index(dic, index_path(out_file))
     return dic
 
 
-def get_sents(this_zip, filename, lang):
-    all_sents, lang_ids = [], [] # lang_ids for data cleanup, coindexed with sentences
+def read_sents(this_zip, filename):
+    """the sentences of one document in a zip, or None if it can't be parsed"""
     with this_zip.open(filename, "r") as fin:
         try:
             tree = ET.parse(fin)
@@ -98,73 +173,555 @@ def get_sents(this_zip, filename, lang):
             return None
         root = tree.getroot()
         sents = root.findall("s")
-        for s in sents:
-            this_sent = " ".join([w.text for w in s.findall("w")])
-            clean_line = re.sub(r' +', ' ', this_sent.strip().translate(pct_stripper))
-            predict_lang, confidence = langid.classify(clean_line)
-            if predict_lang != lang:
-                print("Predicted Lang {} (Conf: {:4f}) for line: {}".format(predict_lang, confidence,
-                                                                      this_sent))
-            all_sents.append(this_sent)
-            lang_ids.append(predict_lang)
+        return [" ".join([w.text for w in s.findall("w")]) for s in sents]
 
+
+def classify_sents(sents, lang, candidate_langs=None, cache_path=None, filename=None, line_numbers=None,
+                   rejections=None, prefilter=None, metrics=None):
+    """
+    language IDs for sents, coindexed with them. The whole list is scored in one batch, through the script
+    prefilter if one is given (its stats go in metrics). Sentences not in lang are logged to rejections under
+    filename, by their line_numbers in the document (positions in sents by default)
+    """
+    lang_ids = []
+    predictions, stats = prefilter_classify(sents, prefilter, candidate_langs, cache_path)
+    if metrics is not None:
+        metrics.update(stats)
+    ok_langs = correct_langs(lang)
+    for j, (this_sent, (predict_lang, confidence)) in enumerate(zip(sents, predictions)):
+        if rejections is not None and predict_lang not in ok_langs:
+            rejections.log(filename, line_numbers[j] if line_numbers is not None else j, lang=lang,
+                           predicted=predict_lang, confidence=confidence, text=this_sent)
+        lang_ids.append(predict_lang)
+    return lang_ids
+
+
+def get_sents(this_zip, filename, lang, candidate_langs=None, cache_path=None, rejections=None, prefilter=None,
+              metrics=None):
+    all_sents = read_sents(this_zip, filename)
+    if all_sents is None:
+        return None, None
+    # lang_ids for data cleanup, coindexed with sentences
+    lang_ids = classify_sents(all_sents, lang, candidate_langs, cache_path, filename, rejections=rejections,
+                              prefilter=prefilter, metrics=metrics)
     return all_sents, lang_ids
 
 
-def check_percent_incorrect_lang(lang_list, correct_lang):
+def correct_langs(lang):
+    # langid's codes for lang, ie zh for zh_cn and zh_tw, as candidates and the prefilter use
     # add special casing for indonesian being usually misidentified as malay
-    if correct_lang == "id":
-        correct = lang_list.count("id") + lang_list.count("ms")
-    else:
-        correct = lang_list.count(correct_lang)
-    per_incorrect = (1 - (correct / len(lang_list))) * 100
-    return per_incorrect
+    if lang == "id":
+        return {"id", "ms"}
+    return {langid_code(lang)}
+
+
+def percent_incorrect(num_incorrect, total):
+    return (1 - ((total - num_incorrect) / total)) * 100
+
+
+def check_percent_incorrect_lang(lang_list, correct_lang):
+    ok_langs = correct_langs(correct_lang)
+    num_incorrect = sum(1 for lang in lang_list if lang not in ok_langs)
+    return percent_incorrect(num_incorrect, len(lang_list))
+
+
+def wilson_upper_bound(num_incorrect, num_sampled, z=EARLY_EXIT_Z):
+    """upper end of the wilson score interval for the incorrect rate given a sample"""
+    p = num_incorrect / num_sampled
+    denominator = 1 + z * z / num_sampled
+    centre = p + z * z / (2 * num_sampled)
+    margin = z * math.sqrt(p * (1 - p) / num_sampled + z * z / (4 * num_sampled * num_sampled))
+    return (centre + margin) / denominator
+
+
+def lang_prefilter(lang, candidate_langs=None, audit=0.0):
+    """the script prefilter for documents in lang, built once per language"""
+    return get_prefilter(frozenset(correct_langs(lang)),
+                         frozenset(candidate_langs) if candidate_langs is not None else None, audit)
+
+
+def check_doc_language(sents, lang, filename, threshold=100, candidate_langs=None, cache_path=None, early_exit=False,
+                       metrics=None, rejections=None, script_prefilter=False, prefilter_audit=0.0):
+    """
+    returns (passes, per_incorrect) where passes is whether the document's incorrect language percentage is under
+    threshold. Without early_exit every sentence is classified, as with get_sents and check_percent_incorrect_lang.
+    With early_exit sentences are classified in growing batches in a shuffled order (seeded by filename), and it
+    stops as soon as the document is certain to fail, certain to pass, or after EARLY_EXIT_MIN_SAMPLE sentences the
+    upper confidence bound on the incorrect rate is below threshold. per_incorrect is then only over the sentences
+    that were classified. Numbers of classified and skipped sentences are added to metrics, and sentences in the
+    wrong language are logged to rejections. With script_prefilter, sentences go through the script prefilter
+    before langid.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    prefilter = lang_prefilter(lang, candidate_langs, prefilter_audit) if script_prefilter else None
+    total = len(sents)
+    if not early_exit:
+        per_incorrect = check_percent_incorrect_lang(
+            classify_sents(sents, lang, candidate_langs, cache_path, filename, rejections=rejections,
+                           prefilter=prefilter, metrics=metrics), lang)
+        metrics["classified"] += total
+        return per_incorrect < threshold, per_incorrect
+
+    ok_langs = correct_langs(lang)
+    order = list(range(total))
+    random.Random(filename).shuffle(order)
+    num_incorrect, num_classified, batch_size = 0, 0, EARLY_EXIT_FIRST_BATCH
+    passes = None
+    while passes is None:
+        line_numbers = order[num_classified:num_classified + batch_size]
+        batch = [sents[j] for j in line_numbers]
+        lang_ids = classify_sents(batch, lang, candidate_langs, cache_path, filename, line_numbers, rejections,
+                                  prefilter, metrics)
+        num_incorrect += sum(1 for lang_id in lang_ids if lang_id not in ok_langs)
+        num_classified += len(batch)
+        batch_size = min(batch_size * 2, EARLY_EXIT_MAX_BATCH)
+
+        if percent_incorrect(num_incorrect, total) >= threshold:
+            passes = False  # fails even if every other sentence is right
+        elif percent_incorrect(num_incorrect + total - num_classified, total) < threshold:
+            passes = True  # passes even if every other sentence is wrong
+        elif num_classified >= EARLY_EXIT_MIN_SAMPLE and \
+                wilson_upper_bound(num_incorrect, num_classified) * 100 < threshold:
+            passes = True
+
+    metrics["classified"] += num_classified
+    metrics["not_classified"] += total - num_classified
+    return passes, num_incorrect / num_classified * 100
+
+
+def write_doc_pair(target_dir, lang, i, en_sents, other_sents, shards=None):
+    """writes the pair as en_{i}.txt and {lang}_{i}.txt in target_dir, or as document i of both langs in shards"""
+    if shards is not None:
+        shards.add(i, "en", "\n".join(en_sents))
+        shards.add(i, lang, "\n".join(other_sents))
+        return
+    with open(os.path.join(target_dir, "en_{}.txt".format(i)), "w") as en_out, \
+            open(os.path.join(target_dir, "{}_{}.txt".format(lang, i)), "w") as other_out:
+        en_out.write("\n".join(en_sents))
+        other_out.write("\n".join(other_sents))
+
+
+def log_doc_rejection(rejections, filename, lang, per_incorrect):
+    """documents over the threshold go in the rejection log as one record with no line number"""
+    if rejections is not None:
+        rejections.log(filename, None, lang=lang, percent_incorrect=round(per_incorrect, 2))
+
+
+def copy_doc_pair(z_en, z_other, i, en_file, other_file, target_dir, lang, threshold=100, candidate_langs=None,
+                  cache_path=None, early_exit=False, metrics=None, rejections=None, shards=None, script_prefilter=False,
+                  prefilter_audit=0.0):
+    """
+    language-IDs one aligned pair of documents and writes them out as en_{i}.txt and {lang}_{i}.txt (or to the
+    shards ShardWriter) if both are mostly in the right language. i is the pair's position in overlaps, so names don't
+    depend on processing order.
+    Returns "written", "skipped" (parse issues) or "incorrect" (language identification below threshold)
+    """
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.timer("parse"):
+        en_sents, other_sents = read_sents(z_en, en_file), read_sents(z_other, other_file)
+    if not en_sents or not other_sents:
+        return "skipped"
+    metrics["lines_read"] += len(en_sents) + len(other_sents)
+    check = partial(check_doc_language, threshold=threshold, candidate_langs=candidate_langs, cache_path=cache_path,
+                    early_exit=early_exit, metrics=metrics, rejections=rejections, script_prefilter=script_prefilter,
+                    prefilter_audit=prefilter_audit)
+    with metrics.timer("classify"):
+        en_ok, incorrect_en = check(en_sents, "en", en_file)
+        if not en_ok:
+            log_doc_rejection(rejections, en_file, "en", incorrect_en)
+        if early_exit and not en_ok:
+            metrics["not_classified"] += len(other_sents)
+            return "incorrect"
+        other_ok, incorrect_other = check(other_sents, lang, other_file)
+        if not other_ok:
+            log_doc_rejection(rejections, other_file, lang, incorrect_other)
+    if not en_ok or not other_ok:
+        return "incorrect"
+    with metrics.timer("write"):
+        write_doc_pair(target_dir, lang, i, en_sents, other_sents, shards)
+    metrics["lines_written"] += len(en_sents) + len(other_sents)
+    return "written"
+
+
+def copy_en_doc(zips, en_file, targets, target_dirs, threshold=100, langid_modes=None, cache_path=None,
+                early_exit=False, metrics=None, rejections=None, shards=None, script_prefilter=False,
+                prefilter_audit=0.0):
+    """
+    the multi language version of copy_doc_pair: the english document is parsed and language-IDed once, then
+    paired with each (lang, i, other_file) in targets. Returns a list of (lang, status).
+    langid_modes maps "en" and each lang to its candidate set (None for the full model), and shards (if given) maps
+    each lang to the ShardWriter of its lang pair.
+    """
+    langid_modes = langid_modes or {}
+    if metrics is None:
+        metrics = Metrics()
+    check = partial(check_doc_language, threshold=threshold, cache_path=cache_path, early_exit=early_exit,
+                    metrics=metrics, rejections=rejections, script_prefilter=script_prefilter,
+                    prefilter_audit=prefilter_audit)
+    with metrics.timer("parse"):
+        en_sents = read_sents(zips["en"], en_file)
+    if not en_sents:
+        return [(lang, "skipped") for lang, i, other_file in targets]
+    metrics["lines_read"] += len(en_sents)
+    with metrics.timer("classify"):
+        en_ok, incorrect_en = check(en_sents, "en", en_file, candidate_langs=langid_modes.get("en"))
+    if not en_ok:
+        # no need to open the other documents, none of these pairs can be written
+        log_doc_rejection(rejections, en_file, "en", incorrect_en)
+        return [(lang, "incorrect") for lang, i, other_file in targets]
+
+    results = []
+    for lang, i, other_file in targets:
+        with metrics.timer("parse"):
+            other_sents = read_sents(zips[lang], other_file)
+        if not other_sents:
+            results.append((lang, "skipped"))
+            continue
+        metrics["lines_read"] += len(other_sents)
+        with metrics.timer("classify"):
+            other_ok, incorrect_other = check(other_sents, lang, other_file, candidate_langs=langid_modes.get(lang))
+        if not other_ok:
+            log_doc_rejection(rejections, other_file, lang, incorrect_other)
+            results.append((lang, "incorrect"))
+            continue
+        with metrics.timer("write"):
+            write_doc_pair(target_dirs[lang], lang, i, en_sents, other_sents,
+                           shards[lang] if shards is not None else None)
+        metrics["lines_written"] += len(en_sents) + len(other_sents)
+        results.append((lang, "written"))
+    return results
+
+
+# each pool worker opens its own handles on the zips once, in open_zips_in_worker, and buffers its sampled
+# rejections (and documents, when writing shards) to send back with each result since only the main process
+# writes the rejection log and shards
+worker_zips = None
+worker_rejections = None
+worker_shards = None
+
+
+def open_zips_in_worker(source_dir, langs, rejection_sample=None, shards=False):
+    global worker_zips, worker_rejections, worker_shards
+    worker_zips = {lang: zipfile.ZipFile(os.path.join(source_dir, "{}.zip".format(lang))) for lang in ["en"] + langs}
+    worker_rejections = RejectionLog(sample_rate=rejection_sample, buffer=True) if rejection_sample else None
+    worker_shards = {lang: ShardWriter(buffer=True) for lang in langs} if shards else None
+
 
+def drain_worker_shards():
+    return {lang: writer.drain() for lang, writer in worker_shards.items()} if worker_shards else {}
 
-def copy_files(overlaps, source_dir, target_dir, lang, threshold=100):
+
+def copy_doc_pair_in_worker(task, **kwargs):
+    """
+    returns copy_doc_pair's status plus the worker's metrics (with cache stats), rejections and documents for the
+    shards, which would otherwise never reach the main process
+    """
+    metrics = Metrics()
+    status = copy_doc_pair(worker_zips["en"], worker_zips[kwargs["lang"]], *task, metrics=metrics,
+                           rejections=worker_rejections,
+                           shards=worker_shards[kwargs["lang"]] if worker_shards else None, **kwargs)
+    if kwargs["cache_path"]:
+        metrics.update(get_cache(kwargs["cache_path"]).pop_stats())
+    return status, metrics, worker_rejections.drain() if worker_rejections else [], drain_worker_shards()
+
+
+def copy_en_doc_in_worker(task, **kwargs):
+    metrics = Metrics()
+    results = copy_en_doc(worker_zips, *task, metrics=metrics, rejections=worker_rejections, shards=worker_shards,
+                          **kwargs)
+    if kwargs["cache_path"]:
+        metrics.update(get_cache(kwargs["cache_path"]).pop_stats())
+    return results, metrics, worker_rejections.drain() if worker_rejections else [], drain_worker_shards()
+
+
+def worker_rejection_sample(rejections):
+    """what open_zips_in_worker needs to know about the main process's rejection log: None if it is disabled"""
+    return rejections.sample_rate if rejections is not None and rejections.enabled else None
+
+
+def doc_pair_unit(z_en, z_other, lang, i, en_file, other_file):
+    """
+    (unit, fingerprint) of a document pair for the run manifest. The fingerprint is the pair's position plus the
+    crc and size the zips record for each document, so nothing has to be read to tell whether a pair changed
+    """
+    en_info, other_info = z_en.getinfo(en_file), z_other.getinfo(other_file)
+    unit = "\t".join([lang, en_file, other_file])
+    return unit, "{}:{}:{}:{}:{}".format(i, en_info.CRC, en_info.file_size, other_info.CRC, other_info.file_size)
+
+
+def doc_pair_params(target_dir, threshold, candidate_langs, early_exit, script_prefilter, shards):
+    """what a document pair's status and outputs depend on, besides its documents"""
+    return dict(stage="copy_files", target_dir=os.path.abspath(target_dir), threshold=threshold,
+                candidate_langs=candidate_langs, early_exit=early_exit, script_prefilter=script_prefilter,
+                shards=shards)
+
+
+def record_doc_pair(manifest, z_en, z_other, lang, task, status, params, num_recorded):
+    """
+    records a processed pair and its outputs in the manifest. A shard is only indexed once its writer moves on to
+    the next one, so with shards nothing is committed until the writer is closed and a crash redoes the pairs since
+    the last run (after the shards that were indexed, whose copies of those documents readers then ignore)
+    """
+    unit, fingerprint = doc_pair_unit(z_en, z_other, lang, *task)
+    outputs = []
+    if status == "written":
+        if params["shards"]:
+            outputs = [os.path.join(params["target_dir"], INDEX_NAME)]
+        else:
+            outputs = [os.path.join(params["target_dir"], name.format(task[0])) for name in ("en_{}.txt",
+                                                                                             lang + "_{}.txt")]
+    manifest.record(unit, fingerprint, params, status, outputs,
+                    commit=not params["shards"] and num_recorded % MANIFEST_COMMIT_DOCS == 0)
+
+
+def print_langid_stats(metrics, early_exit=False, cache_path=None, script_prefilter=False):
+    print("Sentences language IDed: {}".format(metrics["classified"]))
+    if early_exit:
+        total = metrics["classified"] + metrics["not_classified"]
+        print("Classifications skipped by early exit: {} ({:.2f}%)".format(
+            metrics["not_classified"], metrics["not_classified"] / total * 100 if total else 0))
+    if script_prefilter:
+        print(format_prefilter_stats(metrics))
+    if cache_path:
+        print(format_cache_stats(metrics))
+
+
+def copy_files(overlaps, source_dir, target_dir, lang, threshold=100, langid_mode="full", cache_path=None, workers=1,
+               early_exit=False, rejections=None, shards=False, shard_bytes=SHARD_BYTES, script_prefilter=False,
+               prefilter_audit=0.0, manifest=None, en_range=None):
     # keys in overlaps will be english, subdicts will be key other lang, values other file
+    # overlaps can also be an OverlapIndex (from load_overlaps), which is read a block of rows at a time
+    # pairs are done in order of english document, and with an en_range only those of english documents in it
+    # with shards, documents go into shard files in target_dir (see utils.doc_shards) rather than a file each
+    # with a RunManifest, pairs it has as up to date are skipped and every processed pair is recorded in it
     print("processing data for en and {}".format(lang))
     start_time = time.time()
     prefix = "OpenSubtitles/xml/"
+    candidate_langs = restricted_candidates({"en", lang}) if langid_mode == "restricted" else None
+    if rejections is None:
+        rejections = RejectionLog()
+    counts, metrics = Counter(), Metrics()
+    params = doc_pair_params(target_dir, threshold, candidate_langs, early_exit, script_prefilter, shards)
     with zipfile.ZipFile(os.path.join(source_dir, "en.zip")) as z_en, \
-         zipfile.ZipFile(os.path.join(source_dir, "{}.zip".format(lang))) as z_other: # currently only works for bitext, easy to extend
+         zipfile.ZipFile(os.path.join(source_dir, "{}.zip".format(lang))) as z_other, \
+         ShardWriter(target_dir if shards else None, shard_bytes, append=manifest is not None) as shard_writer: # currently only works for bitext, easy to extend
         all_en_files, all_other_files = set(z_en.namelist()), set(z_other.namelist())
-        skipped,incorrect_total = 0, 0
-        for i, en_file in enumerate(overlaps.keys()):
+        tasks = []
+        for i, en_file, other_file in iter_overlap_pairs(overlaps, lang):
+            if not in_en_range(en_file, en_range):
+                continue
             # make sure all found before copying otherwise data isn't parallel
-            other_file = overlaps[en_file][lang]
+            if other_file is None:  # all_file_ids has english docs that aren't aligned to this language
+                counts["skipped"] += 1
+                continue
             en_file = prefix + en_file
             other_file = prefix + other_file
-            #breakpoint()
             if en_file not in all_en_files or other_file not in all_other_files:
-                skipped += 1
+                counts["skipped"] += 1
                 continue
-            en_sents, en_langs = get_sents(z_en, en_file)
-            other_sents, other_langs = get_sents(z_other, other_file)
-            incorrect_en = check_percent_incorrect_lang(en_langs, "en")
-            incorrect_other = check_percent_incorrect_lang(other_langs, lang)
-            print("Incorrect % for en: {}, incorrect % for {}: {}".format(
-                incorrect_en, lang, incorrect_other
-            ))
-            #breakpoint()
-            if en_sents and other_sents:
-                if incorrect_en < threshold and incorrect_other < threshold:
-                    with open(os.path.join(target_dir, "en_{}.txt".format(i)), "w") as en_out, \
-                            open(os.path.join(target_dir, "{}_{}.txt".format(lang, i)), "w") as other_out:
-                        en_out.write("\n".join(en_sents))
-                        other_out.write("\n".join(other_sents))
-                        print("wrote {} lines of en and {} lines of {}".format(
-                            len(en_sents), len(other_sents), lang))
-                else:
-                    incorrect_total += 1
-            else:
-                skipped += 1
-        print("Seconds elapsed for this lang set ({} total files): {}".format(
-            time.time()-start_time, len(overlaps)))
-        print("Skipped due to parse issues or missing files: {}".format(skipped))
-        print("Skipped due to language identification below threshold: {}".format(incorrect_total))
+            if manifest is not None and manifest.lookup(*doc_pair_unit(z_en, z_other, lang, i, en_file, other_file),
+                                                        params) is not None:
+                counts["up_to_date"] += 1
+                continue
+            tasks.append((i, en_file, other_file))
+        tasks.sort(key=lambda task: task[1])
+
+        pair_kwargs = dict(target_dir=target_dir, lang=lang, threshold=threshold, candidate_langs=candidate_langs,
+                           cache_path=cache_path, early_exit=early_exit, script_prefilter=script_prefilter,
+                           prefilter_audit=prefilter_audit)
+        if workers > 1:
+            # in order, so each result can be matched up with its task
+            with Pool(workers, initializer=open_zips_in_worker,
+                      initargs=(source_dir, [lang], worker_rejection_sample(rejections), shards)) as pool:
+                for num_done, (task, (status, worker_stats, records, documents)) in enumerate(zip(tasks, pool.imap(
+                        partial(copy_doc_pair_in_worker, **pair_kwargs), tasks, chunksize=8)), 1):
+                    counts[status] += 1
+                    metrics.update(worker_stats)
+                    rejections.write_records(records)
+                    shard_writer.add_documents(documents.get(lang, []))
+                    if manifest is not None:
+                        record_doc_pair(manifest, z_en, z_other, lang, task, status, params, num_done)
+        else:
+            for num_done, task in enumerate(tasks, 1):
+                status = copy_doc_pair(z_en, z_other, *task, metrics=metrics, rejections=rejections,
+                                       shards=shard_writer if shards else None, **pair_kwargs)
+                counts[status] += 1
+                if manifest is not None:
+                    record_doc_pair(manifest, z_en, z_other, lang, task, status, params, num_done)
+            if cache_path:
+                metrics.update(get_cache(cache_path).pop_stats())
+    if manifest is not None:
+        manifest.commit()
+
+    print("Seconds elapsed for this lang set ({} total files): {}".format(
+        len(overlaps), time.time()-start_time))
+    print("Skipped due to parse issues or missing files: {}".format(counts["skipped"]))
+    print("Skipped due to language identification below threshold: {}".format(counts["incorrect"]))
+    if manifest is not None:
+        print("Up to date from an earlier run: {}".format(counts["up_to_date"]))
+    print_langid_stats(metrics, early_exit, cache_path, script_prefilter)
+    metrics["seconds_total"] = time.time() - start_time
+    write_summary(os.path.join(target_dir, "metrics.json"), metrics, lang=lang,
+                  **{"docs_" + status: count for status, count in counts.items()})
+    return counts
     
 
+def open_zips(source_dir, langs):
+    """the en zip and the zip of each of langs, by language"""
+    return {lang: zipfile.ZipFile(os.path.join(source_dir, "{}.zip".format(lang))) for lang in ["en"] + langs}
+
+
+def multi_langid_modes(langs, langid_mode="full"):
+    """the langid_modes of copy_en_doc: None for the full model, else each language's candidates"""
+    if langid_mode != "restricted":
+        return None
+    langid_modes = {lang: restricted_candidates({"en", lang}) for lang in langs}
+    langid_modes["en"] = restricted_candidates({"en"} | set(langs))
+    return langid_modes
+
+
+def in_en_range(en_file, en_range=None):
+    """
+    whether english document en_file is in a [first, end) en_range of a shard spec (see scripts/shard_plan.py), where
+    a None first or end is unbounded. No en_range takes in every document
+    """
+    if en_range is None:
+        return True
+    first, end = en_range
+    return (first is None or first <= en_file) and (end is None or en_file < end)
+
+
+def get_multi_tasks(lang2overlaps, zips, counts, en_range=None, manifest=None, lang2params=None):
+    """
+    the (en_file, [(lang, i, other_file)]) tasks of copy_files_multi: the per language overlaps merged by english
+    document, in order of english document so shards of an en_range each do a contiguous run of them. Pairs with a
+    missing document, or up to date in the manifest, are counted in counts[lang] instead
+    """
+    prefix = "OpenSubtitles/xml/"
+    namelists = {lang: set(z.namelist()) for lang, z in zips.items()}
+    en2targets = defaultdict(list)
+    for lang in sorted(lang2overlaps):
+        for i, en_file, other_file in iter_overlap_pairs(lang2overlaps[lang], lang):
+            if not in_en_range(en_file, en_range):
+                continue
+            if other_file is None:
+                counts[lang]["skipped"] += 1
+                continue
+            if prefix + en_file not in namelists["en"] or prefix + other_file not in namelists[lang]:
+                counts[lang]["skipped"] += 1
+                continue
+            if manifest is not None and manifest.lookup(*doc_pair_unit(
+                    zips["en"], zips[lang], lang, i, prefix + en_file, prefix + other_file),
+                    lang2params[lang]) is not None:
+                counts[lang]["up_to_date"] += 1
+                continue
+            en2targets[prefix + en_file].append((lang, i, prefix + other_file))
+    return sorted(en2targets.items())
+
+
+def iter_en_docs(tasks, zips, source_dir, doc_kwargs, workers=1, metrics=None, rejections=None, buffer=False,
+                 mp_context=None):
+    """
+    yields (task, results, documents) for each of copy_en_doc's tasks in order, on a pool of workers if there is
+    more than one. With buffer the documents are handed back as {lang: [(doc_id, lang, text)]} (as a buffered
+    ShardWriter drains them) instead of being written, and documents is empty otherwise. Worker metrics and rejections
+    go into metrics and rejections. The pool is started from mp_context if one is given, as with classify_lines
+    """
+    langs = sorted(lang for lang in zips if lang != "en")
+    if metrics is None:
+        metrics = Metrics()
+    if rejections is None:
+        rejections = RejectionLog()
+    if workers > 1:
+        # in order, so each result can be matched up with its task
+        with (mp_context.Pool if mp_context is not None else Pool)(
+                workers, initializer=open_zips_in_worker,
+                initargs=(source_dir, langs, worker_rejection_sample(rejections), buffer)) as pool:
+            for task, (results, worker_stats, records, documents) in zip(tasks, pool.imap(
+                    partial(copy_en_doc_in_worker, **doc_kwargs), tasks, chunksize=8)):
+                metrics.update(worker_stats)
+                rejections.write_records(records)
+                yield task, results, documents
+        return
+    writers = {lang: ShardWriter(buffer=True) for lang in langs} if buffer else None
+    for task in tasks:
+        results = copy_en_doc(zips, *task, metrics=metrics, rejections=rejections, shards=writers, **doc_kwargs)
+        yield task, results, {lang: writer.drain() for lang, writer in writers.items()} if writers else {}
+    if doc_kwargs["cache_path"]:
+        metrics.update(get_cache(doc_kwargs["cache_path"]).pop_stats())
+
+
+def copy_files_multi(lang2overlaps, source_dir, target_dirs, threshold=100, langid_mode="full", cache_path=None,
+                     workers=1, early_exit=False, rejections=None, shards=False, shard_bytes=SHARD_BYTES,
+                     script_prefilter=False, prefilter_audit=0.0, manifest=None, en_range=None):
+    """
+    copy_files for several languages at once. The per language overlaps are merged into one index keyed by english
+    document, so each english document is parsed and language-IDed once however many languages it is aligned to.
+    Output is written to target_dirs[lang] with the same names (or shards) copy_files would use, and pairs are
+    skipped and recorded with a manifest, or limited to an en_range, as with copy_files.
+    """
+    langs = sorted(lang2overlaps)
+    print("processing data for en and {}".format(", ".join(langs)))
+    start_time = time.time()
+    langid_modes = multi_langid_modes(langs, langid_mode)
+    if rejections is None:
+        rejections = RejectionLog()
+    counts = {lang: Counter() for lang in langs}
+    metrics = Metrics()
+
+    lang2params = {lang: doc_pair_params(target_dirs[lang], threshold,
+                                         [langid_modes["en"], langid_modes[lang]] if langid_modes else None,
+                                         early_exit, script_prefilter, shards) for lang in langs}
+
+    zips = open_zips(source_dir, langs)
+    shard_writers = {lang: ShardWriter(target_dirs[lang], shard_bytes, append=manifest is not None)
+                     for lang in langs} if shards else None
+    try:
+        tasks = get_multi_tasks(lang2overlaps, zips, counts, en_range, manifest, lang2params)
+        print("{} english documents aligned to {} documents in other languages".format(
+            len(tasks), sum(len(targets) for en_file, targets in tasks)))
+
+        doc_kwargs = dict(target_dirs=target_dirs, threshold=threshold, langid_modes=langid_modes,
+                          cache_path=cache_path, early_exit=early_exit, script_prefilter=script_prefilter,
+                          prefilter_audit=prefilter_audit)
+        num_done = 0
+        for (en_file, targets), results, documents in iter_en_docs(tasks, zips, source_dir, doc_kwargs, workers,
+                                                                   metrics, rejections, shards):
+            # results are in the same order as targets
+            for (lang, i, other_file), (_, status) in zip(targets, results):
+                counts[lang][status] += 1
+                if manifest is not None:
+                    num_done += 1
+                    record_doc_pair(manifest, zips["en"], zips[lang], lang, (i, en_file, other_file), status,
+                                    lang2params[lang], num_done)
+            for lang, lang_documents in documents.items():
+                shard_writers[lang].add_documents(lang_documents)
+    finally:
+        for writer in (shard_writers or {}).values():
+            writer.close()
+        if manifest is not None:
+            manifest.commit()
+        for z in zips.values():
+            z.close()
+
+    print("Seconds elapsed for {} languages: {}".format(len(langs), time.time()-start_time))
+    for lang in langs:
+        print("{}: {} written, skipped due to parse issues or missing files: {}, "
+              "skipped due to language identification below threshold: {}".format(
+            lang, counts[lang]["written"], counts[lang]["skipped"], counts[lang]["incorrect"]))
+        if manifest is not None:
+            print("{}: up to date from an earlier run: {}".format(lang, counts[lang]["up_to_date"]))
+    print_langid_stats(metrics, early_exit, cache_path, script_prefilter)
+    metrics["seconds_total"] = time.time() - start_time
+    for lang in langs:
+        # the metrics are shared by every language, since each english document was only processed once
+        write_summary(os.path.join(target_dirs[lang], "metrics.json"), metrics, lang=lang, langs=langs,
+                      **{"docs_" + status: count for status, count in counts[lang].items()})
+    return counts
+
+
 if __name__ == "__main__":
     args = setup_argparse()
 
@@ -173,18 +730,41 @@ if __name__ == "__main__":
     else:
         all_languages = ["zh_cn", "zh_tw", "eu", "ar", "fi", "id", "ta", "ru", "de", "el", "es"] # everything will be alphabetical
     print("Working on {} languages".format(len(all_languages)))
+    rejections = RejectionLog(args.rejection_log, args.rejection_sample)
+    manifest = RunManifest(args.manifest) if args.manifest else None
+    en_range = None
+    if args.shard_spec:
+        if args.shard is None:
+            sys.exit("--shard_spec needs --shard")
+        en_range = load_shard(args.shard_spec, "open_subs", args.shard)[1]["en_range"]
+        args.target_dir = shard_dir(args.target_dir, args.shard)
+    lang2overlaps, target_dirs = {}, {}
     for lang in all_languages:
         lang_pair = "{}-{}".format(*sorted([lang,"en"]))
         # make directory for lang pair if doesn't exist
         target_dir = os.path.join(args.target_dir, lang_pair)
         os.makedirs(target_dir, exist_ok=True)
         if not args.file_ids:
-            overlaps = find_overlapping_files(os.path.join(args.source_dir, lang_pair), target_dir=target_dir)
+            overlaps = find_overlapping_files(os.path.join(args.source_dir, lang_pair), target_dir=target_dir,
+                                              workers=args.workers)
         else:    
-            filepath = os.path.join(args.file_ids, '{}_file_ids'.format(lang_pair))
-            with open(filepath, 'rb') as fin:
-                overlaps = pickle.load(fin)
+            # either an index written by find_overlapping_files or an older pickle
+            overlaps = load_overlaps(os.path.join(args.file_ids, '{}_file_ids'.format(lang_pair)), lang)
 
-        copy_files(overlaps, args.source_dir, target_dir, lang, args.threshold)
+        if args.multi:
+            lang2overlaps[lang], target_dirs[lang] = overlaps, target_dir
+        else:
+            copy_files(overlaps, args.source_dir, target_dir, lang, args.threshold, args.langid_mode, args.cache_path,
+                       args.workers, args.early_exit, rejections, args.shards, args.shard_bytes, args.script_prefilter,
+                       args.prefilter_audit, manifest, en_range)
 
+    if args.multi:
+        copy_files_multi(lang2overlaps, args.source_dir, target_dirs, args.threshold, args.langid_mode,
+                         args.cache_path, args.workers, args.early_exit, rejections, args.shards, args.shard_bytes,
+                         args.script_prefilter, args.prefilter_audit, manifest, en_range)
+    rejections.close()
+    if manifest is not None:
+        manifest.close()
+    if args.shard_spec:
+        mark_shard_done(args.target_dir)
 
@@ -0,0 +1,247 @@
+import argparse
+import inspect
+import json
+import os
+import random
+import sys
+from collections import Counter, deque
+from typing import Dict, List, NamedTuple
+
+from preprocess.clean_data import WRITE_BUFFER_SIZE
+from preprocess.open_subs_preprocess import correct_langs, get_multi_tasks, iter_en_docs, multi_langid_modes, \
+    open_zips, print_langid_stats
+from scripts.minimal_subset import write_manifest
+from utils.corpus_io import open_text, output_path
+from utils.general_utils import read_yaml_config, reservoir_sample
+from utils.langid_utils import restricted_candidates
+from utils.metrics import RejectionLog
+from utils.overlap_index import load_overlaps
+from utils.pipeline import POOL_CONTEXT, QUEUE_SIZE, Stage, run_pipeline
+from utils.script_filter import classify_lines
+
+
+REPORT_PATH = "pipeline_report.json"
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(
+        description="extract, clean, sample and subset opensubtitles documents in one streaming pass over the zips, "
+                    "as set out in a yaml config (see config/pipeline.yaml)")
+    p.add_argument('-c', dest='config_file', required=True, help='yaml config with a pipeline section')
+    p.add_argument('--report', help='json file to write per stage metrics to, overrides the config')
+    return p.parse_args()
+
+
+class DocGroup(NamedTuple):
+    """
+    what flows between stages: an english document and the documents aligned to it that are still in, as
+    {lang: sentences}. name is the english document's file in en.zip
+    """
+    name: str
+    docs: Dict[str, List[str]]
+
+
+def num_lines(group: DocGroup) -> int:
+    return sum(len(doc) for doc in group.docs.values())
+
+
+def extract(groups, metrics, source_dir, file_ids, langs, threshold=100, langid_mode="full", workers=1,
+            early_exit=False, cache_path=None, script_prefilter=False, prefilter_audit=0.0, rejection_log=None,
+            rejection_sample=1.0):
+    """
+    open_subs_preprocess --multi as a source: every english document aligned to one of langs (by the
+    {lang_pair}_file_ids indices in file_ids) is language-IDed with the documents aligned to it, and the ones that
+    pass go downstream together instead of to files
+    """
+    source_dir, file_ids = os.path.expanduser(source_dir), os.path.expanduser(file_ids)
+    langs = sorted(langs)
+    lang2overlaps = {lang: load_overlaps(os.path.join(file_ids, "{}_file_ids".format("-".join(sorted([lang, "en"])))),
+                                         lang) for lang in langs}
+    doc_kwargs = dict(target_dirs={lang: None for lang in langs}, threshold=threshold,
+                      langid_modes=multi_langid_modes(langs, langid_mode), cache_path=cache_path,
+                      early_exit=early_exit, script_prefilter=script_prefilter, prefilter_audit=prefilter_audit)
+    zips = open_zips(source_dir, langs)
+    rejections = RejectionLog(rejection_log, rejection_sample)
+    try:
+        counts = {lang: Counter() for lang in langs}
+        tasks = get_multi_tasks(lang2overlaps, zips, counts)
+        metrics["pairs_skipped"] += sum(lang_counts["skipped"] for lang_counts in counts.values())
+        for (en_file, targets), results, documents in iter_en_docs(tasks, zips, source_dir, doc_kwargs, workers,
+                                                                   metrics, rejections, buffer=True,
+                                                                   mp_context=POOL_CONTEXT):
+            for _, status in results:
+                metrics["pairs_" + status] += 1
+            docs = {}
+            for lang_documents in documents.values():
+                for _, lang, text in lang_documents:
+                    docs[lang] = text.split("\n")
+            if docs:
+                yield DocGroup(en_file, docs)
+    finally:
+        rejections.close()
+        for z in zips.values():
+            z.close()
+    print_langid_stats(metrics, early_exit, cache_path, script_prefilter)
+
+
+def clean(groups, metrics, langs, workers=1, chunk_size=2000, langid_mode="full", confusers=None, cache_path=None):
+    """
+    clean_data for documents: keeps the sentences of each document that are in its language. Sentences of
+    consecutive documents are classified together chunk_size at a time (on a pool with workers > 1), and each
+    document goes on once all of its sentences are
+    """
+    candidate_langs = restricted_candidates(set.union(*(correct_langs(lang) for lang in ["en"] + list(langs))),
+                                            confusers) if langid_mode == "restricted" else None
+    pending = deque()  # documents whose sentences are being classified, in order
+
+    def iter_sents():
+        for group in groups:
+            pending.append(group)
+            for doc in group.docs.values():
+                yield from doc
+
+    def cleaned(group: DocGroup, predictions: List[str]) -> DocGroup:
+        docs, start = {}, 0
+        for lang, doc in group.docs.items():
+            ok_langs = correct_langs(lang)
+            docs[lang] = [sent for sent, predict_lang in zip(doc, predictions[start:start + len(doc)])
+                          if predict_lang in ok_langs]
+            metrics["kept"] += len(docs[lang])
+            metrics["cut"] += len(doc) - len(docs[lang])
+            start += len(doc)
+        return DocGroup(group.name, docs)
+
+    predictions = []
+    for _, predict_lang, _ in classify_lines(iter_sents(), workers, chunk_size, candidate_langs, cache_path, metrics,
+                                             mp_context=POOL_CONTEXT):
+        predictions.append(predict_lang)
+        while pending and len(predictions) >= num_lines(pending[0]):
+            group = pending.popleft()
+            yield cleaned(group, predictions)
+            del predictions[:num_lines(group)]
+    while pending:  # documents with no sentences left after the last one
+        yield cleaned(pending.popleft(), [])
+
+
+def sample(groups, metrics, max_docs, seed=42):
+    """
+    sample_from_data for documents: max_docs of them picked uniformly at random, in their original order. Whole
+    documents are sampled so every language's corpus keeps the same ones. Nothing goes on until the input is done,
+    and the sample is held in memory until then
+    """
+    for _, group in reservoir_sample(groups, max_docs, random.Random(seed)):
+        yield group
+
+
+def subset(groups, metrics, langs):
+    """minimal_subset for documents: only the ones with sentences in english and every one of langs, in those"""
+    keep = ["en"] + [lang for lang in langs if lang != "en"]
+    for group in groups:
+        if all(group.docs.get(lang) for lang in keep):
+            yield DocGroup(group.name, {lang: group.docs[lang] for lang in keep})
+        else:
+            metrics["dropped"] += 1
+
+
+STAGES = {"extract": extract, "clean": clean, "sample": sample, "subset": subset}
+SOURCES = {"extract"}  # stages that read no input, so have to come first
+
+
+class CorpusWriter(object):
+    """
+    Writes the documents of a stage as minimal_subset does: corpus.{lang} files of every document's sentences one
+    per line, in document order, and a manifest of each document's line count per language. Documents a language
+    doesn't have add no lines to its corpus
+    """
+
+    def __init__(self, output_dir: str, langs: List[str], compress=None, manifest="manifest.tsv"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.langs = langs
+        self.manifest = os.path.join(output_dir, manifest)
+        self.files = {lang: open_text(output_path(os.path.join(output_dir, "corpus.{}".format(lang)), compress), "w",
+                                      WRITE_BUFFER_SIZE) for lang in langs}
+        self.names, self.lang2counts = [], {lang: [] for lang in langs}
+
+    def __call__(self, group: DocGroup):
+        self.names.append(group.name)
+        for lang in self.langs:
+            doc = group.docs.get(lang, [])
+            self.files[lang].writelines(sent + "\n" for sent in doc)
+            self.lang2counts[lang].append(len(doc))
+
+    def close(self):
+        if self.files is None:
+            return
+        for fout in self.files.values():
+            fout.close()
+        self.files = None
+        num_misaligned = write_manifest(self.manifest, self.names, self.langs, self.lang2counts)
+        print("{}: {} documents, {} with different line counts across languages".format(
+            self.output_dir, len(self.names), num_misaligned), file=sys.stderr)
+
+
+def build_stages(config: dict) -> List[Stage]:
+    """
+    Stages from the pipeline section of a config, in order. langs (besides english) is set for every stage that
+    takes it, unless the stage sets its own. A stage with an output dir writes what it yields there as well as
+    passing it on, and the last stage has to have one
+    """
+    langs = config.get("langs")
+    specs = [dict(spec) for spec in config.get("stages") or []]
+    if not langs or not specs:
+        raise ValueError("the pipeline needs langs and stages")
+    if specs[0].get("name") not in SOURCES:
+        raise ValueError("the first stage has to be one of {}".format(", ".join(sorted(SOURCES))))
+    if not specs[-1].get("output"):
+        raise ValueError("the last stage needs an output, or what it yields goes nowhere")
+    stages, outputs = [], []
+    for k, spec in enumerate(specs):
+        name = spec.pop("name", None)
+        if name not in STAGES:
+            raise ValueError("unknown stage {}, stages are {}".format(name, ", ".join(STAGES)))
+        if k > 0 and name in SOURCES:
+            raise ValueError("{} can only be the first stage".format(name))
+        outputs.append((spec.pop("output", None), spec.pop("compress", None)))
+        if "langs" in inspect.signature(STAGES[name]).parameters:
+            spec.setdefault("langs", langs)
+        stages.append(Stage(name, STAGES[name], spec, lines=num_lines))
+    # only opened once every stage's settings are known to be good
+    for stage, (output, compress) in zip(stages, outputs):
+        if output:
+            stage_langs = stage.params.get("langs", langs)
+            stage.sink = CorpusWriter(os.path.expanduser(output),
+                                      ["en"] + [lang for lang in stage_langs if lang != "en"], compress)
+    return stages
+
+
+def report(stages: List[Stage], path: str):
+    """prints each stage's throughput and writes every stage's metrics to path"""
+    print("{:<10} {:>10} {:>12} {:>10} {:>14} {:>9} {:>9}".format("stage", "docs out", "lines out", "busy s",
+                                                                "lines/busy s", "wait in", "wait out"),
+          file=sys.stderr)
+    summaries = []
+    for stage in stages:
+        metrics = stage.metrics
+        lines = max(metrics["lines_in"], metrics["lines_out"])
+        metrics["lines_per_busy_second"] = lines / metrics["seconds_busy"] if metrics["seconds_busy"] else 0.0
+        print("{:<10} {:>10} {:>12} {:>10.2f} {:>14.1f} {:>9.2f} {:>9.2f}".format(
+            stage.name, metrics["items_out"], metrics["lines_out"], metrics["seconds_busy"],
+            metrics["lines_per_busy_second"], metrics["seconds_wait_input"], metrics["seconds_wait_output"]),
+            file=sys.stderr)
+        summaries.append(metrics.summary(stage=stage.name))
+    with open(path, "w") as fout:
+        json.dump(summaries, fout, indent=1)
+        fout.write("\n")
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    config = read_yaml_config(args.config_file).get("pipeline") or {}
+    try:
+        stages = build_stages(config)
+    except ValueError as e:
+        sys.exit("{}: {}".format(args.config_file, e))
+    run_pipeline(stages, config.get("queue_size", QUEUE_SIZE))
+    report(stages, args.report or config.get("report", REPORT_PATH))
@@ -3,6 +3,13 @@ import argparse
 import os
 import random
 import sys
+from contextlib import ExitStack
+from typing import List
+
+from utils.corpus_io import open_text, read_lines
+from utils.general_utils import reservoir_sample
+from utils.line_index import check_aligned, is_index_file
+from utils.metrics import is_metrics_file
 
 
 def setup_argparse():
@@ -11,10 +18,61 @@ def setup_argparse():
     p.add_argument('-f', dest='files', nargs='+', help='a list of all the files to use instead of a dir')
     p.add_argument('-t', dest='target_dir', help='a dir to write files to')
     p.add_argument('-m', dest='max_lines', type=int, help='maximum lines to sample down to')
+    p.add_argument('--seed', type=int, default=42, help='random seed, the same seed gives the same sample')
+    p.add_argument('--aligned', action='store_true',
+                   help='the files are parallel (ie en.txt and de.txt), sample the same lines from all of them')
+    p.add_argument('--index', action='store_true',
+                   help='sample through line offset indices (built once and kept next to the files), so only the '
+                        'sampled lines are read. Picks a different sample for a seed than streaming does')
 
     return p.parse_args()
 
 
+def sample_file(filepath: str, target_dir: str, max_lines: int, seed: int) -> int:
+    """
+    streams a file and writes max_lines of it picked uniformly at random, in their original order. Compressed files
+    give a sample compressed the same way
+    """
+    with read_lines(filepath) as fin:
+        sample = reservoir_sample(fin, max_lines, random.Random(seed))
+    with open_text(os.path.join(target_dir, os.path.split(filepath)[1]), "w") as fout:
+        fout.writelines(line for _, line in sample)
+    return len(sample)
+
+
+def sample_aligned_files(filepaths: List[str], target_dir: str, max_lines: int, seed: int) -> int:
+    """
+    streams parallel files in lockstep and writes the same max_lines line numbers of each, so the sampled files
+    stay aligned. The files must all have the same number of lines
+    """
+    with ExitStack() as stack:
+        fins = [stack.enter_context(read_lines(filepath)) for filepath in filepaths]
+        try:
+            sample = reservoir_sample(zip(*fins, strict=True), max_lines, random.Random(seed))
+        except ValueError:
+            sys.exit("files aren't aligned, they have different numbers of lines: {}".format(", ".join(filepaths)))
+    for side, filepath in enumerate(filepaths):
+        with open_text(os.path.join(target_dir, os.path.split(filepath)[1]), "w") as fout:
+            fout.writelines(lines[side] for _, lines in sample)
+    return len(sample)
+
+
+def sample_with_index(filepaths: List[str], target_dir: str, max_lines: int, seed: int) -> int:
+    """
+    picks max_lines line numbers up front and reads just those lines of each file through its line index. With more
+    than one file the files are treated as aligned and must have the same number of lines. Only for uncompressed files
+    """
+    try:
+        indices = check_aligned(filepaths)
+    except ValueError as e:
+        sys.exit(str(e))
+    num_lines = len(indices[0])
+    line_numbers = sorted(random.Random(seed).sample(range(num_lines), min(max_lines, num_lines)))
+    for index in indices:
+        with open(os.path.join(target_dir, os.path.split(index.filepath)[1]), "w") as fout:
+            fout.writelines(line + "\n" for line in index.get_lines(line_numbers))
+    return len(line_numbers)
+
 
 if __name__ == "__main__":
     args = setup_argparse()
@@ -22,7 +80,8 @@ if __name__ == "__main__":
     if args.data_dir:
         with os.scandir(args.data_dir) as source_dir:
             files = sorted([file.path for file in source_dir if file.is_file()
-                            and not file.name.startswith('.')])
+                            and not file.name.startswith('.') and not is_index_file(file.name)
+                            and not is_metrics_file(file.name)])
 
     elif args.files:
         files = args.files
@@ -31,11 +90,15 @@ if __name__ == "__main__":
         sys.exit("need to provide either -d or -f flag")
 
     os.makedirs(args.target_dir, exist_ok=True)
-    for filepath in files:
-        print("Working on: {}".format(filepath))
-        filename = os.path.split(filepath)[1]
-        with open(filepath, "r") as fin:
-            lines = fin.readlines()
-            out_lines = random.sample(lines, args.max_lines)
-        with open(os.path.join(args.target_dir, filename), "w") as fout:
-            fout.write("".join(out_lines))
\ No newline at end of file
+    if args.aligned:
+        print("Working on: {}".format(", ".join(files)))
+        sample = sample_with_index if args.index else sample_aligned_files
+        num_sampled = sample(files, args.target_dir, args.max_lines, args.seed)
+        print("Sampled {} aligned lines".format(num_sampled))
+    else:
+        for filepath in files:
+            print("Working on: {}".format(filepath))
+            if args.index:
+                sample_with_index([filepath], args.target_dir, args.max_lines, args.seed)
+            else:
+                sample_file(filepath, args.target_dir, args.max_lines, args.seed)
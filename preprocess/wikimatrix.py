@@ -1,42 +1,62 @@
 import argparse
-import csv
+import json
 import sys
-
-import yaml
 import os
+import tempfile
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+from functools import partial
+from multiprocessing import Pool
 from typing import List, Tuple, Dict
 
-from utils.general_utils import get_language_list
+import numpy as np
+
+from utils.corpus_io import COMPRESSED_EXTS, PrefetchReader, wrap_reader
+from utils.general_utils import chunked, get_language_list, read_yaml_config
+from utils.sentence_graph import ParallelSentenceGraph, pair_keys
+from utils.shard_spec import load_shard, mark_shard_done, shard_dir
+
+
+READ_CHUNK_BYTES = 1 << 22  # bytes of tsv read (and scores parsed) at a time
+# defaults for the wikimatrix section of a -c config
+LANG_LIST = "config/list_of_bitexts.txt"
+DATA_DIR = "~/data/WikiMatrix/"
+SIM_SCORE_THRESH = 1.04
+BATCH_SIZE = 100000  # pairs added to the graph at a time
 
 
 def setup_argparse():
     p = argparse.ArgumentParser()
-    p.add_argument('-c', dest='config_file', default='../config/zotero.yaml',
-                   help='a yaml config containing necessary API information')
-    #p.add_argument('-d', dest='output_dir', default='../outputs/D4/', help='dir to write output summaries to')
+    p.add_argument('-c', dest='config_file',
+                   help='a yaml config whose wikimatrix section can set lang_list, data_dir, sim_score_thresh and '
+                        'batch_size (see config/pipeline.yaml)')
+    p.add_argument('-o', dest='output_dir', default='wikimatrix_graph',
+                   help='dir to write the sentence store, components and N-way parallel sets to')
+    p.add_argument('--workers', type=int, default=1, help='number of processes to scan tsvs with')
+    p.add_argument('--unsorted', action='store_true',
+                   help="read every row, for tsvs that aren't sorted by descending score like the released ones")
+    p.add_argument('--min_langs', type=int, default=3,
+                   help='minimum number of languages a set of parallel sentences needs to be written out')
+    p.add_argument('--shard_spec', help="only scan one shard (a set of tsvs) of a plan from scripts/shard_plan.py, "
+                                        "writing the kept pairs to a part_{n} dir in -o. scripts/shard_plan.py "
+                                        "merge then builds the graph from every shard's scans")
+    p.add_argument('--shard', type=int, help="which shard of --shard_spec to scan")
     #p.add_argument('-m', dest='model_path', default='', help='path for a pre-trained embedding model')
     return p.parse_args()
 
 
-def read_yaml_config(config_file):
-    return yaml.load(open(config_file))
-
-"""
-def find_next_translation(src_sent, checked):
-    more_langs = []
-    more_sents = []
-    for lang_pair in all_lang_pairs_starting_with_src_dict:
-        if tgt_lang in checked:
-            continue
-        if src_sent in lang_pair_bitext:
-            more_langs.append(tgt_lang)
-            more_sents.append(tgt_sent)
-            checked.add(tgt_lang)
-            find_next_translation(tgt_sent, checked) # TODO make sure this works
-    return more_langs, more_sents
-"""
+def get_settings(config_file=None) -> Dict:
+    """the wikimatrix section of a yaml config, over the defaults"""
+    settings = dict(lang_list=LANG_LIST, data_dir=DATA_DIR, sim_score_thresh=SIM_SCORE_THRESH, batch_size=BATCH_SIZE)
+    if config_file:
+        section = read_yaml_config(config_file).get("wikimatrix") or {}
+        unknown = set(section) - set(settings)
+        if unknown:
+            sys.exit("unknown wikimatrix settings in {}: {}".format(config_file, ", ".join(sorted(unknown))))
+        settings.update(section)
+    settings["data_dir"] = os.path.expanduser(settings["data_dir"])
+    return settings
+
 
 def get_all_targets_from_pairs(all_language_pairs: List[Tuple]) -> Dict:
     # based on the way wikimatrix is constructed, translations are symmetrical, so they're not really src and target but equal pairs
@@ -48,79 +68,302 @@ def get_all_targets_from_pairs(all_language_pairs: List[Tuple]) -> Dict:
 
 
 def make_tsv_name(lang, tgt_lang, data_dir) -> Tuple:
-    """since bitext is symmetric, try both ways"""
+    """since bitext is symmetric, try both ways, as plain or compressed tsvs"""
     template = "WikiMatrix.{}-{}.tsv"
     t1, t2 = os.path.join(data_dir, template.format(lang, tgt_lang)), \
              os.path.join(data_dir, template.format(tgt_lang, lang))
-    if os.path.isfile(t1):
-        return t1, False  # returns whether the langs had to be swapped around
-    if os.path.isfile(t2):
-        return t2, True
+    for ext in ("",) + COMPRESSED_EXTS:
+        if os.path.isfile(t1 + ext):
+            return t1 + ext, False  # returns whether the langs had to be swapped around
+        if os.path.isfile(t2 + ext):
+            return t2 + ext, True
     print("No file for either language found. Check that the directory is correct? "
           "Looked in:\n{}\n{}".format(t1, t2), file=sys.stderr)
     return None, False
 
 
+def parse_scores(lines):
+    """
+    (scores, malformed) arrays for a chunk of tsv lines: each line's margin score, and whether it has none (no tab,
+    an empty or non-numeric first column) in which case its score is nan. Parsed in one go by numpy, or line by line
+    if that fails
+    """
+    fields = [score_field(line) for line in lines]
+    try:
+        scores = np.array(fields).astype(np.float64) if fields else np.zeros(0)
+    except ValueError:
+        scores = np.array([parse_score(field) for field in fields], dtype=np.float64)
+    return scores, ~np.isfinite(scores)
+
+
+def score_field(line):
+    end = line.find(b"\t")
+    return line[:end] if end > 0 else b"nan"
+
+
+def parse_score(field):
+    try:
+        return float(field)
+    except ValueError:
+        return np.nan
+
+
+def scan_tsv(tsv_name, swapped, sim_score_thresh, assume_sorted=True, batch_size=BATCH_SIZE, stats=None):
+    """
+    yields lists of up to batch_size (src_sent, tgt_sent) pairs for the rows of a wikimatrix tsv at or above
+    sim_score_thresh, adding rows_read, rows_kept, rows_malformed and byte counts to stats as it goes.
+    The file is read READ_CHUNK_BYTES at a time and the score column of each chunk is parsed in one go by numpy.
+    Wikimatrix files are sorted by descending margin score, so unless assume_sorted is off reading stops at the
+    first score below the threshold. Chunks are read (and decompressed, for .gz and .zst tsvs) on a background thread
+    while earlier ones are parsed, and bytes_read counts bytes of the file as stored, like file_bytes, up to the end
+    of the last chunk parsed (not however far the background thread got).
+    Rows without a score or three columns are skipped, and a third column with tabs in it is kept whole
+    """
+    if stats is None:
+        stats = Counter()
+    stats["file_bytes"] += os.path.getsize(tsv_name)
+    pairs, bytes_read = [], 0
+    with open(tsv_name, "rb") as raw, \
+            PrefetchReader(wrap_reader(raw, tsv_name), READ_CHUNK_BYTES, tell=raw.tell) as reader:
+        for lines, position in reader.positioned_chunks():
+            stats["rows_read"] += len(lines)
+            bytes_read = position
+            # wikimatrix format is sim_score \t src_sent \t tgt_sent
+            scores, malformed = parse_scores(lines)
+            keep = scores >= sim_score_thresh
+            # malformed rows don't end a sorted scan, only scores under the threshold do
+            in_order = keep | malformed
+            stop = assume_sorted and not in_order.all()
+            if stop:
+                end = int(np.argmin(in_order))
+                lines, keep, malformed = lines[:end], keep[:end], malformed[:end]
+            stats["rows_malformed"] += int(malformed.sum())
+            for line in (line for line, kept in zip(lines, keep) if kept):
+                row = line.decode("utf8").rstrip("\r\n").split("\t", 2)
+                if len(row) < 3:
+                    stats["rows_malformed"] += 1
+                    continue
+                pairs.append((row[1], row[2]) if not swapped else (row[2], row[1]))
+                if len(pairs) == batch_size:
+                    stats["rows_kept"] += len(pairs)
+                    yield pairs
+                    pairs = []
+            if stop:
+                break
+    stats["bytes_read"] += bytes_read
+    if pairs:
+        stats["rows_kept"] += len(pairs)
+        yield pairs
+
+
+def write_pairs(fout, pairs):
+    """
+    pairs to a binary file of scanned pairs, each sentence on a line of its own since sentences can have tabs but
+    never newlines
+    """
+    fout.writelines("{}\n{}\n".format(*pair).encode("utf8") for pair in pairs)
+
+
+def read_pairs(fin, batch_size=BATCH_SIZE):
+    """yields lists of up to batch_size pairs from a file written by write_pairs"""
+    for lines in chunked(fin, 2 * batch_size):
+        sents = [line[:-1].decode("utf8") for line in lines]
+        yield list(zip(sents[::2], sents[1::2]))
+
+
+def write_scan_report(report, path):
+    """one row per tsv of rows and bytes read against rows kept, to see how much reading the early stop saved"""
+    with open(path, "w") as fout:
+        fout.write("tsv\trows_read\trows_kept\trows_malformed\tbytes_read\tfile_bytes\n")
+        for tsv_name, stats in report:
+            fout.write("{}\t{}\t{}\t{}\t{}\t{}\n".format(os.path.basename(tsv_name), stats["rows_read"],
+                                                         stats["rows_kept"], stats["rows_malformed"],
+                                                         stats["bytes_read"], stats["file_bytes"]))
+
+
+def scan_paths(scan_dir, index):
+    """the kept pairs (as written by write_pairs) and stats of the index'th task, as scanned by a shard"""
+    name = os.path.join(scan_dir, "scan_{:05d}".format(index))
+    return name + ".pairs", name + ".json"
+
+
+def scan_to_file(task, out_dir, sim_score_thresh, assume_sorted=True, batch_size=BATCH_SIZE):
+    """scans an (index, lang, tgt_lang, tsv_name, swapped) task into its scan_paths in out_dir, returns its stats"""
+    index, _, _, tsv_name, swapped = task
+    pairs_path, stats_path = scan_paths(out_dir, index)
+    stats = Counter()
+    with open(pairs_path, "wb") as fout:
+        for pairs in scan_tsv(tsv_name, swapped, sim_score_thresh, assume_sorted, batch_size, stats):
+            write_pairs(fout, pairs)
+    with open(stats_path, "w") as fout:
+        json.dump(dict(stats), fout)
+    return stats
+
+
+def scan_shard(tasks, indices, out_dir, sim_score_thresh, workers=1, assume_sorted=True, batch_size=BATCH_SIZE):
+    """
+    scans the tasks of one shard, writing each one's kept pairs (swapped like scan_tsv's) and stats to out_dir
+    under its index in the full task list, for scan_into_graph to read back with index2dir
+    """
+    scan = partial(scan_to_file, out_dir=out_dir, sim_score_thresh=sim_score_thresh, assume_sorted=assume_sorted,
+                   batch_size=batch_size)
+    indexed = [(index,) + tuple(task) for index, task in zip(indices, tasks)]
+    pool = Pool(workers) if workers > 1 else None
+    for task, stats in zip(indexed, pool.imap(scan, indexed) if pool else map(scan, indexed)):
+        print("{}: kept {} of {} rows".format(task[3], stats["rows_kept"], stats["rows_read"]), file=sys.stderr)
+    if pool:
+        pool.close()
+        pool.join()
+
+
+def iter_task_pairs(task, sim_score_thresh, assume_sorted=True, batch_size=BATCH_SIZE, index2dir=None, stats=None):
+    """
+    yields batches of a task's kept pairs: scanned from its tsv, or with index2dir read back from the scan a shard
+    wrote (see scan_shard), in which case tasks start with their index
+    """
+    if stats is None:
+        stats = Counter()
+    if index2dir is None:
+        _, _, tsv_name, swapped = task
+        yield from scan_tsv(tsv_name, swapped, sim_score_thresh, assume_sorted, batch_size, stats)
+        return
+    pairs_path, stats_path = scan_paths(index2dir[task[0]], task[0])
+    with open(stats_path) as fin:
+        stats.update(json.load(fin))
+    with open(pairs_path, "rb") as fin:
+        yield from read_pairs(fin, batch_size)
+
+
+def spill_task(task, spill_dir, **kwargs):
+    """
+    on a worker: writes the kept pairs of a task and their sentence keys (hashing is the expensive part of adding
+    them to the graph) to files in spill_dir, for the main process to stream into the graph in task order.
+    Returns (task, pairs_path, keys_path, stats)
+    """
+    lang, tgt_lang = task[-4], task[-3]
+    stats = Counter()
+    name = os.path.join(spill_dir, "spill_{}".format("_".join(map(str, task[:-2]))))
+    with open(name + ".pairs", "wb") as pairs_out, open(name + ".keys", "wb") as keys_out:
+        for pairs in iter_task_pairs(task, stats=stats, **kwargs):
+            write_pairs(pairs_out, pairs)
+            pair_keys(lang, tgt_lang, pairs).tofile(keys_out)
+    return task, name + ".pairs", name + ".keys", stats
+
+
+def read_spill(pairs_path, keys_path, batch_size=BATCH_SIZE):
+    """yields (pairs, keys) batches of a task spilled by spill_task, and deletes its files once read"""
+    with open(pairs_path, "rb") as pairs_in, open(keys_path, "rb") as keys_in:
+        for pairs in read_pairs(pairs_in, batch_size):
+            yield pairs, np.fromfile(keys_in, dtype=np.uint64, count=2 * len(pairs))
+    os.remove(pairs_path)
+    os.remove(keys_path)
+
+
+def scan_into_graph(tasks, graph, sim_score_thresh, workers=1, batch_size=BATCH_SIZE, assume_sorted=True,
+                    index2dir=None) -> Counter:
+    """
+    scans the (lang, tgt_lang, tsv_name, swapped) tasks and adds their pairs to graph batch_size at a time, writing
+    scan_report.tsv to the graph's dir. Returns the stats summed over every tsv. With index2dir the tasks are
+    (index, lang, tgt_lang, tsv_name, swapped) and their pairs are read from shards' scans instead (see scan_shard).
+    With workers > 1 tsvs are scanned and hashed on a pool, each spilled to a file in the graph's dir that is read
+    back a batch at a time, so no process holds more than a batch of pairs whatever the size of a tsv
+    """
+    kwargs = dict(sim_score_thresh=sim_score_thresh, assume_sorted=assume_sorted, batch_size=batch_size,
+                  index2dir=index2dir)
+
+    def batches_in_process(task):
+        stats = Counter()
+        batches = ((pairs, None) for pairs in iter_task_pairs(task, stats=stats, **kwargs))
+        return task, batches, stats
+
+    def batches_from_pool(pool, spill_dir):
+        for task, pairs_path, keys_path, stats in pool.imap(partial(spill_task, spill_dir=spill_dir, **kwargs),
+                                                            tasks):
+            yield task, read_spill(pairs_path, keys_path, batch_size), stats
+
+    # files are scanned in parallel but added to the graph in order, so node ids don't depend on workers
+    report, total = [], Counter()
+    with tempfile.TemporaryDirectory(prefix="spill_", dir=graph.out_dir) as spill_dir:
+        pool = Pool(workers) if workers > 1 else None
+        results = batches_from_pool(pool, spill_dir) if pool else map(batches_in_process, tasks)
+        for task, batches, stats in results:
+            lang, tgt_lang, tsv_name = task[-4:-1]
+            for pairs, keys in batches:
+                graph.add_pairs(lang, tgt_lang, pairs, keys)
+            print("{}: read {} rows ({:.1f}% of the file), kept {}".format(
+                tsv_name, stats["rows_read"],
+                stats["bytes_read"] / stats["file_bytes"] * 100 if stats["file_bytes"] else 0, stats["rows_kept"]),
+                file=sys.stderr)
+            report.append((tsv_name, stats))
+            total.update(stats)
+        if pool:
+            pool.close()
+            pool.join()
+    write_scan_report(report, os.path.join(graph.out_dir, "scan_report.tsv"))
+    return total
+
+
+def get_tasks(all_language_pairs, data_dir) -> List[Tuple]:
+    """a (lang, tgt_lang, tsv_name, swapped) scan task for every language pair with a tsv in data_dir"""
+    tasks = []
+    for lang, tgt_lang in all_language_pairs:  # bitext is symmetric, so each pair only needs reading once
+        tsv_name, swapped = make_tsv_name(lang, tgt_lang, data_dir)
+        if tsv_name:
+            tasks.append((lang, tgt_lang, tsv_name, swapped))
+    return tasks
+
+
+def write_graph_outputs(graph, total, output_dir, min_langs):
+    """prints the scan and graph stats and writes the N-way parallel sets of graph to output_dir/nway.tsv"""
+    print("Read {} rows and {:.1f}% of {} bytes to keep {} pairs".format(
+        total["rows_read"], total["bytes_read"] / total["file_bytes"] * 100 if total["file_bytes"] else 0,
+        total["file_bytes"], total["rows_kept"]))
+
+    components = graph.finish()
+    print("{} sentences, {} pairs".format(len(components), graph.num_edges))
+
+    #print out the statistics
+    threshold = 10000 # minimum number of parallel sentences below which we do not care
+    lang_set_counts = graph.lang_set_counts(components)
+    for lang_set, num_parallel_sents in sorted(lang_set_counts.items(), key=lambda kv: (len(kv[0]), kv[1]),
+                                               reverse=True): #this is sorting them by maximum number of langs possible
+        if num_parallel_sents >= threshold:
+            print("{}: {}".format(lang_set, num_parallel_sents))
+
+    with open(os.path.join(output_dir, "nway.tsv"), "w", encoding="utf8") as fout:
+        for component, lang, sentence in graph.iter_sets(components, min_langs):
+            fout.write("{}\t{}\t{}\n".format(component, lang, sentence))
+
+
 if __name__ == "__main__":
     args = setup_argparse()
-    # things to go in a config later
-    lang_list = "config/list_of_bitexts.txt"
-    data_dir = "~/data/WikiMatrix/"
-    sim_score_thresh = 1.04
+    settings = get_settings(args.config_file)
 
-    langs2sents = defaultdict(list) # dictionary for storing list of languages and sentences that are in all of those. Coindexed key and rest
-    all_language_pairs = get_language_list(lang_list)
+    all_language_pairs = get_language_list(settings["lang_list"])
     src2tgts = get_all_targets_from_pairs(all_language_pairs)
     all_languages = list(src2tgts.keys())
     print("Processing {} languages and {} language pairs...".format(len(all_languages),
                                                                     len(all_language_pairs)))
     for key in sorted(src2tgts, key=lambda x: len(src2tgts[x]),reverse=True):
         print("{}: {}".format(key, len(src2tgts[key])), file=sys.stderr)
-    
-    for lang in all_languages:
-        checked = {lang}
-        curr_lang_list = [lang]
-        curr_sent_list = []
-        target_langs = src2tgts[lang]
-        for tgt_lang in target_langs:
-            # fetch tsv from data dir, load it in. Don't load in everything at once cause it's 60GB
-            tsv_name, swapped = make_tsv_name(lang, tgt_lang, data_dir)
-            if not tsv_name:
-                continue
-            with open(tsv_name, "r", newline='') as tsvin:
-                tsv_reader, swapped = csv.reader(tsvin, delimiter="\t")
-                # wikimatrix format is sim_score \t src_sent \t tgt_sent
-                total_skipped = 0
-                for row in tsv_reader:
-                    if float(row[0]) < sim_score_thresh:
-                        total_skipped += 1
-                    else:
-                        if not swapped:
-                            src_sent, tgt_sent = row[1], row[2]
-                        else:
-                            src_sent, tgt_sent = row[2], row[1]
-
-                        curr_sent_list.extend([src_sent, tgt_sent])
-                        curr_lang_list.append(tgt_lang)
-                        checked.add(tgt_lang)
-                        # this is where we spin out to all the languages that this
-                        #todo
-                        #more_langs, more_sents = find_next_translation(tgt_sent, checked)
-                        #curr_lang_list.extend(more_langs)
-                        #curr_sent_list.extend(more_sents)
-                        langs2sents[tuple(curr_lang_list)].extend(curr_sent_list)
-
-    #print out the statistics
-    threshold = 10000 # minimum number of parallel sentences below which we do not care
-    for lang_list in sorted(langs2sents, key=lambda k:len(k), reverse=True): #this is sorting them by maximum number of langs possible
-        num_parallel_sents = len(langs2sents[lang_list])
-        if num_parallel_sents < threshold:
-            break
-        print("{}: {}".format(lang_list, num_parallel_sents))
-
-    # TODO note that I could decide to instead not store the sentences and just store the lists and a count, if memory is an issue. Then I could fetch them later.
 
-                
-            
-        
+    if args.shard_spec:
+        if args.shard is None:
+            sys.exit("--shard_spec needs --shard")
+        # the spec fixes the tsvs and threshold, so every shard scans the same way
+        spec, shard = load_shard(args.shard_spec, "wikimatrix", args.shard)
+        out_dir = shard_dir(args.output_dir, args.shard)
+        os.makedirs(out_dir, exist_ok=True)
+        scan_shard([tuple(spec["tasks"][index]) for index in shard["tasks"]], shard["tasks"], out_dir,
+                   spec["sim_score_thresh"], args.workers, assume_sorted=not spec["unsorted"],
+                   batch_size=settings["batch_size"])
+        mark_shard_done(out_dir)
+        sys.exit()
 
+    # every (lang, sentence) becomes an integer node and every pair an edge, the text goes to a file on disk.
+    # Don't load in everything at once cause it's 60GB
+    graph = ParallelSentenceGraph(args.output_dir)
+    tasks = get_tasks(all_language_pairs, settings["data_dir"])
+    total = scan_into_graph(tasks, graph, settings["sim_score_thresh"], args.workers, settings["batch_size"],
+                            assume_sorted=not args.unsorted)
+    write_graph_outputs(graph, total, args.output_dir, args.min_langs)
@@ -0,0 +1,262 @@
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import zipfile
+from typing import Callable, Dict, List
+
+from preprocess.clean_data import filter_true_language, strict_filter_true_language
+from preprocess.dedup_bitext import dedup_bitext
+from preprocess.open_subs_preprocess import copy_files, find_overlapping_files
+from preprocess.wikimatrix import make_tsv_name, scan_into_graph
+from utils.dedup import MinHasher
+from utils.func_words import FOLDED_CSV
+from utils.general_utils import read_func_words
+from utils.langid_utils import restricted_candidates
+from utils.sentence_graph import ParallelSentenceGraph
+
+
+LANGS = ["en", "de", "fi", "es"]  # all in the function word csv and in langid, en has to be first
+FOREIGN_LINE_RATE = 0.1  # fraction of lines in a line file that are in another language
+FOREIGN_DOC_RATE = 0.05  # fraction of subtitle documents that are in the wrong language
+OS_PREFIX = "OpenSubtitles/xml/"
+SIM_SCORE_THRESH = 1.04
+STAGES = ["clean", "clean_restricted", "clean_strict", "find_overlaps", "copy_files", "copy_files_early_exit",
+          "copy_files_shards", "wikimatrix", "dedup", "dedup_bloom", "dedup_near"]
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="time every preprocessing stage on synthetic data")
+    p.add_argument('-o', dest='out_path', default='benchmark_results.jsonl',
+                   help='jsonl file results are appended to, one line per stage')
+    p.add_argument('--work_dir', help='dir to generate data and write stage outputs in, defaults to a temp dir')
+    p.add_argument('--keep', action='store_true', help="don't delete the work dir afterwards")
+    p.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--lines', type=int, default=50000, help='lines per line file')
+    p.add_argument('--docs', type=int, default=200, help='subtitle documents per language')
+    p.add_argument('--sents_per_doc', type=int, default=300)
+    p.add_argument('--tsv_rows', type=int, default=100000, help='rows per wikimatrix tsv')
+    p.add_argument('--seed', type=int, default=0)
+    return p.parse_args()
+
+
+class SentenceMaker(object):
+    """
+    makes up sentences out of each language's function words, which is enough for langid to tell them apart and
+    gives realistic lengths and character distributions without shipping any corpora
+    """
+
+    def __init__(self, langs: List[str], seed: int):
+        lang2words = read_func_words(FOLDED_CSV)
+        self.words = {lang: [word for word in lang2words[lang] if word.isalpha()] for lang in langs}
+        self.rng = random.Random(seed)
+
+    def sentence(self, lang: str) -> str:
+        words = self.rng.choices(self.words[lang], k=self.rng.randint(4, 16))
+        return " ".join(words).capitalize() + "."
+
+    def mixed(self, lang: str) -> str:
+        """a sentence in lang, or FOREIGN_LINE_RATE of the time in one of the other languages"""
+        if self.rng.random() < FOREIGN_LINE_RATE:
+            lang = self.rng.choice([other for other in self.words if other != lang])
+        return self.sentence(lang)
+
+
+def make_line_files(maker: SentenceMaker, out_dir: str, num_lines: int) -> Dict[str, str]:
+    """en.txt and de.txt of mixed language lines, the same length so they can be strict filtered as bitext"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for lang in ["en", "de"]:
+        paths[lang] = os.path.join(out_dir, "{}.txt".format(lang))
+        with open(paths[lang], "w") as fout:
+            for _ in range(num_lines):
+                fout.write(maker.mixed(lang) + "\n")
+    return paths
+
+
+def subtitle_xml(maker: SentenceMaker, lang: str, num_sents: int) -> bytes:
+    sents = []
+    for i in range(num_sents):
+        words = "".join("<w>{}</w>".format(word) for word in maker.sentence(lang).rstrip(".").split())
+        sents.append('<s id="{}">{}</s>'.format(i + 1, words))
+    return '<?xml version="1.0" encoding="utf-8"?>\n<document>\n{}\n</document>\n'.format("\n".join(sents)).encode()
+
+
+def make_open_subs(maker: SentenceMaker, source_dir: str, other_langs: List[str], num_docs: int,
+                   sents_per_doc: int) -> Dict[str, Dict[str, str]]:
+    """
+    {lang}.zip files laid out like the OpenSubtitles release plus a {pair}.xml.gz alignment per language, with
+    FOREIGN_DOC_RATE of the documents in the wrong language. Returns the overlaps find_overlapping_files would
+    """
+    os.makedirs(source_dir, exist_ok=True)
+    overlaps = {}
+    for lang in ["en"] + other_langs:
+        with zipfile.ZipFile(os.path.join(source_dir, "{}.zip".format(lang)), "w", zipfile.ZIP_DEFLATED) as zout:
+            for doc in range(num_docs):
+                doc_lang = lang
+                if maker.rng.random() < FOREIGN_DOC_RATE:
+                    doc_lang = maker.rng.choice([other for other in LANGS if other != lang])
+                zout.writestr(OS_PREFIX + "{}/{}/{}/{}.xml".format(lang, 1900 + doc % 100, doc, doc),
+                              subtitle_xml(maker, doc_lang, sents_per_doc))
+
+    for lang in other_langs:
+        pair = sorted([lang, "en"])
+        with gzip.open(os.path.join(source_dir, "{}-{}.xml.gz".format(*pair)), "wt") as fout:
+            fout.write('<?xml version="1.0" encoding="utf-8"?>\n<cesAlign version="1.0">\n')
+            for doc in range(num_docs):
+                docs = {l: "{}/{}/{}/{}.xml.gz".format(l, 1900 + doc % 100, doc, doc) for l in pair}
+                fout.write('<linkGrp targType="s" fromDoc="{}" toDoc="{}">\n'.format(docs[pair[0]], docs[pair[1]]))
+                for i in range(sents_per_doc):
+                    fout.write('<link xtargets="{0};{0}" overlap="0.9" />\n'.format(i + 1))
+                fout.write('</linkGrp>\n')
+                overlaps.setdefault(docs["en"][:-len(".gz")], {})[lang] = docs[lang][:-len(".gz")]
+            fout.write('</cesAlign>\n')
+    return overlaps
+
+
+def make_wikimatrix(maker: SentenceMaker, data_dir: str, langs: List[str], num_rows: int) -> List[tuple]:
+    """
+    a WikiMatrix.{l1}-{l2}.tsv per language pair, sorted by descending score like the release. Rows are drawn from
+    a shared pool of translations, so the pairs connect into n-way sets. Returns wikimatrix.py's scan tasks
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    concepts = [{lang: maker.sentence(lang) for lang in langs} for _ in range(num_rows)]
+    tasks = []
+    for i, lang in enumerate(langs):
+        for tgt_lang in langs[i + 1:]:
+            rows = []
+            for _ in range(num_rows):
+                concept = maker.rng.choice(concepts)
+                rows.append((1.0 + maker.rng.expovariate(10), concept[lang], concept[tgt_lang]))
+            rows.sort(key=lambda row: row[0], reverse=True)
+            with open(os.path.join(data_dir, "WikiMatrix.{}-{}.tsv".format(lang, tgt_lang)), "w") as fout:
+                for score, src_sent, tgt_sent in rows:
+                    fout.write("{:.6f}\t{}\t{}\n".format(score, src_sent, tgt_sent))
+            tsv_name, swapped = make_tsv_name(lang, tgt_lang, data_dir)
+            tasks.append((lang, tgt_lang, tsv_name, swapped))
+    return tasks
+
+
+def measure(func: Callable, *args, **kwargs) -> dict:
+    """
+    runs func in a forked child with its output silenced, so peak rss is the stage's own (plus any workers it
+    waits for) rather than whatever earlier stages left behind in this process
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def child():
+        with open(os.devnull, "w") as devnull:
+            os.dup2(devnull.fileno(), 1)
+            os.dup2(devnull.fileno(), 2)
+        error = None
+        start = time.perf_counter()
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            error = traceback.format_exc()
+        seconds = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on linux
+        peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                          resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        sender.send({"seconds": seconds, "peak_rss_mb": peak_rss_kb / 1024, "error": error})
+
+    process = multiprocessing.get_context("fork").Process(target=child)
+    process.start()
+    result = receiver.recv() if receiver.poll(None) else None
+    process.join()
+    return result or {"seconds": None, "peak_rss_mb": None, "error": "exited with {}".format(process.exitcode)}
+
+
+def run_wikimatrix(tasks, out_dir, workers):
+    graph = ParallelSentenceGraph(out_dir)
+    scan_into_graph(tasks, graph, SIM_SCORE_THRESH, workers)
+    graph.finish()
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmark_")
+    maker = SentenceMaker(LANGS, args.seed)
+
+    print("Generating data in {}...".format(work_dir), file=sys.stderr)
+    line_files = make_line_files(maker, os.path.join(work_dir, "lines"), args.lines)
+    source_dir = os.path.join(work_dir, "open_subs")
+    overlaps = make_open_subs(maker, source_dir, ["de"], args.docs, args.sents_per_doc)
+    wikimatrix_tasks = make_wikimatrix(maker, os.path.join(work_dir, "wikimatrix"), LANGS, args.tsv_rows)
+
+    def out_dir(stage):
+        path = os.path.join(work_dir, "out", stage)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    # stage -> (function, args, kwargs, {unit: amount of work done})
+    stages = {
+        "clean": (filter_true_language, (line_files["en"], {"en"}, out_dir("clean"), args.workers), {},
+                  {"lines": args.lines}),
+        "clean_restricted": (filter_true_language, (line_files["en"], {"en"}, out_dir("clean_restricted"),
+                                                    args.workers),
+                             {"candidate_langs": restricted_candidates({"en"})}, {"lines": args.lines}),
+        "clean_strict": (strict_filter_true_language, ([line_files["en"], line_files["de"]], [{"en"}, {"de"}],
+                                                       out_dir("clean_strict"), args.workers), {},
+                         {"lines": 2 * args.lines}),
+        "find_overlaps": (find_overlapping_files, (os.path.join(source_dir, "de-en"),),
+                          {"target_dir": out_dir("find_overlaps"), "workers": args.workers}, {"docs": args.docs}),
+        "copy_files": (copy_files, (overlaps, source_dir, out_dir("copy_files"), "de"),
+                       {"workers": args.workers}, {"docs": 2 * args.docs, "lines": 2 * args.docs * args.sents_per_doc}),
+        "copy_files_early_exit": (copy_files, (overlaps, source_dir, out_dir("copy_files_early_exit"), "de"),
+                                  {"workers": args.workers, "early_exit": True},
+                                  {"docs": 2 * args.docs, "lines": 2 * args.docs * args.sents_per_doc}),
+        "copy_files_shards": (copy_files, (overlaps, source_dir, out_dir("copy_files_shards"), "de"),
+                              {"workers": args.workers, "shards": True},
+                              {"docs": 2 * args.docs, "lines": 2 * args.docs * args.sents_per_doc}),
+        "wikimatrix": (run_wikimatrix, (wikimatrix_tasks, out_dir("wikimatrix"), args.workers), {},
+                       {"lines": len(wikimatrix_tasks) * args.tsv_rows}),
+        "dedup": (dedup_bitext, ([line_files["en"], line_files["de"]], out_dir("dedup")), {}, {"lines": args.lines}),
+        "dedup_bloom": (dedup_bitext, ([line_files["en"], line_files["de"]], out_dir("dedup_bloom"), "bloom"), {},
+                        {"lines": args.lines}),
+        "dedup_near": (dedup_bitext, ([line_files["en"], line_files["de"]], out_dir("dedup_near")),
+                       {"minhasher": MinHasher()}, {"lines": args.lines}),
+    }
+
+    run = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(), "python": platform.python_version(),
+           "workers": args.workers, "seed": args.seed, "scale": {"lines": args.lines, "docs": args.docs,
+                                                                 "sents_per_doc": args.sents_per_doc,
+                                                                 "tsv_rows": args.tsv_rows}}
+    with open(args.out_path, "a") as fout:
+        for stage in args.stages:
+            func, stage_args, stage_kwargs, work = stages[stage]
+            print("Running {}...".format(stage), file=sys.stderr)
+            result = measure(func, *stage_args, **stage_kwargs)
+            if result["error"] is None:
+                result.update({"{}_per_sec".format(unit): amount / result["seconds"] for unit, amount in work.items()})
+            record = dict(run, stage=stage, work=work, **result)
+            fout.write(json.dumps(record) + "\n")
+            fout.flush()
+            if result["error"] is not None:
+                print("{} failed:\n{}".format(stage, result["error"]), file=sys.stderr)
+            else:
+                print("{:<22} {:8.2f}s {} {:8.1f} MB".format(stage, result["seconds"], "  ".join(
+                    "{:10.1f} {}/s".format(result["{}_per_sec".format(unit)], unit) for unit in work),
+                    result["peak_rss_mb"]), file=sys.stderr)
+
+    if not args.keep and not args.work_dir:
+        shutil.rmtree(work_dir)
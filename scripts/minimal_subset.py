@@ -1,23 +1,119 @@
-import sys
+import argparse
+import io
 import os
-import itertools
+import sys
 from functools import reduce
+from multiprocessing.pool import ThreadPool
+from typing import List, Tuple
+
+from utils.corpus_io import open_binary, output_path
+from utils.doc_shards import ShardReader
+from utils.line_index import is_index_file
+
+
+COPY_BLOCK_BYTES = 1 << 24  # bytes copied from a document into the corpus at a time
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="concatenate the documents every language has into corpus.{lang} files")
+    p.add_argument('langs', nargs='+', help='one dir of documents per language, named by the language')
+    p.add_argument('--shards', help='read the documents of langs from a shard dir written by open_subs_preprocess '
+                                    '--shards, instead of from lang dirs')
+    p.add_argument('-o', dest='output_dir', default='.', help='dir to write corpus.{lang} and the manifest to')
+    p.add_argument('--workers', type=int, help='number of corpora to build at once, defaults to one per language')
+    p.add_argument('--compress', choices=['gz', 'zst'],
+                   help='compress the corpora. Compressed documents (.gz, .zst) are read as they are')
+    p.add_argument('--manifest', default='manifest.tsv', help='name of the per document line count manifest')
+    return p.parse_args()
+
+
+def shared_documents(langs: List[str]) -> List[str]:
+    """names of the documents present in every language's dir, sorted so every corpus has the same order"""
+    sets = [set(name for name in os.listdir(lang) if not is_index_file(name)) for lang in langs]
+    return sorted(reduce(set.intersection, sets))
+
+
+def shared_shard_documents(reader: ShardReader, langs: List[str]) -> List[int]:
+    """ids of the documents every language has in a shard dir, in id order"""
+    return sorted(reduce(set.intersection, [set(reader.doc_ids(lang)) for lang in langs]))
+
+
+def copy_counting_lines(fin, fout) -> int:
+    """
+    copies fin to fout a block at a time and returns the number of lines copied. A missing newline at the end is
+    added, so that the next document starts on a line of its own
+    """
+    num_lines, last = 0, b"\n"
+    while True:
+        block = fin.read(COPY_BLOCK_BYTES)
+        if not block:
+            break
+        fout.write(block)
+        num_lines += block.count(b"\n")
+        last = block[-1:]
+    if last != b"\n":
+        fout.write(b"\n")
+        num_lines += 1
+    return num_lines
+
+
+def build_corpus(lang: str, names: List[str], output_dir: str, compress=None) -> Tuple[str, List[int]]:
+    """writes corpus.{lang} out of the lang dir's copies of names, returning (lang, line count of each)"""
+    counts = []
+    with open_binary(output_path(os.path.join(output_dir, "corpus.{}".format(lang)), compress), "wb") as fout:
+        for name in names:
+            with open_binary(os.path.join(lang, name), "rb") as fin:
+                counts.append(copy_counting_lines(fin, fout))
+    return lang, counts
+
+
+def build_corpus_from_shards(reader: ShardReader, lang: str, doc_ids: List[int], output_dir: str,
+                             compress=None) -> Tuple[str, List[int]]:
+    """build_corpus for documents in a shard dir"""
+    counts = []
+    with open_binary(output_path(os.path.join(output_dir, "corpus.{}".format(lang)), compress), "wb") as fout:
+        for doc_id in doc_ids:
+            counts.append(copy_counting_lines(io.BytesIO(reader.read_bytes(doc_id, lang)), fout))
+    return lang, counts
+
+
+def write_manifest(path: str, names: List[str], langs: List[str], lang2counts: dict) -> int:
+    """
+    one row per document with its line count in each language and whether they all agree, which is what checking
+    alignment of the corpora needs without reading them again. Returns the number of misaligned documents
+    """
+    num_misaligned = 0
+    with open(path, "w") as fout:
+        fout.write("\t".join(["document"] + langs + ["aligned"]) + "\n")
+        for i, name in enumerate(names):
+            counts = [lang2counts[lang][i] for lang in langs]
+            aligned = len(set(counts)) == 1
+            num_misaligned += not aligned
+            fout.write("\t".join([str(name)] + [str(count) for count in counts] + [str(int(aligned))]) + "\n")
+    return num_misaligned
+
 
-langs = sys.argv[1:]
-sets = []
+if __name__ == "__main__":
+    args = setup_argparse()
 
-for lang in langs:
-	sets.append(set(os.listdir(lang)))
+    reader = ShardReader(args.shards) if args.shards else None
+    names = shared_shard_documents(reader, args.langs) if reader else shared_documents(args.langs)
+    print("{} documents shared by {}".format(len(names), ", ".join(args.langs)), file=sys.stderr)
+    os.makedirs(args.output_dir, exist_ok=True)
 
-filelist = reduce(set.intersection, sets)
+    if reader:
+        build = lambda lang: build_corpus_from_shards(reader, lang, names, args.output_dir, args.compress)
+    else:
+        build = lambda lang: build_corpus(lang, names, args.output_dir, args.compress)
+    # copying is io bound, so threads are enough to keep every disk busy
+    with ThreadPool(args.workers or len(args.langs)) as pool:
+        lang2counts = dict(pool.imap_unordered(build, args.langs))
+    if reader:
+        reader.close()
 
-# check that they have the same tags
-for lang in langs:
-	outfile = open("corpus.{}".format(lang), "w")
-	pathnames = [os.path.join(i, j) for (i, j) in itertools.product([lang], filelist)]
-	dumps = [open(i, "r").readlines() for i in pathnames]
-	for d in dumps:
-		for line in d:
-			outfile.write(line)
-	
-	
+    num_misaligned = write_manifest(os.path.join(args.output_dir, args.manifest), names, args.langs, lang2counts)
+    for lang in args.langs:
+        print("corpus.{}: {} lines".format(lang, sum(lang2counts[lang])), file=sys.stderr)
+    if num_misaligned:
+        print("{} documents have different line counts across languages, see {}".format(num_misaligned,
+                                                                                        args.manifest), file=sys.stderr)
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+from typing import List
+
+from preprocess.wikimatrix import get_settings, get_tasks, scan_into_graph, write_graph_outputs
+from utils.corpus_io import compression_ext
+from utils.doc_shards import INDEX_NAME, SHARD_BYTES, is_shard_dir, merge_shard_dirs
+from utils.general_utils import get_language_list
+from utils.metrics import is_metrics_file
+from utils.overlap_index import iter_overlap_pairs, load_overlaps
+from utils.sentence_graph import ParallelSentenceGraph
+from utils.shard_spec import (DONE_NAME, count_lines, is_shard_done, line_offsets, line_starts_after, load_spec,
+                              shard_dir, write_spec)
+
+
+COPY_BLOCK_BYTES = 1 << 24  # bytes copied at a time when concatenating shard outputs
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(
+        description="split clean_data, open_subs_preprocess and wikimatrix runs into shards that can run on "
+                    "different machines (each with --shard_spec SPEC --shard N), and merge what they write back "
+                    "into what a single run would have written")
+    sub = p.add_subparsers(dest='command', required=True)
+    clean = sub.add_parser('clean', help='newline aligned byte ranges of the files to clean')
+    clean.add_argument('files', nargs='+')
+    clean.add_argument('--strict_filter', action='store_true',
+                       help='plan for clean_data --strict_filter, with the first two files split at the same lines')
+    subs = sub.add_parser('open_subs', help='ranges of english documents of the overlaps')
+    subs.add_argument('-f', '--file_ids', required=True, help='the pre-extracted file ids open_subs_preprocess uses')
+    subs.add_argument('--langs', nargs='+', required=True)
+    wiki = sub.add_parser('wikimatrix', help='sets of tsvs to scan')
+    wiki.add_argument('-c', dest='config_file', help="a config with a wikimatrix section, as for wikimatrix.py, which "
+                                                     "--lang_list, --data_dir and --sim_score_thresh override")
+    wiki.add_argument('--lang_list')
+    wiki.add_argument('--data_dir')
+    wiki.add_argument('--sim_score_thresh', type=float)
+    wiki.add_argument('--unsorted', action='store_true', help="read every row of every tsv, see wikimatrix.py")
+    for plan in (clean, subs, wiki):
+        plan.add_argument('-n', dest='num_shards', type=int, required=True, help='number of shards to aim for')
+        plan.add_argument('-o', dest='spec', required=True, help='json file to write the shard spec to')
+    merge = sub.add_parser('merge', help="combine the part_{n} dirs the shards of a spec wrote to output_dir")
+    merge.add_argument('spec')
+    merge.add_argument('output_dir', help='the -o (or -t) every shard was run with')
+    merge.add_argument('--shard_bytes', type=int, default=SHARD_BYTES,
+                       help='the --shard_bytes open_subs_preprocess --shards was run with')
+    merge.add_argument('--workers', type=int, default=1, help='processes hashing scanned wikimatrix pairs')
+    merge.add_argument('--min_langs', type=int, default=3, help='as for wikimatrix.py')
+    return p.parse_args()
+
+
+def split_points(size: int, pieces: int) -> List[int]:
+    return [size * k // pieces for k in range(1, pieces)]
+
+
+def plan_clean(files: List[str], num_shards: int, strict: bool = False) -> List[dict]:
+    """
+    shards of {files, ranges, first_lines}: byte ranges of the files that start on a line, with the number of that
+    line so cleaned lines are numbered as in a single run. Large files are split and small ones grouped (with no
+    range, for the whole file). In strict mode the two sides are split at the same lines. Compressed files can't be
+    split, so are always whole
+    """
+    sizes = [os.path.getsize(filepath) for filepath in files]
+    if strict:
+        files, sizes = files[:2], sizes[:2]
+        if any(compression_ext(filepath) for filepath in files):
+            return [dict(files=files, ranges=None, first_lines=[0, 0])]
+        num_lines = [count_lines(filepath) for filepath in files]
+        if num_lines[0] != num_lines[1]:
+            sys.exit("{} has {} lines but {} has {}, they aren't aligned".format(files[0], num_lines[0], files[1],
+                                                                                num_lines[1]))
+        # split the first side by bytes, then the second at the same lines
+        starts = [(0, 0)] + line_starts_after(files[0], split_points(sizes[0], num_shards)) + \
+                 [(sizes[0], num_lines[0])]
+        lines = sorted(set(line for _, line in starts))
+        offsets = [sorted(set(offset for offset, _ in starts)), line_offsets(files[1], lines)]
+        return [dict(files=files, ranges=[[offsets[0][k], offsets[0][k + 1]], [offsets[1][k], offsets[1][k + 1]]],
+                     first_lines=[lines[k], lines[k]]) for k in range(len(lines) - 1)]
+
+    target = max(sum(sizes) // num_shards, 1)
+    pieces = []  # (file, range, first_line, bytes), in file and line order
+    for filepath, size in zip(files, sizes):
+        if compression_ext(filepath) or size <= target:
+            pieces.append((filepath, None, 0, size))
+            continue
+        starts = [(0, 0)] + line_starts_after(filepath, split_points(size, -(-size // target))) + [(size, None)]
+        starts = sorted(set(starts), key=lambda start: start[0])
+        pieces.extend((filepath, [start, end], first_line, end - start)
+                      for (start, first_line), (end, _) in zip(starts, starts[1:]) if end > start)
+    shards, current, current_bytes = [], None, 0
+    for filepath, byte_range, first_line, size in pieces:
+        if current is None or current_bytes + size > target:
+            current, current_bytes = dict(files=[], ranges=[], first_lines=[]), 0
+            shards.append(current)
+        if current["files"] and current["files"][-1] == filepath:
+            # the next piece of the file before, which would write to the same outputs, so they become one range
+            current["ranges"][-1][1] = byte_range[1]
+        else:
+            current["files"].append(filepath)
+            current["ranges"].append(byte_range)
+            current["first_lines"].append(first_line)
+        current_bytes += size
+    return shards
+
+
+def plan_open_subs(file_ids: str, langs: List[str], num_shards: int) -> List[dict]:
+    """
+    shards of {en_range}: [first, end) ranges of the sorted english documents aligned to any of langs, about as many
+    documents each. open_subs_preprocess does documents in that order, so the shards' outputs put together in shard
+    order are what one run writes. The first shard's first and the last one's end are None, for no bound
+    """
+    en_docs = set()
+    for lang in langs:
+        lang_pair = "{}-{}".format(*sorted([lang, "en"]))
+        overlaps = load_overlaps(os.path.join(file_ids, '{}_file_ids'.format(lang_pair)), lang)
+        en_docs.update(en_doc for _, en_doc, other_doc in iter_overlap_pairs(overlaps, lang) if other_doc is not None)
+    en_docs = sorted(en_docs)
+    bounds = sorted(set(bound for bound in split_points(len(en_docs), num_shards) if bound > 0))
+    firsts = [None] + [en_docs[bound] for bound in bounds]
+    return [dict(en_range=[first, end]) for first, end in zip(firsts, firsts[1:] + [None])]
+
+
+def plan_wikimatrix(tasks: List[tuple], num_shards: int) -> List[dict]:
+    """
+    shards of {tasks}: sets of tsvs (indices into tasks) with about the same number of bytes each, the biggest
+    first to whichever shard has the fewest so far
+    """
+    shards = [dict(tasks=[], bytes=0) for _ in range(min(num_shards, len(tasks)))]
+    sizes = [os.path.getsize(task[2]) for task in tasks]
+    for index in sorted(range(len(tasks)), key=lambda index: sizes[index], reverse=True):
+        shard = min(shards, key=lambda shard: shard["bytes"])
+        shard["tasks"].append(index)
+        shard["bytes"] += sizes[index]
+    for shard in shards:
+        shard["tasks"].sort()
+    return shards
+
+
+def check_done(spec_path: str, shard_dirs: List[str]):
+    missing = [str(n) for n, out_dir in enumerate(shard_dirs) if not is_shard_done(out_dir)]
+    if missing:
+        sys.exit("shards {} of {} haven't finished".format(", ".join(missing), spec_path))
+
+
+def merge_metrics(paths: List[str], out_path: str):
+    """
+    sums the metrics summaries of the shards, keeping their layout. Other fields (which file they are for, ...) are
+    the first shard's
+    """
+    merged = {}
+    for path in paths:
+        with open(path) as fin:
+            for name, value in json.load(fin).items():
+                if name in merged and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    merged[name] += value
+                else:
+                    merged.setdefault(name, value)
+    with open(out_path, "w") as fout:
+        json.dump({name: round(value, 3) if isinstance(value, float) else value for name, value in merged.items()},
+                  fout, indent=1)
+        fout.write("\n")
+
+
+def merge_outputs(shard_dirs: List[str], output_dir: str, concatenate: bool, shard_bytes: int = SHARD_BYTES):
+    """
+    puts together the files the shards wrote, by their path relative to the shard's dir: metrics summaries are
+    summed, document shard dirs merged, and other files concatenated in shard order (ie pieces of a cleaned file),
+    or with concatenate off taken from the first shard that has them (ie documents, which only one shard writes).
+    Compressed pieces are concatenated as they are, which gives a valid multi member .gz (or multi frame .zst) with
+    the same content as one run's but not the same bytes. Compressed outputs aren't byte for byte the same between
+    single runs either, since gzip headers have the time they were written
+    """
+    rel2sources, rel2shard_dirs = {}, {}
+    for out_dir in shard_dirs:
+        for root, dirs, names in os.walk(out_dir):
+            dirs.sort()
+            rel_root = os.path.relpath(root, out_dir)
+            sharded = is_shard_dir(root)
+            if sharded:
+                rel2shard_dirs.setdefault(rel_root, []).append(root)
+            for name in sorted(names):
+                if name == DONE_NAME or (sharded and (name == INDEX_NAME or name.startswith("shard_"))):
+                    continue
+                rel2sources.setdefault(os.path.normpath(os.path.join(rel_root, name)), []).append(
+                    os.path.join(root, name))
+    for rel, sources in rel2sources.items():
+        out_path = os.path.join(output_dir, rel)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        if is_metrics_file(rel):
+            merge_metrics(sources, out_path)
+        elif concatenate:
+            with open(out_path, "wb") as fout:
+                for source in sources:
+                    with open(source, "rb") as fin:
+                        shutil.copyfileobj(fin, fout, COPY_BLOCK_BYTES)
+        else:
+            shutil.copyfile(sources[0], out_path)
+    for rel, dirs in rel2shard_dirs.items():
+        num_docs = merge_shard_dirs(dirs, os.path.join(output_dir, rel), shard_bytes)
+        print("{}: {} documents".format(os.path.join(output_dir, rel), num_docs), file=sys.stderr)
+    print("Merged {} files from {} shards into {}".format(len(rel2sources), len(shard_dirs), output_dir),
+          file=sys.stderr)
+
+
+def merge_wikimatrix(spec: dict, shard_dirs: List[str], output_dir: str, workers=1, min_langs=3):
+    """builds the graph out of the shards' scans, in the spec's task order, as wikimatrix.py would have"""
+    index2dir = {index: out_dir for shard, out_dir in zip(spec["shards"], shard_dirs) for index in shard["tasks"]}
+    tasks = [(index,) + tuple(task) for index, task in enumerate(spec["tasks"])]
+    graph = ParallelSentenceGraph(output_dir)
+    total = scan_into_graph(tasks, graph, spec["sim_score_thresh"], workers, index2dir=index2dir)
+    write_graph_outputs(graph, total, output_dir, min_langs)
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    if args.command == 'merge':
+        spec = load_spec(args.spec)
+        shard_dirs = [shard_dir(args.output_dir, n) for n in range(len(spec["shards"]))]
+        check_done(args.spec, shard_dirs)
+        if spec["stage"] == "wikimatrix":
+            merge_wikimatrix(spec, shard_dirs, args.output_dir, args.workers, args.min_langs)
+        else:
+            merge_outputs(shard_dirs, args.output_dir, spec["stage"] == "clean", args.shard_bytes)
+        sys.exit()
+
+    fields = {}
+    if args.command == 'clean':
+        shards = plan_clean(args.files, args.num_shards, args.strict_filter)
+        fields = dict(strict=args.strict_filter)
+    elif args.command == 'open_subs':
+        shards = plan_open_subs(args.file_ids, args.langs, args.num_shards)
+        fields = dict(file_ids=args.file_ids, langs=args.langs)
+    else:
+        settings = get_settings(args.config_file)
+        settings.update((name, getattr(args, name)) for name in ("lang_list", "data_dir", "sim_score_thresh")
+                        if getattr(args, name) is not None)
+        tasks = get_tasks(get_language_list(settings["lang_list"]), os.path.expanduser(settings["data_dir"]))
+        shards = plan_wikimatrix(tasks, args.num_shards)
+        fields = dict(tasks=tasks, sim_score_thresh=settings["sim_score_thresh"], unsorted=args.unsorted)
+    write_spec(args.spec, args.command, shards, **fields)
+    print("Wrote {} shards to {}".format(len(shards), args.spec), file=sys.stderr)
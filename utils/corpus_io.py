@@ -0,0 +1,198 @@
+import gzip
+import io
+import queue
+import threading
+from typing import BinaryIO, Callable, Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:  # only needed for .zst corpora
+    zstandard = None
+
+
+COMPRESSED_EXTS = (".gz", ".zst")
+GZIP_LEVEL = 3  # compression levels for output, chosen for speed since outputs are intermediate
+ZSTD_LEVEL = 3
+PREFETCH_CHUNK_BYTES = 1 << 22  # lines read per chunk by the background reader
+PREFETCH_DEPTH = 4  # chunks read ahead of the consumer
+
+
+def compression_ext(path: str) -> str:
+    """.gz or .zst if path is compressed, otherwise ''"""
+    for ext in COMPRESSED_EXTS:
+        if path.endswith(ext):
+            return ext
+    return ""
+
+
+def strip_compression_ext(path: str) -> str:
+    """en.txt.gz -> en.txt, so names and languages can be worked out as for plain files"""
+    ext = compression_ext(path)
+    return path[:-len(ext)] if ext else path
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise ImportError("reading or writing .zst files needs the zstandard package (pip install zstandard)")
+
+
+def wrap_reader(raw: BinaryIO, path: str) -> BinaryIO:
+    """a decompressing binary stream over raw, an already open file, by path's extension"""
+    ext = compression_ext(path)
+    if ext == ".gz":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if ext == ".zst":
+        require_zstandard()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=False))
+    return raw
+
+
+def open_binary(path: str, mode: str = "rb") -> BinaryIO:
+    """opens path for binary reading ("rb"), writing ("wb") or appending ("ab"), compressed according to its extension"""
+    ext = compression_ext(path)
+    if ext == ".gz":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL)
+    if ext == ".zst":
+        require_zstandard()
+        if "r" in mode:
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")))
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(open(path, mode))
+    return open(path, mode)
+
+
+def open_text(path: str, mode: str = "r", buffering: int = -1):
+    """
+    like open(path, mode) for text, but .gz and .zst paths are decompressed on read and compressed on write.
+    Compressed files are always utf8, plain ones use open's default as before
+    """
+    if not compression_ext(path):
+        return open(path, mode, buffering=buffering)
+    binary = open_binary(path, mode.replace("t", "") + ("b" if "b" not in mode else ""))
+    if buffering > 1 and "r" not in mode:
+        binary = io.BufferedWriter(binary, buffer_size=buffering)
+    return io.TextIOWrapper(binary, encoding="utf8")
+
+
+class PrefetchReader(object):
+    """
+    Reads a file a chunk of lines at a time on a background thread, up to PREFETCH_DEPTH chunks ahead, so that
+    reading and decompressing (which release the GIL) overlap with whatever the consumer does with the lines.
+    Iterating gives lines, chunks() gives the lists of lines as read. The file is closed with the reader.
+    With a tell function (ie the tell of the raw file under a decompressor) positioned_chunks() gives each chunk
+    with where tell was once it had been read, so a consumer that stops early can tell how much it used
+    """
+
+    _END = object()
+
+    def __init__(self, fileobj, chunk_bytes: int = PREFETCH_CHUNK_BYTES, depth: int = PREFETCH_DEPTH,
+                 tell: Optional[Callable[[], int]] = None):
+        self.fileobj = fileobj
+        self.tell = tell
+        self.chunk_bytes = chunk_bytes
+        self.queue = queue.Queue(maxsize=depth)
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            while True:
+                lines = self.fileobj.readlines(self.chunk_bytes)
+                if not lines:
+                    break
+                if not self._put((lines, self.tell() if self.tell is not None else None)):
+                    return
+            self._put(self._END)
+        except Exception as e:  # handed to the consumer to raise
+            self._put(e)
+
+    def positioned_chunks(self) -> Iterator[Tuple[List, Optional[int]]]:
+        while True:
+            item = self.queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def chunks(self) -> Iterator[List]:
+        for lines, _ in self.positioned_chunks():
+            yield lines
+
+    def __iter__(self):
+        for lines in self.chunks():
+            yield from lines
+
+    def stop(self):
+        """stops reading ahead, leaving the file open (ie to see how far into it the reader got)"""
+        self.stopping.set()
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _RangeReader(io.RawIOBase):
+    """the bytes [start, end) of a file as a raw stream, which ends at end"""
+
+    def __init__(self, path: str, start: int, end: int):
+        self.raw = open(path, "rb", buffering=0)
+        self.raw.seek(start)
+        self.remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        read = self.raw.readinto(memoryview(buffer)[:self.remaining]) if self.remaining > 0 else 0
+        self.remaining -= read
+        return read
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def open_range(path: str, start: int, end: int):
+    """
+    the lines of bytes [start, end) of a plain file, read as open(path) would (same encoding and newlines). The
+    range should start and end on line boundaries, ie as planned by utils.shard_spec
+    """
+    if compression_ext(path):
+        raise ValueError("can't read a byte range of a compressed file: {}".format(path))
+    return io.TextIOWrapper(io.BufferedReader(_RangeReader(path, start, end)))
+
+
+def read_lines(path: str, prefetch: bool = True, byte_range=None):
+    """
+    opens path (compressed or not) for reading lines, with a PrefetchReader unless prefetch is off. With a
+    (start, end) byte_range only the lines in it are read. Use as a context manager, like open
+    """
+    fin = open_range(path, *byte_range) if byte_range else open_text(path, "r")
+    return PrefetchReader(fin) if prefetch else fin
+
+
+def output_path(path: str, compression: Optional[str] = None) -> str:
+    """path with the extension for compression ("gz" or "zst") added, or as is for None"""
+    return "{}.{}".format(path, compression) if compression else path
+
+
+def is_corpus_file(name: str, ext: str) -> bool:
+    """whether name is a corpus file with extension ext once any compression extension is taken off"""
+    return strip_compression_ext(name).endswith(ext)
@@ -0,0 +1,197 @@
+import hashlib
+import math
+from typing import List, Tuple
+
+import numpy as np
+
+from utils.langid_utils import normalize_line
+from utils.sentence_graph import claim_slots, find_slots, grown_capacity, table_capacity
+
+
+SHINGLE_CHARS = 5  # characters per shingle for minhash
+NUM_PERM = 64  # minhash permutations, split into bands for lsh
+NUM_BANDS = 16  # 16 bands of 4 rows flag 64% of pairs at 0.5 jaccard similarity and almost all at 0.8
+SEPARATOR = "\x00"  # between the sides of a pair, and padding for texts shorter than a shingle
+MINHASH_SEED = 1234  # so every run draws the same permutations
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def pair_key(line1: str, line2: str) -> int:
+    """64 bit hash of a (line, line) pair, never 0 since 0 marks an empty slot (as sentence_key)"""
+    digest = hashlib.blake2b("{}\t{}".format(line1, line2).encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def pair_keys(lines1: List[str], lines2: List[str]) -> np.ndarray:
+    return np.fromiter((pair_key(line1, line2) for line1, line2 in zip(lines1, lines2)), dtype=np.uint64,
+                       count=len(lines1))
+
+
+def first_occurrences(keys: np.ndarray) -> np.ndarray:
+    """whether each key is the first of its value in keys"""
+    first = np.zeros(len(keys), dtype=bool)
+    first[np.unique(keys, return_index=True)[1]] = True
+    return first
+
+
+class ExactSet(object):
+    """
+    Set of nonzero uint64 keys in an open addressing numpy hash table of just the keys (probed as a HashInterner's
+    is), 8 to 16 bytes a key. Exact, but grows with the number of distinct keys, with no limit on how many
+    """
+
+    def __init__(self, capacity: int = 1 << 20):
+        self.keys = np.zeros(table_capacity(capacity), dtype=np.uint64)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        return self.keys[find_slots(self.keys, keys)] == keys
+
+    def add(self, keys: np.ndarray):
+        keys = np.unique(keys)
+        keys = keys[~self.contains(keys)]
+        capacity = grown_capacity(len(self.keys), self.size + len(keys))
+        if capacity != len(self.keys):
+            old_keys = self.keys[self.keys != 0]
+            self.keys = np.zeros(capacity, dtype=np.uint64)
+            claim_slots(self.keys, old_keys)
+        claim_slots(self.keys, keys)
+        self.size += len(keys)
+
+    @property
+    def nbytes(self) -> int:
+        return self.keys.nbytes
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over uint64 keys in a numpy bit array of fixed size, which holds capacity keys with about
+    error_rate false positives (keys reported as seen that weren't). Bit positions come from double hashing the
+    two halves of the key, so keys should already be well mixed hashes
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 1e-4):
+        capacity = max(capacity, 1)
+        self.num_bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = np.zeros((self.num_bits + 7) // 8, dtype=np.uint8)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def positions(self, keys: np.ndarray) -> np.ndarray:
+        h1 = keys & np.uint64(0xFFFFFFFF)
+        h2 = (keys >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.num_bits)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        positions = self.positions(keys)
+        bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def add(self, keys: np.ndarray):
+        positions = self.positions(keys).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.size += len(keys)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def false_positive_rate(self) -> float:
+        """the expected false positive rate at the current fill"""
+        return (1 - math.exp(-self.num_hashes * self.size / self.num_bits)) ** self.num_hashes
+
+
+def make_seen_set(method: str, capacity: int, error_rate: float):
+    return BloomFilter(capacity, error_rate) if method == "bloom" else ExactSet()
+
+
+def near_dup_text(line1: str, line2: str) -> str:
+    """
+    what near duplicate detection compares: both sides normalized as for langid (see normalize_line) and casefolded,
+    so pairs that only differ in punctuation, spacing or case count as the same
+    """
+    return normalize_line(line1).casefold() + SEPARATOR + normalize_line(line2).casefold()
+
+
+class MinHasher(object):
+    """
+    MinHash signatures of texts' character shingles, a batch at a time in numpy: shingles are hashed with a
+    polynomial rolling hash, each permutation is a multiply-add of that hash, and the minimum per text is taken with
+    reduceat. band_keys turns signatures into one key per band for locality sensitive hashing
+    """
+
+    def __init__(self, num_perm: int = NUM_PERM, num_bands: int = NUM_BANDS, shingle_chars: int = SHINGLE_CHARS,
+                 seed: int = MINHASH_SEED):
+        if num_perm % num_bands:
+            raise ValueError("num_perm ({}) has to be a multiple of num_bands ({})".format(num_perm, num_bands))
+        rng = np.random.default_rng(seed)
+        self.multipliers = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.increments = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self.num_bands = num_bands
+        self.shingle_chars = shingle_chars
+
+    def shingle_hashes(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """(hash of every shingle, index of each text's first shingle)"""
+        n = self.shingle_chars
+        texts = [text.ljust(n, SEPARATOR) for text in texts]
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        code_points = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        num_starts = len(code_points) - n + 1
+        hashes = np.zeros(num_starts, dtype=np.uint64)
+        for j in range(n):
+            hashes = hashes * HASH_MULTIPLIER + code_points[j:j + num_starts]
+        # only shingles that don't run into the next text
+        ends = np.cumsum(lengths)
+        text_ids = np.repeat(np.arange(len(texts)), lengths)[:num_starts]
+        valid = np.arange(num_starts) + n <= ends[text_ids]
+        return hashes[valid], np.concatenate([[0], np.cumsum(lengths - n + 1)[:-1]])
+
+    def signatures(self, texts: List[str]) -> np.ndarray:
+        """a (texts x num_perm) array of minhashes"""
+        hashes, starts = self.shingle_hashes(texts)
+        signatures = np.empty((len(texts), len(self.multipliers)), dtype=np.uint64)
+        for i, (multiplier, increment) in enumerate(zip(self.multipliers, self.increments)):
+            signatures[:, i] = np.minimum.reduceat((hashes * multiplier + increment) >> np.uint64(32), starts)
+        return signatures
+
+    def band_keys(self, texts: List[str]) -> np.ndarray:
+        """a (texts x num_bands) array of nonzero keys, equal for two texts when a whole band of minhashes is"""
+        signatures = self.signatures(texts)
+        rows = signatures.shape[1] // self.num_bands
+        keys = np.empty((len(texts), self.num_bands), dtype=np.uint64)
+        for band in range(self.num_bands):
+            key = np.full(len(texts), band + 1, dtype=np.uint64)
+            for column in signatures[:, band * rows:(band + 1) * rows].T:
+                key = (key ^ column) * HASH_MULTIPLIER
+            keys[:, band] = key ^ (key >> np.uint64(29))
+        keys[keys == 0] = 1
+        return keys
+
+
+def near_duplicates(band_keys: np.ndarray, seen, skip: np.ndarray) -> np.ndarray:
+    """
+    which rows share a band key with a kept earlier row, or with one in seen, the rows of earlier batches. Rows in
+    skip (ie exact duplicates) are neither checked nor kept. Band keys of the rows that are kept are added to seen
+    """
+    dups = seen.contains(band_keys.ravel()).reshape(band_keys.shape).any(axis=1) & ~skip
+    # rows that share a key with another row of this batch depend on whether that row is kept, so go in order
+    values, counts = np.unique(band_keys[~skip].ravel(), return_counts=True)
+    shared = np.isin(band_keys, values[counts > 1]).any(axis=1) & ~skip & ~dups
+    kept_keys = set()
+    for row in np.flatnonzero(shared).tolist():
+        row_keys = band_keys[row].tolist()
+        if kept_keys.intersection(row_keys):
+            dups[row] = True
+        else:
+            kept_keys.update(row_keys)
+    kept = ~skip & ~dups
+    seen.add(band_keys[kept].ravel())
+    return dups
@@ -0,0 +1,219 @@
+import argparse
+import os
+import sys
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+SHARD_BYTES = 1 << 30  # a new shard is started once the current one is this big
+INDEX_NAME = "index.tsv"
+INDEX_HEADER = "doc_id\tlang\tshard\tstart\tend\n"
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="list and unpack documents in a shard dir written by ShardWriter")
+    sub = p.add_subparsers(dest='command', required=True)
+    ls = sub.add_parser('list', help='count the documents of each language')
+    ls.add_argument('shard_dir')
+    cat = sub.add_parser('cat', help='print documents')
+    cat.add_argument('shard_dir')
+    cat.add_argument('lang')
+    cat.add_argument('doc_ids', nargs='+', type=int)
+    export = sub.add_parser('export', help='write every document out as {lang}_{doc_id}.txt, the unsharded layout')
+    export.add_argument('shard_dir')
+    export.add_argument('target_dir')
+    return p.parse_args()
+
+
+def shard_name(shard: int) -> str:
+    return "shard_{:05d}.txt".format(shard)
+
+
+def is_shard_dir(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+class ShardWriter(object):
+    """
+    Appends documents to a few large shard files in shard_dir instead of writing a file per document. Each document
+    is utf8 text followed by a newline, and index.tsv gives the doc id, language, shard and [start, end) byte offsets
+    of every document (without its newline). A shard's documents are appended to the index (and flushed) once the
+    shard is finished, when the next one is started or on close, so after a crash the index still has every finished
+    shard. Without a shard_dir nothing is written, unless buffer is set, in which case documents are kept for drain()
+    (ie to send back from a pool worker to the process that owns the shards), as with RejectionLog.
+    With append, the documents already indexed in shard_dir are kept and new ones go into new shards after the last
+    indexed one, so only an unfinished shard from a crashed run is overwritten.
+    """
+
+    def __init__(self, shard_dir: Optional[str] = None, shard_bytes: int = SHARD_BYTES, buffer: bool = False,
+                 append: bool = False):
+        self.shard_dir = shard_dir
+        self.shard_bytes = shard_bytes
+        self.documents = [] if buffer else None
+        self.pending = []  # index entries of the shard being written
+        self.shard, self.offset, self.fout, self.index_file = -1, 0, None, None
+        if shard_dir:
+            os.makedirs(shard_dir, exist_ok=True)
+        if shard_dir and not buffer:
+            index_path = os.path.join(shard_dir, INDEX_NAME)
+            if append and is_shard_dir(shard_dir):
+                with ShardReader(shard_dir) as reader:
+                    self.shard = max((location[0] for location in reader.index.values()), default=-1)
+                self.index_file = open(index_path, "a")
+            else:
+                self.index_file = open(index_path, "w")
+                self.index_file.write(INDEX_HEADER)
+                self.index_file.flush()
+
+    @property
+    def enabled(self) -> bool:
+        return self.shard_dir is not None or self.documents is not None
+
+    def _finish_shard(self):
+        """closes the current shard and indexes its documents"""
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+        self.index_file.writelines("{}\t{}\t{}\t{}\t{}\n".format(*entry) for entry in self.pending)
+        self.index_file.flush()
+        self.pending = []
+
+    def _next_shard(self):
+        self._finish_shard()
+        self.shard += 1
+        self.offset = 0
+        self.fout = open(os.path.join(self.shard_dir, shard_name(self.shard)), "wb")
+
+    def add(self, doc_id: int, lang: str, text: str):
+        if self.documents is not None:
+            self.documents.append((doc_id, lang, text))
+            return
+        if not self.shard_dir:
+            return
+        if self.fout is None or self.offset >= self.shard_bytes:
+            self._next_shard()
+        encoded = text.encode("utf8")
+        self.fout.write(encoded)
+        self.fout.write(b"\n")
+        self.pending.append((doc_id, lang, self.shard, self.offset, self.offset + len(encoded)))
+        self.offset += len(encoded) + 1
+
+    def add_documents(self, documents: List[Tuple[int, str, str]]):
+        """adds documents drained from a buffered writer"""
+        for doc_id, lang, text in documents:
+            self.add(doc_id, lang, text)
+
+    def drain(self) -> List[Tuple[int, str, str]]:
+        documents, self.documents = self.documents, []
+        return documents or []
+
+    def close(self):
+        if self.index_file is not None:
+            self._finish_shard()
+            self.index_file.close()
+            self.index_file = None
+        self.shard_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def merge_shard_dirs(shard_dirs: List[str], target_dir: str, shard_bytes: int = SHARD_BYTES) -> int:
+    """
+    writes the documents of shard_dirs, in order, into one shard dir as if they had all been added to it in that
+    order, ie to put together the outputs of several machines. Returns the number of documents
+    """
+    num_docs = 0
+    with ShardWriter(target_dir, shard_bytes) as writer:
+        for shard_dir in shard_dirs:
+            with ShardReader(shard_dir) as reader:
+                for doc_id, lang, text in reader.iter_documents():
+                    writer.add(doc_id, lang, text)
+                num_docs += len(reader)
+    return num_docs
+
+
+class ShardReader(object):
+    """
+    Read side of ShardWriter. Documents are read with pread, and shard files opened under a lock, so one reader can
+    be shared between threads.
+    """
+
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        self.index: Dict[Tuple[int, str], Tuple[int, int, int]] = {}
+        with open(os.path.join(shard_dir, INDEX_NAME)) as fin:
+            if fin.readline() != INDEX_HEADER:
+                raise ValueError("{} isn't a shard index".format(os.path.join(shard_dir, INDEX_NAME)))
+            for line in fin:
+                doc_id, lang, shard, start, end = line.rstrip("\n").split("\t")
+                self.index[int(doc_id), lang] = (int(shard), int(start), int(end))
+        self.langs = sorted({lang for _, lang in self.index})
+        self.fds = {}
+        self.fds_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key: Tuple[int, str]) -> bool:
+        return key in self.index
+
+    def doc_ids(self, lang: str) -> List[int]:
+        return sorted(doc_id for doc_id, doc_lang in self.index if doc_lang == lang)
+
+    def _fd(self, shard: int) -> int:
+        fd = self.fds.get(shard)
+        if fd is None:
+            with self.fds_lock:
+                if shard not in self.fds:
+                    self.fds[shard] = os.open(os.path.join(self.shard_dir, shard_name(shard)), os.O_RDONLY)
+                fd = self.fds[shard]
+        return fd
+
+    def read_bytes(self, doc_id: int, lang: str) -> bytes:
+        shard, start, end = self.index[doc_id, lang]
+        return os.pread(self._fd(shard), end - start, start)
+
+    def read(self, doc_id: int, lang: str) -> str:
+        return self.read_bytes(doc_id, lang).decode("utf8")
+
+    def iter_documents(self, lang: Optional[str] = None) -> Iterator[Tuple[int, str, str]]:
+        """yields (doc_id, lang, text) for every document (of lang), in the order they are stored in the shards"""
+        entries = sorted((location, key) for key, location in self.index.items() if lang is None or key[1] == lang)
+        for (shard, start, end), (doc_id, doc_lang) in entries:
+            yield doc_id, doc_lang, os.pread(self._fd(shard), end - start, start).decode("utf8")
+
+    def close(self):
+        with self.fds_lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    with ShardReader(args.shard_dir) as reader:
+        if args.command == 'list':
+            for lang in reader.langs:
+                print("{}\t{}".format(lang, len(reader.doc_ids(lang))))
+        elif args.command == 'cat':
+            for doc_id in args.doc_ids:
+                if (doc_id, args.lang) not in reader:
+                    sys.exit("no {} document {} in {}".format(args.lang, doc_id, args.shard_dir))
+                print(reader.read(doc_id, args.lang))
+        else:
+            os.makedirs(args.target_dir, exist_ok=True)
+            for doc_id, lang, text in reader.iter_documents():
+                with open(os.path.join(args.target_dir, "{}_{}.txt".format(lang, doc_id)), "w") as fout:
+                    fout.write(text)
+            print("Exported {} documents to {}".format(len(reader), args.target_dir))
@@ -0,0 +1,136 @@
+import argparse
+import itertools
+import os
+import re
+import sys
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from utils.general_utils import read_func_words
+
+
+VOCAB_VERSION = 2  # 2: tokens keep internal . ' and -, entries tokenize() can't produce are dropped
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data")
+FOLDED_CSV = os.path.join(DATA_DIR, "multilingual_stopwords.csv")
+CASED_CSV = os.path.join(DATA_DIR, "multilingual_stopwords_cased.csv")
+# single letters too, plenty of function words are one letter, and internal . ' ’ or - is kept as the csvs have
+# words like 16.30, l'on and well-known
+TOKEN_PATTERN = re.compile(r"\w+(?:[.'’-]\w+)*")
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="compile a function word vocabulary to a binary artifact")
+    p.add_argument('-o', dest='out_path', required=True, help='.npz file to write the vocabulary to')
+    p.add_argument('--cased', action='store_true', help='match the cased csv exactly instead of case folding')
+    p.add_argument('--csv', help='csv to compile, defaults to the data/ csv for the casing')
+    p.add_argument('--langs', nargs='+', help='languages to include, defaults to all in the csv')
+    return p.parse_args()
+
+
+def tokenize(line: str) -> List[str]:
+    return TOKEN_PATTERN.findall(line)
+
+
+class FuncWordVocab(object):
+    """
+    Function words of a set of languages compiled to consecutive integer ids, looked up through a dict. Folded
+    vocabularies match tokens by str.casefold(), cased ones match exactly. token_langs[id, i] says whether the
+    word is a function word of langs[i], since the same word can be one in several languages. Entries that tokenize()
+    never gives as one token (punctuation, clitics like -ul written with their hyphen) could never be counted, so
+    they are left out when compiling.
+    """
+
+    def __init__(self, tokens: List[str], langs: List[str], token_langs: np.ndarray, casefold: bool):
+        self.tokens = tokens
+        self.langs = langs
+        self.token_langs = token_langs
+        self.casefold = casefold
+        self.token2id = {token: i for i, token in enumerate(tokens)}
+
+    def __len__(self):
+        return len(self.tokens)
+
+    @classmethod
+    def compile(cls, csv_path: str, casefold: bool, langs: Optional[Iterable[str]] = None) -> "FuncWordVocab":
+        lang2words = read_func_words(csv_path)
+        langs = sorted(langs) if langs is not None else sorted(lang2words)
+        missing = [lang for lang in langs if lang not in lang2words]
+        if missing:
+            raise ValueError("No function words for {} in {}".format(", ".join(missing), csv_path))
+
+        token2langs: Dict[str, set] = {}
+        dropped = set()
+        for i, lang in enumerate(langs):
+            for word in lang2words[lang]:
+                token = word.casefold() if casefold else word
+                if tokenize(token) != [token]:
+                    dropped.add(token)
+                    continue
+                token2langs.setdefault(token, set()).add(i)
+        if dropped:
+            print("Left out {} function words of {} that aren't single tokens, ie {}".format(
+                len(dropped), csv_path, ", ".join(map(repr, sorted(dropped)[:10]))), file=sys.stderr)
+        tokens = sorted(token2langs)
+        token_langs = np.zeros((len(tokens), len(langs)), dtype=bool)
+        for token_id, token in enumerate(tokens):
+            token_langs[token_id, list(token2langs[token])] = True
+        return cls(tokens, langs, token_langs, casefold)
+
+    def save(self, path: str):
+        """an uncompressed npz, with the tokens as one utf8 blob plus offsets so loading doesn't unpickle anything"""
+        encoded = [token.encode("utf8") for token in self.tokens]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in encoded], out=offsets[1:])
+        with open(path, "wb") as fout:
+            np.savez(fout, version=VOCAB_VERSION, blob=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                     offsets=offsets, langs=np.array(self.langs), token_langs=self.token_langs,
+                     casefold=self.casefold)
+
+    @classmethod
+    def load(cls, path: str) -> "FuncWordVocab":
+        with np.load(path) as saved:
+            if int(saved["version"]) != VOCAB_VERSION:
+                raise ValueError("{} is vocabulary version {}, expected {}".format(path, int(saved["version"]),
+                                                                                 VOCAB_VERSION))
+            blob, offsets = saved["blob"].tobytes(), saved["offsets"]
+            tokens = [blob[start:end].decode("utf8") for start, end in zip(offsets[:-1], offsets[1:])]
+            return cls(tokens, saved["langs"].tolist(), saved["token_langs"], bool(saved["casefold"]))
+
+    def transform(self, sentences: List[List[str]], folded: bool = False) -> csr_matrix:
+        """
+        a (sentences x vocabulary) csr matrix of function word counts for a batch of tokenized sentences. Pass
+        folded if a folded vocabulary's tokens were already case folded
+        """
+        if self.casefold and not folded:
+            sentences = [[token.casefold() for token in sentence] for sentence in sentences]
+        lengths = np.fromiter(map(len, sentences), dtype=np.int64, count=len(sentences))
+        # map over the flattened tokens keeps the dict lookups out of the interpreter loop
+        cols = np.fromiter(map(self.token2id.get, itertools.chain.from_iterable(sentences), itertools.repeat(-1)),
+                           dtype=np.int64, count=int(lengths.sum()))
+        rows = np.repeat(np.arange(len(sentences)), lengths)
+        found = cols >= 0
+        # duplicate (row, col) entries are summed, which is what makes them counts
+        matrix = csr_matrix((np.ones(int(found.sum()), dtype=np.float64), (rows[found], cols[found])),
+                            shape=(len(sentences), len(self.tokens)))
+        matrix.sum_duplicates()
+        return matrix
+
+    def transform_lines(self, lines: List[str]) -> csr_matrix:
+        """like transform, for raw lines. Folded vocabularies fold each line once rather than every token"""
+        if self.casefold:
+            return self.transform([tokenize(line.casefold()) for line in lines], folded=True)
+        return self.transform([tokenize(line) for line in lines])
+
+
+def default_csv(casefold: bool) -> str:
+    return FOLDED_CSV if casefold else CASED_CSV
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    vocab = FuncWordVocab.compile(args.csv or default_csv(not args.cased), not args.cased, args.langs)
+    vocab.save(args.out_path)
+    print("Compiled {} function words of {} languages to {}".format(len(vocab), len(vocab.langs), args.out_path))
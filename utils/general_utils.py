@@ -1,8 +1,14 @@
 import csv
-from typing import Tuple, List, Dict
+import functools
+import itertools
+import math
+import random
+from typing import Tuple, List, Dict, Iterable, Iterator
 
 from collections import defaultdict
 
+import yaml
+
 UD_LANGUAGES= ['cs', 'gl', 'pt', 'ro', 'ru', 'sv', 'ur', 'el', 'et', 'fi', 'he', 'hsb', 'lv', 'no',
               'tr', 'uk', 'bg', 'bxr', 'ca', 'da', 'de', 'en', 'es', 'eu', 'fa', 'fr', 'ga', 'hi',
               'hr', 'hu', 'id', 'it', 'ja', 'kk', 'kmr', 'ko', 'la', 'sk', 'sl', 'sme', 'sr', 'ta',
@@ -29,7 +35,14 @@ def get_language_list(filepath: str, threshold: int=10000, format="wikimatrix")
                 all_langs.append(lang_pair)
     return all_langs
 
-def read_func_words(csv_path:str) -> Dict[List]:
+def read_yaml_config(config_file: str) -> Dict:
+    """a yaml config as a dict, empty for an empty file. safe_load, so configs can't construct arbitrary objects"""
+    with open(config_file) as fin:
+        return yaml.safe_load(fin) or {}
+
+
+@functools.lru_cache(maxsize=None)
+def _read_func_words(csv_path: str) -> Dict[str, Tuple[str, ...]]:
     lang2tok = defaultdict(list)
     with open(csv_path, "r", newline="") as csvin:
         reader = csv.reader(csvin)
@@ -37,4 +50,58 @@ def read_func_words(csv_path:str) -> Dict[List]:
             if i == 0:
                 continue  # skip header
             lang2tok[line[1]].append(line[3])
-    return lang2tok
\ No newline at end of file
+    return {lang: tuple(toks) for lang, toks in lang2tok.items()}
+
+
+def read_func_words(csv_path:str) -> Dict[str, Tuple[str, ...]]:
+    """
+    language -> function words from one of the data/ csvs. The csv is only read once, and each call gets its own
+    dict of the (immutable) word tuples, so what a caller does with it can't change what the next one gets
+    """
+    return dict(_read_func_words(csv_path))
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """yields lists of up to size items from iterable, without reading further ahead than that"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+_END = object()  # end of iterator marker for reservoir_sample
+
+
+def _open_uniform(rng: random.Random) -> float:
+    """uniform in (0, 1), so its log is finite and log(1 - it) is too"""
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample(iterable: Iterable, k: int, rng: random.Random) -> List[Tuple[int, object]]:
+    """
+    a uniform sample of k items from an iterable of unknown length in one pass, as (index, item) pairs in index
+    order. Uses Li's algorithm L, which draws how many items to skip rather than a random number per item, so past
+    the first k items it mostly just advances the iterator.
+    """
+    iterator = iter(iterable)
+    reservoir = list(zip(range(k), iterator))
+    if len(reservoir) < k or k == 0:
+        return reservoir
+
+    index = k - 1
+    w = math.exp(math.log(_open_uniform(rng)) / k)
+    while True:
+        skip = math.floor(math.log(_open_uniform(rng)) / math.log(1 - w)) if w < 1 else 0
+        index += skip + 1
+        item = next(itertools.islice(iterator, skip, None), _END)
+        if item is _END:
+            break
+        reservoir[rng.randrange(k)] = (index, item)
+        w *= math.exp(math.log(_open_uniform(rng)) / k)
+    reservoir.sort(key=lambda pair: pair[0])
+    return reservoir
+
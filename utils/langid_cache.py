@@ -0,0 +1,113 @@
+import hashlib
+import os
+import sqlite3
+from collections import Counter, OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+
+MAX_MEMORY_ENTRIES = 1000000  # entries kept in the in-memory LRU in front of the on-disk cache
+SQLITE_MAX_VARS = 900  # keys per SELECT ... IN (...), under sqlite's default variable limit
+
+
+class LangIdCache(object):
+    """
+    Persistent cache of langid predictions keyed by a 64 bit hash of the normalized line, stored in sqlite so
+    that it survives between runs and can be shared by pool workers and by every language. Keys also include
+    the identifier's candidate set, since a restricted identifier can predict differently to the full one.
+    A bounded LRU sits in front of the database for the very frequent lines ("Yes.", "What?").
+    """
+
+    def __init__(self, path: str, max_memory_entries: int = MAX_MEMORY_ENTRIES):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.memory = OrderedDict()
+        self.stats = Counter()
+        self.db = sqlite3.connect(path, timeout=600)
+        # WAL lets several worker processes read while one of them writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS langid "
+                        "(key INTEGER PRIMARY KEY, lang TEXT NOT NULL, confidence REAL NOT NULL)")
+        self.db.commit()
+
+    @staticmethod
+    def make_key(text: str, tag: str) -> int:
+        digest = hashlib.blake2b("{}\t{}".format(tag, text).encode("utf8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)  # fits sqlite's signed 64 bit integers
+
+    def remember(self, key: int, prediction: Tuple[str, float]):
+        self.memory[key] = prediction
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def lookup_disk(self, keys: List[int]) -> Dict[int, Tuple[str, float]]:
+        found = {}
+        for start in range(0, len(keys), SQLITE_MAX_VARS):
+            batch = keys[start:start + SQLITE_MAX_VARS]
+            query = "SELECT key, lang, confidence FROM langid WHERE key IN ({})".format(",".join("?" * len(batch)))
+            for key, lang, confidence in self.db.execute(query, batch):
+                found[key] = (lang, confidence)
+        return found
+
+    def store_disk(self, items: Iterable[Tuple[int, Tuple[str, float]]]):
+        self.db.executemany("INSERT OR IGNORE INTO langid (key, lang, confidence) VALUES (?, ?, ?)",
+                            ((key, lang, confidence) for key, (lang, confidence) in items))
+        self.db.commit()
+
+    def classify_batch(self, texts: List[str], identifier) -> List[Tuple[str, float]]:
+        """like identifier.classify_batch, but only classifies the texts that aren't cached yet"""
+        keys = [self.make_key(text, identifier.cache_tag) for text in texts]
+        results = {}
+        for key in keys:
+            if key in results:
+                self.stats["memory_hits"] += 1  # a repeat within this batch
+            elif key in self.memory:
+                self.memory.move_to_end(key)
+                results[key] = self.memory[key]
+                self.stats["memory_hits"] += 1
+            else:
+                results[key] = None
+
+        missing = [key for key, prediction in results.items() if prediction is None]
+        from_disk = self.lookup_disk(missing) if missing else {}
+        self.stats["disk_hits"] += len(from_disk)
+        for key, prediction in from_disk.items():
+            results[key] = prediction
+            self.remember(key, prediction)
+
+        to_classify = {key: text for key, text in zip(keys, texts) if results[key] is None}
+        if to_classify:
+            self.stats["misses"] += len(to_classify)
+            new = list(zip(to_classify, identifier.classify_batch(list(to_classify.values()))))
+            self.store_disk(new)
+            for key, prediction in new:
+                results[key] = prediction
+                self.remember(key, prediction)
+
+        return [results[key] for key in keys]
+
+    def pop_stats(self) -> Counter:
+        """returns the stats gathered since the last call and resets them, for passing back from workers"""
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+
+_caches = {}
+
+
+def get_cache(path: str) -> LangIdCache:
+    """one cache (and sqlite connection) per path per process. Keyed by pid too, since connections can't cross a fork"""
+    key = (path, os.getpid())
+    if key not in _caches:
+        _caches[key] = LangIdCache(path)
+    return _caches[key]
+
+
+def format_cache_stats(stats: Counter) -> str:
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    if not lookups:
+        return "langid cache: no lookups"
+    return "langid cache: {} lookups, {:.2f}% hits ({:.2f}% memory, {:.2f}% disk), {} lines classified".format(
+        lookups, (stats["memory_hits"] + stats["disk_hits"]) / lookups * 100,
+        stats["memory_hits"] / lookups * 100, stats["disk_hits"] / lookups * 100, stats["misses"])
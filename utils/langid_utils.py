@@ -0,0 +1,138 @@
+import re
+import string
+from collections import Counter
+from typing import Iterable, Iterator, List, Optional, Set, Tuple
+
+import langid
+import numpy as np
+
+from utils.general_utils import chunked
+from utils.langid_cache import get_cache
+
+
+pct_stripper = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+
+# languages that langid tends to fall back on for short or noisy lines, roughly one per script for the
+# non latin ones. In restricted mode these are scored alongside the ok languages so that obviously wrong
+# lines still get cut.
+COMMON_CONFUSERS = {"en", "fr", "de", "es", "it", "pt", "nl", "la", "ru", "zh", "ja", "ar"}
+
+SCORE_BATCH_SIZE = 256  # rows of the dense feature matrix built at a time
+
+
+def normalize_line(line: str) -> str:
+    """strips punctuation and collapses spaces, which is what langid sees"""
+    return re.sub(r' +', ' ', line.strip().translate(pct_stripper))
+
+
+def langid_code(lang: str) -> str:
+    """maps our language codes onto langid's, ie zh_cn which isnt in langid becomes zh"""
+    return lang.split("_")[0]
+
+
+def restricted_candidates(ok_langs: Iterable[str], confusers: Optional[Iterable[str]] = None) -> Set[str]:
+    """the candidate set for restricted mode: the acceptable languages plus the usual confusers"""
+    if confusers is None:
+        confusers = COMMON_CONFUSERS
+    return {langid_code(lang) for lang in ok_langs} | set(confusers)
+
+
+class BatchLangIdentifier(object):
+    """
+    Scores many sentences per call against langid's naive bayes model, using a feature matrix per batch
+    instead of one np.dot per sentence. With candidate_langs=None every language in the model is scored and
+    predictions are the same as langid.classify. With a candidate set only those columns of the model are kept,
+    which is much cheaper but means a sentence can only ever be assigned to one of the candidates.
+    """
+
+    def __init__(self, candidate_langs: Optional[Iterable[str]] = None):
+        if langid.langid.identifier is None:
+            langid.langid.load_model()
+        model = langid.langid.identifier
+
+        self.tk_nextmove = model.tk_nextmove
+        self.tk_output = model.tk_output
+        self.num_feats = model.nb_numfeats
+
+        classes, nb_ptc, nb_pc = list(model.nb_classes), model.nb_ptc, model.nb_pc
+        if candidate_langs is not None:
+            candidate_langs = set(candidate_langs)
+            unknown = candidate_langs - set(classes)
+            if unknown:
+                raise ValueError("Unknown language code(s) for langid: {}".format(sorted(unknown)))
+            mask = np.fromiter((c in candidate_langs for c in classes), dtype=bool)
+            classes = [c for c in classes if c in candidate_langs]
+            nb_ptc, nb_pc = nb_ptc[:, mask], nb_pc[mask]
+
+        self.classes = classes
+        # predictions depend on the candidate set, so cached predictions are keyed by it too
+        self.cache_tag = "full" if candidate_langs is None else ",".join(sorted(classes))
+        self.nb_ptc = np.ascontiguousarray(nb_ptc)
+        self.nb_pc = nb_pc
+
+    def instance2features(self, text: str) -> Counter:
+        """feature index -> count for one sentence, the same features as langid's instance2fv"""
+        nextmove, output = self.tk_nextmove, self.tk_output
+        state = 0
+        statecount = Counter()
+        for letter in text.encode("utf8"):
+            state = nextmove[(state << 8) + letter]
+            statecount[state] += 1
+
+        features = Counter()
+        for state, count in statecount.items():
+            for index in output.get(state, ()):
+                features[index] += count
+        return features
+
+    def classify_batch(self, texts: List[str]) -> List[Tuple[str, float]]:
+        """(predicted_lang, confidence) for each text, in order. Texts should already be normalized"""
+        predictions = []
+        for start in range(0, len(texts), SCORE_BATCH_SIZE):
+            batch = texts[start:start + SCORE_BATCH_SIZE]
+            fv = np.zeros((len(batch), self.num_feats), dtype=np.float64)
+            for row, text in enumerate(batch):
+                features = self.instance2features(text)
+                if features:
+                    fv[row, list(features.keys())] = list(features.values())
+            scores = fv @ self.nb_ptc + self.nb_pc
+            best = scores.argmax(axis=1)
+            predictions.extend((self.classes[cl], float(scores[row, cl])) for row, cl in enumerate(best))
+        return predictions
+
+    def classify(self, text: str) -> Tuple[str, float]:
+        return self.classify_batch([text])[0]
+
+
+_identifiers = {}
+
+
+def get_identifier(candidate_langs: Optional[Iterable[str]] = None) -> BatchLangIdentifier:
+    """one identifier per candidate set per process, so pool workers build theirs once"""
+    key = frozenset(candidate_langs) if candidate_langs is not None else None
+    if key not in _identifiers:
+        _identifiers[key] = BatchLangIdentifier(key)
+    return _identifiers[key]
+
+
+def classify_texts(texts: List[str], candidate_langs: Optional[Iterable[str]] = None,
+                   cache_path: Optional[str] = None) -> List[Tuple[str, float]]:
+    """classifies already normalized texts in one batch, going through the langid cache if one is given"""
+    identifier = get_identifier(candidate_langs)
+    if cache_path is None:
+        return identifier.classify_batch(texts)
+    return get_cache(cache_path).classify_batch(texts, identifier)
+
+
+def classify_chunk(lines: List[str], candidate_langs: Optional[Iterable[str]] = None,
+                   cache_path: Optional[str] = None) -> List[Tuple[str, float]]:
+    """normalizes and classifies a list of raw lines in one batch, returning (predicted_lang, confidence) per line"""
+    return classify_texts([normalize_line(line) for line in lines], candidate_langs, cache_path)
+
+
+def iter_classify(lines: Iterable[str], chunk_size: int = 2000, candidate_langs: Optional[Iterable[str]] = None,
+                  cache_path: Optional[str] = None) -> Iterator[Tuple[str, str, float]]:
+    """yields (line, predicted_lang, confidence) for every line in order, scoring chunk_size lines at a time"""
+    for chunk in chunked(lines, chunk_size):
+        for line, (predict_lang, confidence) in zip(chunk, classify_chunk(chunk, candidate_langs, cache_path)):
+            yield line, predict_lang, confidence
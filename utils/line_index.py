@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import sys
+from typing import Iterable, Iterator, List
+
+import numpy as np
+
+from utils.corpus_io import compression_ext
+
+
+INDEX_VERSION = 2  # 2: lines end at \r and \r\n as well as \n
+READ_BLOCK_BYTES = 1 << 24  # bytes scanned for line ends at a time while building
+NEWLINE, CR = ord("\n"), ord("\r")
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="build line offset indices and fetch lines from text files through them")
+    sub = p.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='build (or refresh) the index of each file')
+    build.add_argument('files', nargs='+')
+    get = sub.add_parser('get', help='print the given lines of one file, or tab separated across parallel files')
+    get.add_argument('files', nargs='+')
+    get.add_argument('-n', dest='lines', nargs='+', type=int, required=True, help='0 based line numbers')
+    return p.parse_args()
+
+
+def index_paths(filepath: str):
+    """the offsets array and metadata sidecars of filepath"""
+    return filepath + ".lidx.npy", filepath + ".lidx.json"
+
+
+def is_index_file(filename: str) -> bool:
+    """whether filename is one of our sidecars, so directory listings of data can skip them"""
+    return filename.endswith(".lidx.npy") or filename.endswith(".lidx.json")
+
+
+def file_signature(filepath: str) -> dict:
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def iter_line_ends(filepath: str) -> Iterator[np.ndarray]:
+    """
+    yields arrays of the offset just past every line end of filepath, a block at a time. Line ends are what text
+    mode (universal newlines) splits on, \\n, \\r\\n or a lone \\r, so line numbers agree with reading the file as
+    text, as clean_data does and line indices are
+    """
+    position = 0
+    with open(filepath, "rb") as fin:
+        while True:
+            block = fin.read(READ_BLOCK_BYTES)
+            if not block:
+                break
+            while block.endswith(b"\r"):  # so a \r\n is never split between blocks
+                extra = fin.read(1)
+                if not extra:
+                    break
+                block += extra
+            data = np.frombuffer(block, dtype=np.uint8)
+            crs = np.flatnonzero(data == CR)
+            followed = crs + 1 < len(data)
+            followed[followed] = data[crs[followed] + 1] == NEWLINE
+            ends = np.sort(np.concatenate([np.flatnonzero(data == NEWLINE), crs[~followed]]))
+            yield ends.astype(np.int64) + position + 1
+            position += len(block)
+
+
+def build_offsets(filepath: str) -> np.ndarray:
+    """
+    byte offset of the start of every line plus one past the end of the file, so line i is
+    offsets[i]:offsets[i + 1] and there are len(offsets) - 1 lines. Lines end as in iter_line_ends, and a last line
+    without a line end still counts.
+    """
+    offsets = np.concatenate([np.zeros(1, dtype=np.int64)] + list(iter_line_ends(filepath)))
+    size = os.path.getsize(filepath)
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+    return offsets
+
+
+def write_line_index(filepath: str, offsets: np.ndarray, signature: dict):
+    offsets_path, meta_path = index_paths(filepath)
+    np.save(offsets_path, offsets)
+    # written last, so a half written index isn't picked up
+    with open(meta_path, "w") as fout:
+        json.dump(dict(signature, version=INDEX_VERSION, num_lines=len(offsets) - 1), fout)
+
+
+def load_fresh_offsets(filepath: str):
+    """the saved offsets of filepath, or None if there aren't any or filepath changed since they were built"""
+    offsets_path, meta_path = index_paths(filepath)
+    try:
+        with open(meta_path) as fin:
+            meta = json.load(fin)
+    except (OSError, ValueError):
+        return None
+    if meta.get("version") != INDEX_VERSION or \
+            {key: meta.get(key) for key in ("size", "mtime_ns")} != file_signature(filepath):
+        return None
+    return np.load(offsets_path, mmap_mode="r")
+
+
+class LineIndex(object):
+    """
+    Random access to the lines of a text file through the byte offset of every line. Fetching lines costs a seek
+    and a read per line requested, however big the file is. Lines are returned as str without their line end
+    (\n, \r\n or \r), as iterating over the file in text mode would split them.
+    """
+
+    def __init__(self, filepath: str, offsets: np.ndarray):
+        self.filepath = filepath
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get_lines(self, line_numbers: Iterable[int]) -> List[str]:
+        """the given lines in the order asked for. They are read in file order, so sorted requests read forwards"""
+        line_numbers = list(line_numbers)
+        lines = {}
+        with open(self.filepath, "rb") as fin:
+            for i in sorted(set(line_numbers)):
+                if not 0 <= i < len(self):
+                    raise IndexError("line {} out of range for {} ({} lines)".format(i, self.filepath, len(self)))
+                fin.seek(self.offsets[i])
+                lines[i] = fin.read(self.offsets[i + 1] - self.offsets[i]).decode("utf8").rstrip("\r\n")
+        return [lines[i] for i in line_numbers]
+
+    def iter_range(self, start: int, end: int) -> Iterator[str]:
+        """yields lines start up to end, reading from the start line's offset without scanning what comes before"""
+        with open(self.filepath, "rb") as fin:
+            fin.seek(self.offsets[start])
+            for i in range(start, min(end, len(self))):
+                yield fin.read(self.offsets[i + 1] - self.offsets[i]).decode("utf8").rstrip("\r\n")
+
+
+def get_line_index(filepath: str, save: bool = True) -> LineIndex:
+    """
+    the index of filepath, loaded from its sidecar if that is up to date and otherwise built in one pass and (if
+    save and the directory is writable) saved next to the file for next time
+    """
+    if compression_ext(filepath):
+        raise ValueError("line indices need uncompressed files, {} is compressed".format(filepath))
+    offsets = load_fresh_offsets(filepath)
+    if offsets is None:
+        signature = file_signature(filepath)
+        offsets = build_offsets(filepath)
+        if save:
+            try:
+                write_line_index(filepath, offsets, signature)
+            except OSError as e:
+                print("Couldn't save the line index of {}: {}".format(filepath, e), file=sys.stderr)
+    return LineIndex(filepath, offsets)
+
+
+def check_aligned(filepaths: List[str]) -> List[LineIndex]:
+    """indices of parallel files, raising ValueError if they don't all have the same number of lines"""
+    indices = [get_line_index(filepath) for filepath in filepaths]
+    if len({len(index) for index in indices}) > 1:
+        raise ValueError("files aren't aligned, they have different numbers of lines: {}".format(
+            ", ".join("{} ({})".format(index.filepath, len(index)) for index in indices)))
+    return indices
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    if args.command == "build":
+        for filepath in args.files:
+            print("{}\t{}".format(filepath, len(get_line_index(filepath))))
+    else:
+        indices = check_aligned(args.files)
+        columns = [index.get_lines(args.lines) for index in indices]
+        for lines in zip(*columns):
+            print("\t".join(lines))
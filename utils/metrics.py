@@ -0,0 +1,108 @@
+import gzip
+import json
+import os
+import time
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+REJECTION_LOG_COMPRESSLEVEL = 3  # gzip level for rejection logs, they're written while cleaning so speed matters
+
+
+class Metrics(Counter):
+    """
+    Counters (lines_read, kept, cut, cache hits, ...) plus seconds_{name} timers for a stage, all in one Counter so
+    metrics gathered on pool workers merge into the main process's with update()
+    """
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self["seconds_" + name] += time.perf_counter() - start
+
+    def summary(self, **fields) -> dict:
+        """a json friendly dict of the metrics plus any extra fields, ie which file they are for"""
+        summary = dict(fields)
+        summary.update((name, round(value, 3) if isinstance(value, float) else value)
+                       for name, value in sorted(self.items()))
+        return summary
+
+
+def is_metrics_file(path: str) -> bool:
+    """whether path is a summary written by write_summary, so directory listings of data can skip them"""
+    name = os.path.basename(path)
+    return name == "metrics.json" or name.endswith(".metrics.json")
+
+
+def write_summary(path: str, metrics: Metrics, **fields):
+    with open(path, "w") as fout:
+        json.dump(metrics.summary(**fields), fout, indent=1)
+        fout.write("\n")
+
+
+def finish_metrics(metrics: Metrics, seconds_total: float, out_path: str, **fields):
+    """
+    fills in the write time and writes the metrics summary next to the outputs. Reading and classifying are timed
+    inside utils.script_filter.classify_lines, so whatever else the loop over its output took was spent writing
+    """
+    metrics["seconds_total"] = seconds_total
+    metrics["seconds_write"] = max(seconds_total - metrics["seconds_read"] - metrics["seconds_classify"], 0)
+    write_summary(out_path + ".metrics.json", metrics, **fields)
+
+
+class RejectionLog(object):
+    """
+    Rejected lines as gzip'd json lines, one {"source", "line", ...} record each, with only sample_rate of them
+    kept. Whether a line is sampled depends only on its (source, line), so the same lines are logged whatever the
+    number of workers or order of processing. Without a path nothing is written, unless buffer is set, in which case
+    records are kept for drain() (ie to send back from a pool worker to the process that owns the file).
+    """
+
+    def __init__(self, path: Optional[str] = None, sample_rate: float = 1.0, buffer: bool = False):
+        self.sample_rate = sample_rate
+        self.fout = gzip.open(path, "wt", encoding="utf8", compresslevel=REJECTION_LOG_COMPRESSLEVEL) \
+            if path else None
+        self.records = [] if buffer else None
+
+    @property
+    def enabled(self) -> bool:
+        return self.fout is not None or self.records is not None
+
+    def sampled(self, source: str, line: int) -> bool:
+        if self.sample_rate >= 1:
+            return True
+        return zlib.crc32("{}\t{}".format(source, line).encode("utf8")) < self.sample_rate * 2 ** 32
+
+    def log(self, source: str, line: int, **fields):
+        if not self.enabled or not self.sampled(source, line):
+            return
+        record = dict(source=source, line=line, **fields)
+        if self.records is not None:
+            self.records.append(record)
+        else:
+            self.fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_records(self, records: List[dict]):
+        """writes records drained from a buffered log, which were already sampled"""
+        if self.fout is not None:
+            self.fout.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    def drain(self) -> List[dict]:
+        records, self.records = self.records, []
+        return records or []
+
+    def close(self):
+        if self.fout is not None:
+            self.fout.close()
+            self.fout = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
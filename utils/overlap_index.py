@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import pickle
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+INDEX_VERSION = 1
+MISSING = -1  # value in a language column for english documents with no aligned document in that language
+ITER_BLOCK_ROWS = 1 << 16  # rows of the columns read at a time by iter_pairs
+
+OverlapPair = Tuple[int, str, Optional[str]]  # (position, en doc, lang doc), lang doc None if not aligned
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="convert and query OpenSubtitles overlap indices")
+    sub = p.add_subparsers(dest='command', required=True)
+    convert = sub.add_parser('convert', help='convert pickled *_file_ids to an index')
+    convert.add_argument('pickle_file')
+    convert.add_argument('index_dir', nargs='?', help='defaults to pickle_file + .idx')
+    query = sub.add_parser('query', help='count (or list) english documents aligned to all the given languages')
+    query.add_argument('index_dir')
+    query.add_argument('langs', nargs='+')
+    query.add_argument('--list', action='store_true', help='print the aligned documents too')
+    return p.parse_args()
+
+
+def write_overlap_index(overlaps: Dict[str, Dict[str, str]], index_dir: str):
+    """
+    writes the output of find_overlapping_files as a directory of numpy arrays:
+    every document path is interned once into strings.bin (with string_offsets.npy), and en.npy plus one
+    {lang}.npy column per language hold the string id of the document on each row (MISSING if there isn't one).
+    Rows keep the order of overlaps, so row numbers are the same as enumerate(overlaps.keys()).
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    langs = sorted({lang for targets in overlaps.values() for lang in targets})
+    num_docs = len(overlaps)
+
+    string_ids, blobs, offsets = {}, [], [0]
+
+    def intern(doc: str) -> int:
+        if doc not in string_ids:
+            encoded = doc.encode("utf8")
+            string_ids[doc] = len(blobs)
+            blobs.append(encoded)
+            offsets.append(offsets[-1] + len(encoded))
+        return string_ids[doc]
+
+    en_column = np.empty(num_docs, dtype=np.int32)
+    columns = {lang: np.full(num_docs, MISSING, dtype=np.int32) for lang in langs}
+    for row, (en_doc, targets) in enumerate(overlaps.items()):
+        en_column[row] = intern(en_doc)
+        for lang, doc in targets.items():
+            columns[lang][row] = intern(doc)
+
+    with open(os.path.join(index_dir, "strings.bin"), "wb") as fout:
+        for blob in blobs:
+            fout.write(blob)
+    np.save(os.path.join(index_dir, "string_offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(index_dir, "en.npy"), en_column)
+    for lang, column in columns.items():
+        np.save(os.path.join(index_dir, "{}.npy".format(lang)), column)
+    # written last, so a half written index isn't picked up
+    with open(os.path.join(index_dir, "meta.json"), "w") as fout:
+        json.dump({"version": INDEX_VERSION, "langs": langs, "num_docs": num_docs}, fout)
+
+
+class OverlapIndex(object):
+    """
+    Read side of write_overlap_index. Everything is memory mapped and columns are only opened when a query needs
+    them, so opening an index is instant and a query only touches the languages it asks about.
+    """
+
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json")) as fin:
+            meta = json.load(fin)
+        if meta["version"] != INDEX_VERSION:
+            raise ValueError("{} is index version {}, expected {}".format(index_dir, meta["version"], INDEX_VERSION))
+        self.langs = meta["langs"]
+        self.num_docs = meta["num_docs"]
+        self.offsets = np.load(os.path.join(index_dir, "string_offsets.npy"), mmap_mode="r")
+        self.strings = np.memmap(os.path.join(index_dir, "strings.bin"), dtype=np.uint8, mode="r") \
+            if self.offsets[-1] else np.zeros(0, dtype=np.uint8)  # numpy can't map an empty file
+        self.columns = {}
+
+    def __len__(self):
+        return self.num_docs
+
+    def column(self, lang: str) -> np.ndarray:
+        if lang not in self.columns:
+            if lang != "en" and lang not in self.langs:
+                raise KeyError("no column for {} in {}".format(lang, self.index_dir))
+            self.columns[lang] = np.load(os.path.join(self.index_dir, "{}.npy".format(lang)), mmap_mode="r")
+        return self.columns[lang]
+
+    def doc(self, string_id: int) -> str:
+        return bytes(self.strings[self.offsets[string_id]:self.offsets[string_id + 1]]).decode("utf8")
+
+    def aligned_rows(self, langs: Iterable[str]) -> np.ndarray:
+        """rows whose english document has an aligned document in every one of langs"""
+        mask = np.ones(self.num_docs, dtype=bool)
+        for lang in langs:
+            if lang != "en":
+                mask &= self.column(lang) != MISSING
+        return np.flatnonzero(mask)
+
+    def aligned_docs(self, langs: List[str]) -> Iterator[Tuple[str, Dict[str, str]]]:
+        """yields (en doc, {lang: doc}) for the english documents aligned across all of langs"""
+        en_column = self.column("en")
+        columns = [(lang, self.column(lang)) for lang in langs if lang != "en"]
+        for row in self.aligned_rows(langs):
+            yield self.doc(en_column[row]), {lang: self.doc(column[row]) for lang, column in columns}
+
+    def iter_pairs(self, lang: str, start: int = 0, end: Optional[int] = None) -> Iterator[OverlapPair]:
+        """
+        yields (row, en doc, lang doc) for rows start to end, which are positions in the dict the index was written
+        from. Rows without a lang document give (row, en doc, None). Columns are read
+        ITER_BLOCK_ROWS at a time, so memory doesn't grow with the number of documents
+        """
+        en_column, column = self.column("en"), self.column(lang)
+        end = self.num_docs if end is None else min(end, self.num_docs)
+        for block_start in range(start, end, ITER_BLOCK_ROWS):
+            block_end = min(block_start + ITER_BLOCK_ROWS, end)
+            en_ids, other_ids = en_column[block_start:block_end].tolist(), column[block_start:block_end].tolist()
+            for row, en_id, other_id in zip(range(block_start, block_end), en_ids, other_ids):
+                yield row, self.doc(en_id), self.doc(other_id) if other_id != MISSING else None
+
+
+def index_path(file_ids_path: str) -> str:
+    return file_ids_path + ".idx"
+
+
+def load_overlaps(file_ids_path: str, lang: str) -> Union[OverlapIndex, Dict[str, Dict[str, str]]]:
+    """
+    the overlaps for lang: the index next to file_ids_path if there is one, without reading it, otherwise the dict
+    unpickled from file_ids_path. Either goes to iter_overlap_pairs
+    """
+    if os.path.isfile(os.path.join(index_path(file_ids_path), "meta.json")):
+        index = OverlapIndex(index_path(file_ids_path))
+        index.column(lang)  # so a language the index doesn't have fails here
+        return index
+    with open(file_ids_path, 'rb') as fin:
+        return pickle.load(fin)
+
+
+def iter_overlap_pairs(overlaps: Union[OverlapIndex, Dict[str, Dict[str, str]]], lang: str) -> Iterator[OverlapPair]:
+    """
+    (position, en doc, lang doc) for the english documents of an OverlapIndex or of a {en doc: {lang: doc}} dict
+    (from find_overlapping_files or a pickle), as OverlapIndex.iter_pairs
+    """
+    if isinstance(overlaps, OverlapIndex):
+        yield from overlaps.iter_pairs(lang)
+        return
+    for row, (en_doc, targets) in enumerate(overlaps.items()):
+        yield row, en_doc, targets.get(lang)
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    if args.command == "convert":
+        with open(args.pickle_file, 'rb') as fin:
+            overlaps = pickle.load(fin)
+        out_dir = args.index_dir or index_path(args.pickle_file)
+        write_overlap_index(overlaps, out_dir)
+        print("Wrote {} english documents to {}".format(len(overlaps), out_dir))
+    else:
+        index = OverlapIndex(args.index_dir)
+        rows = index.aligned_rows(args.langs)
+        print("{} of {} english documents are aligned to all of {}".format(len(rows), len(index),
+                                                                           ", ".join(args.langs)), file=sys.stderr)
+        if args.list:
+            for en_doc, docs in index.aligned_docs(args.langs):
+                print("\t".join([en_doc] + [docs[lang] for lang in args.langs if lang != "en"]))
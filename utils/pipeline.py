@@ -0,0 +1,140 @@
+import inspect
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from utils.metrics import Metrics
+
+
+QUEUE_SIZE = 64  # items buffered between two stages
+POLL_SECONDS = 0.1  # how often a stage blocked on a queue checks whether the pipeline was stopped
+_END = object()  # end of stream marker
+# stages run on threads, and a process forked while another thread holds a lock (a queue's, the langid cache's) can
+# deadlock on it, so stages that start process pools start them from this
+POOL_CONTEXT = multiprocessing.get_context("spawn")
+
+
+class PipelineStopped(Exception):
+    """raised in a stage's thread when another stage failed, so it stops too"""
+
+
+class BoundedQueue(object):
+    """
+    A queue.Queue of at most maxsize items between two stages, so a fast stage blocks instead of getting ahead of a
+    slow one, with the seconds each side spent blocked added to its metrics. Puts and gets give up with
+    PipelineStopped once stop is set
+    """
+
+    def __init__(self, maxsize: int, stop: threading.Event):
+        self.queue = queue.Queue(maxsize)
+        self.stop = stop
+
+    def put(self, item, metrics: Metrics):
+        with metrics.timer("wait_output"):
+            while True:
+                if self.stop.is_set():
+                    raise PipelineStopped()
+                try:
+                    self.queue.put(item, timeout=POLL_SECONDS)
+                    return
+                except queue.Full:
+                    pass
+
+    def iter_items(self, metrics: Metrics) -> Iterator:
+        while True:
+            with metrics.timer("wait_input"):
+                while True:
+                    if self.stop.is_set():
+                        raise PipelineStopped()
+                    try:
+                        item = self.queue.get(timeout=POLL_SECONDS)
+                        break
+                    except queue.Empty:
+                        pass
+            if item is _END:
+                return
+            yield item
+
+
+class Stage(object):
+    """
+    One step of a pipeline: func(items, metrics, **params) is a generator that takes the items of the stage before
+    (None for the first stage) and yields its own. sink, if given, is called with every item the stage yields, ie
+    to write it to disk, and sink.close() at the end. Items and lines (by lines(item), if given) in and out are
+    counted in the stage's metrics, along with its seconds busy and blocked on either queue
+    """
+
+    def __init__(self, name: str, func: Callable, params: Optional[dict] = None, sink=None,
+                 lines: Optional[Callable] = None):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.sink = sink
+        self.lines = lines
+        self.metrics = Metrics()
+        # catches misspelled settings before anything runs
+        try:
+            inspect.signature(func).bind(None, None, **self.params)
+        except TypeError as e:
+            raise ValueError("bad settings for stage {}: {}".format(name, e))
+
+    def counted(self, items: Iterable, direction: str) -> Iterator:
+        for item in items:
+            self.metrics["items_" + direction] += 1
+            if self.lines is not None:
+                self.metrics["lines_" + direction] += self.lines(item)
+            yield item
+
+    def run(self, inputs: Optional[BoundedQueue], output: Optional[BoundedQueue]):
+        start_time = time.perf_counter()
+        try:
+            items = self.counted(inputs.iter_items(self.metrics), "in") if inputs is not None else None
+            for item in self.counted(self.func(items, self.metrics, **self.params), "out"):
+                if self.sink is not None:
+                    with self.metrics.timer("materialize"):
+                        self.sink(item)
+                if output is not None:
+                    output.put(item, self.metrics)
+            if output is not None:
+                output.put(_END, self.metrics)
+        finally:
+            if self.sink is not None:
+                self.sink.close()
+            self.metrics["seconds_total"] = time.perf_counter() - start_time
+            self.metrics["seconds_busy"] = max(self.metrics["seconds_total"] - self.metrics["seconds_wait_input"] -
+                                               self.metrics["seconds_wait_output"], 0)
+
+
+def run_pipeline(stages: List[Stage], queue_size: int = QUEUE_SIZE):
+    """
+    runs every stage on a thread of its own, with a BoundedQueue between each and the next, so items stream through
+    without the whole of any stage's output being held (or written) anywhere. The first stage that fails stops the
+    others and its exception is raised once they have
+    """
+    stop = threading.Event()
+    queues = [BoundedQueue(queue_size, stop) for _ in stages[1:]]
+    errors = []
+
+    def run_stage(k: int):
+        try:
+            stages[k].run(queues[k - 1] if k > 0 else None, queues[k] if k < len(queues) else None)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=run_stage, args=(k,), name=stage.name, daemon=True)
+               for k, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop.set()
+        raise
+    if errors:
+        raise errors[0]
@@ -0,0 +1,132 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Iterable, Optional, Tuple
+
+
+HASH_BLOCK_BYTES = 1 << 24  # bytes hashed at a time when fingerprinting a file
+
+
+def setup_argparse():
+    p = argparse.ArgumentParser(description="summarize a run manifest")
+    p.add_argument('manifest')
+    p.add_argument('--units', action='store_true', help='list every unit with its status and outputs')
+    return p.parse_args()
+
+
+def params_key(params: dict) -> str:
+    """parameters as canonical json, so the same parameters always compare equal"""
+    return json.dumps(params, sort_keys=True, default=sorted)
+
+
+class RunManifest(object):
+    """
+    Records which units of work (an input file, a bitext, a document pair) a run has finished, with a fingerprint
+    of their content, the parameters they were processed with and the outputs they produced, so that a rerun can
+    skip whatever is already up to date. Long units can also save checkpoints to resume from.
+    Stored in sqlite like the langid cache. Records are committed in batches (see commit), so a crash loses at most
+    the units since the last commit, which are then redone.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=600)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, fingerprint TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS units (unit TEXT PRIMARY KEY, fingerprint TEXT, params TEXT, "
+                        "status TEXT, outputs TEXT, updated REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints (unit TEXT PRIMARY KEY, fingerprint TEXT, params TEXT, "
+                        "position INTEGER, state TEXT)")
+        self.db.commit()
+
+    def fingerprint(self, path: str) -> str:
+        """
+        blake2b of a file's contents. Hashes are kept with the file's size and mtime, so unchanged files are only
+        hashed once, while a file that was rewritten with the same contents still counts as up to date
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute("SELECT size, mtime_ns, fingerprint FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as fin:
+            while True:
+                block = fin.read(HASH_BLOCK_BYTES)
+                if not block:
+                    break
+                digest.update(block)
+        fingerprint = digest.hexdigest()
+        self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, fingerprint) VALUES (?, ?, ?, ?)",
+                        (path, stat.st_size, stat.st_mtime_ns, fingerprint))
+        self.db.commit()
+        return fingerprint
+
+    def fingerprints(self, paths: Iterable[str]) -> str:
+        return ",".join(self.fingerprint(path) for path in paths)
+
+    def lookup(self, unit: str, fingerprint: str, params: dict) -> Optional[Tuple[str, list]]:
+        """(status, outputs) if unit was done with this fingerprint and params and its outputs are all still there"""
+        row = self.db.execute("SELECT status, outputs FROM units WHERE unit = ? AND fingerprint = ? AND params = ?",
+                              (unit, fingerprint, params_key(params))).fetchone()
+        if row is None:
+            return None
+        outputs = json.loads(row[1])
+        if not all(os.path.exists(output) for output in outputs):
+            return None
+        return row[0], outputs
+
+    def record(self, unit: str, fingerprint: str, params: dict, status: str = "done", outputs: Iterable[str] = (),
+               commit: bool = True):
+        self.db.execute("INSERT OR REPLACE INTO units (unit, fingerprint, params, status, outputs, updated) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (unit, fingerprint, params_key(params), status,
+                                                      json.dumps(list(outputs)), time.time()))
+        if commit:
+            self.commit()
+
+    def save_checkpoint(self, unit: str, fingerprint: str, params: dict, position: int, state: dict):
+        """position is how far into the unit (ie lines) it got, state whatever else resuming needs"""
+        self.db.execute("INSERT OR REPLACE INTO checkpoints (unit, fingerprint, params, position, state) "
+                        "VALUES (?, ?, ?, ?, ?)", (unit, fingerprint, params_key(params), position, json.dumps(state)))
+        self.commit()
+
+    def load_checkpoint(self, unit: str, fingerprint: str, params: dict) -> Optional[Tuple[int, dict]]:
+        """the last checkpoint of unit, if it was for the same fingerprint and params"""
+        row = self.db.execute("SELECT position, state FROM checkpoints WHERE unit = ? AND fingerprint = ? "
+                              "AND params = ?", (unit, fingerprint, params_key(params))).fetchone()
+        return (row[0], json.loads(row[1])) if row is not None else None
+
+    def clear_checkpoint(self, unit: str):
+        self.db.execute("DELETE FROM checkpoints WHERE unit = ?", (unit,))
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    args = setup_argparse()
+
+    with RunManifest(args.manifest) as manifest:
+        for status, count in manifest.db.execute("SELECT status, COUNT(*) FROM units GROUP BY status ORDER BY status"):
+            print("{}\t{}".format(status, count))
+        for unit, position in manifest.db.execute("SELECT unit, position FROM checkpoints ORDER BY unit"):
+            print("checkpoint\t{}\t{}".format(unit, position))
+        if args.units:
+            for row in manifest.db.execute("SELECT unit, status, outputs FROM units ORDER BY unit"):
+                print("\t".join(row))
@@ -0,0 +1,254 @@
+import functools
+import itertools
+import zlib
+from collections import deque
+from multiprocessing import Pool
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from utils.general_utils import chunked
+from utils.langid_cache import get_cache
+from utils.langid_utils import classify_chunk
+from utils.metrics import Metrics
+
+
+MIN_LETTERS = 3  # lines with fewer letters than this always go to langid
+ACCEPT_FRACTION = 0.9  # of a line's letters that must be in scripts only the ok languages use, to accept it
+REJECT_FRACTION = 0.1  # of a line's letters in the ok languages' scripts at or under which it is rejected
+
+ACCEPT, PASS, REJECT = 1, 0, -1
+
+# ISO 15924 codes. Zyyy (common) is digits, punctuation, spaces, symbols and any script not listed here,
+# none of which count as letters
+SCRIPTS = ["Zyyy", "Latn", "Grek", "Cyrl", "Armn", "Hebr", "Arab", "Deva", "Beng", "Guru", "Gujr", "Orya", "Taml",
+           "Telu", "Knda", "Mlym", "Sinh", "Thai", "Laoo", "Tibt", "Geor", "Ethi", "Khmr", "Hang", "Kana", "Hani"]
+SCRIPT_RANGES = [  # (first code point, last code point, script)
+    (0x41, 0x5A, "Latn"), (0x61, 0x7A, "Latn"), (0xC0, 0xD6, "Latn"), (0xD8, 0xF6, "Latn"), (0xF8, 0x24F, "Latn"),
+    (0x370, 0x3FF, "Grek"), (0x400, 0x52F, "Cyrl"), (0x530, 0x58F, "Armn"), (0x590, 0x5FF, "Hebr"),
+    (0x600, 0x6FF, "Arab"), (0x750, 0x77F, "Arab"), (0x8A0, 0x8FF, "Arab"), (0x900, 0x97F, "Deva"),
+    (0x980, 0x9FF, "Beng"), (0xA00, 0xA7F, "Guru"), (0xA80, 0xAFF, "Gujr"), (0xB00, 0xB7F, "Orya"),
+    (0xB80, 0xBFF, "Taml"), (0xC00, 0xC7F, "Telu"), (0xC80, 0xCFF, "Knda"), (0xD00, 0xD7F, "Mlym"),
+    (0xD80, 0xDFF, "Sinh"), (0xE00, 0xE7F, "Thai"), (0xE80, 0xEFF, "Laoo"), (0xF00, 0xFFF, "Tibt"),
+    (0x10A0, 0x10FF, "Geor"), (0x1100, 0x11FF, "Hang"), (0x1200, 0x139F, "Ethi"), (0x1780, 0x17FF, "Khmr"),
+    (0x1C80, 0x1C8F, "Cyrl"), (0x1E00, 0x1EFF, "Latn"), (0x1F00, 0x1FFF, "Grek"), (0x2C60, 0x2C7F, "Latn"),
+    (0x2DE0, 0x2DFF, "Cyrl"), (0x2E80, 0x2FDF, "Hani"), (0x3005, 0x3007, "Hani"), (0x3040, 0x30FF, "Kana"),
+    (0x3130, 0x318F, "Hang"), (0x31F0, 0x31FF, "Kana"), (0x3400, 0x4DBF, "Hani"), (0x4E00, 0x9FFF, "Hani"),
+    (0xA640, 0xA69F, "Cyrl"), (0xA720, 0xA7FF, "Latn"), (0xAC00, 0xD7AF, "Hang"), (0xF900, 0xFAFF, "Hani"),
+    (0xFB50, 0xFDFF, "Arab"), (0xFE70, 0xFEFF, "Arab"), (0xFF21, 0xFF3A, "Latn"), (0xFF41, 0xFF5A, "Latn"),
+    (0xFF66, 0xFF9F, "Kana"), (0x20000, 0x2FA1F, "Hani"),
+]
+# the scripts each of langid's languages is written in
+SCRIPT_LANGS = {
+    "Latn": "af an az br bs ca cs cy da de en eo es et eu fi fo fr ga gl hr ht hu id is it jv ku la lb lt lv mg ms "
+            "mt nb nl nn no oc pl pt qu ro rw se sk sl sq sr sv sw tl tr vi vo wa xh zu",
+    "Grek": "el", "Cyrl": "be bg kk ky mk mn ru sr uk", "Armn": "hy", "Hebr": "he", "Arab": "ar fa ku ps ug ur",
+    "Deva": "hi mr ne", "Beng": "as bn", "Guru": "pa", "Gujr": "gu", "Orya": "or", "Taml": "ta", "Telu": "te",
+    "Knda": "kn", "Mlym": "ml", "Sinh": "si", "Thai": "th", "Laoo": "lo", "Tibt": "dz", "Geor": "ka", "Ethi": "am",
+    "Khmr": "km", "Hang": "ko", "Kana": "ja", "Hani": "ja zh",
+}
+LANG_SCRIPTS = {lang: {script for script, langs in SCRIPT_LANGS.items() if lang in langs.split()}
+                for lang in set(" ".join(SCRIPT_LANGS.values()).split())}
+
+
+def _range_table() -> Tuple[np.ndarray, np.ndarray]:
+    """range starts and the script id from each start on, with Zyyy filling the gaps, for np.searchsorted"""
+    starts, script_ids = [0], [0]
+    for first, last, script in SCRIPT_RANGES:
+        if first != starts[-1]:
+            starts.append(first)
+            script_ids.append(SCRIPTS.index(script))
+        else:
+            script_ids[-1] = SCRIPTS.index(script)
+        starts.append(last + 1)
+        script_ids.append(0)
+    return np.array(starts, dtype=np.uint32), np.array(script_ids, dtype=np.int64)
+
+
+RANGE_STARTS, RANGE_SCRIPT_IDS = _range_table()
+
+
+def script_histograms(lines: List[str]) -> np.ndarray:
+    """a (lines x SCRIPTS) array of how many characters of each line are in each script, for a whole batch at once"""
+    lengths = np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+    code_points = np.frombuffer("".join(lines).encode("utf-32-le"), dtype=np.uint32)
+    script_ids = RANGE_SCRIPT_IDS[np.searchsorted(RANGE_STARTS, code_points, side="right") - 1]
+    line_ids = np.repeat(np.arange(len(lines)), lengths)
+    return np.bincount(line_ids * len(SCRIPTS) + script_ids,
+                       minlength=len(lines) * len(SCRIPTS)).reshape(len(lines), len(SCRIPTS))
+
+
+class ScriptPrefilter(object):
+    """
+    The first stage in front of langid. A line is rejected when (almost) none of its letters are in a script any of
+    the ok languages is written in, and accepted when (almost) all of them are in scripts that, of the languages
+    langid could predict (candidate_langs, or all of them), only the ok languages use. Everything else is passed on
+    to langid, so for latin script languages the prefilter only ever rejects. ok_langs is one set per line position,
+    cycling, so that the interleaved sides of a bitext can each have their own. Languages with no known script turn
+    the prefilter off for their lines.
+    audit is the fraction of decided lines (picked by their text) that langid also classifies, to see how often the
+    two agree.
+    """
+
+    def __init__(self, ok_langs: Sequence[Set[str]], candidate_langs: Optional[Iterable[str]] = None,
+                 audit: float = 0.0):
+        self.ok_langs = [set(langs) for langs in ok_langs]
+        self.audit = audit
+        candidates = set(candidate_langs) if candidate_langs is not None else set(LANG_SCRIPTS)
+        num_sides = len(self.ok_langs)
+        self.ok_scripts = np.zeros((num_sides, len(SCRIPTS)), dtype=bool)
+        self.settled_scripts = np.zeros((num_sides, len(SCRIPTS)), dtype=bool)
+        self.accept_labels = [{} for _ in range(num_sides)]
+        for side, langs in enumerate(self.ok_langs):
+            if any(lang not in LANG_SCRIPTS for lang in langs):
+                self.ok_scripts[side] = True  # nothing is rejected, or accepted, on this side
+                continue
+            for script in set.union(*(LANG_SCRIPTS[lang] for lang in langs)):
+                script_id = SCRIPTS.index(script)
+                self.ok_scripts[side, script_id] = True
+                script_candidates = set(SCRIPT_LANGS[script].split()) & candidates
+                if script_candidates and script_candidates <= langs:
+                    self.settled_scripts[side, script_id] = True
+                    self.accept_labels[side][script_id] = min(script_candidates)
+
+    def decide(self, lines: List[str]) -> Tuple[np.ndarray, List[Optional[str]]]:
+        """
+        ACCEPT, REJECT or PASS for each line, plus a label for the decided ones: the ok language an accepted line
+        must be, or the main script of a rejected one
+        """
+        histograms = script_histograms(lines)
+        sides = np.arange(len(lines)) % len(self.ok_langs)
+        letters = histograms[:, 1:].sum(axis=1)
+        ok = (histograms * self.ok_scripts[sides]).sum(axis=1)
+        settled = (histograms * self.settled_scripts[sides]).sum(axis=1)
+        enough = letters >= MIN_LETTERS
+        decisions = np.full(len(lines), PASS, dtype=np.int8)
+        decisions[enough & (ok <= REJECT_FRACTION * letters)] = REJECT
+        decisions[enough & (settled >= ACCEPT_FRACTION * letters)] = ACCEPT
+
+        main_scripts = histograms[:, 1:].argmax(axis=1) + 1
+        settled_main = (histograms * self.settled_scripts[sides]).argmax(axis=1)
+        labels = [None] * len(lines)
+        for i in np.flatnonzero(decisions != PASS).tolist():
+            if decisions[i] == ACCEPT:
+                labels[i] = self.accept_labels[sides[i]][settled_main[i]]
+            else:
+                labels[i] = SCRIPTS[main_scripts[i]]
+        return decisions, labels
+
+    def audited(self, line: str) -> bool:
+        return self.audit > 0 and zlib.crc32(line.encode("utf8")) < self.audit * 2 ** 32
+
+
+@functools.lru_cache(maxsize=None)
+def get_prefilter(ok_langs: frozenset, candidate_langs: Optional[frozenset] = None,
+                  audit: float = 0.0) -> ScriptPrefilter:
+    """one prefilter per language, for callers that check many small batches (ie documents)"""
+    return ScriptPrefilter([ok_langs], candidate_langs, audit)
+
+
+def prefilter_classify(lines: List[str], prefilter: Optional[ScriptPrefilter], candidate_langs=None,
+                       cache_path=None) -> Tuple[List[Tuple[str, Optional[float]]], Metrics]:
+    """
+    classify_chunk with the prefilter in front: lines it decides get (label, None), the rest are classified by
+    langid. Returns the predictions and the script_{accepted,rejected,passed} counts, plus audit_{accepted,rejected}
+    and audit_{accepted,rejected}_agree for decided lines langid checked too
+    """
+    stats = Metrics()
+    if prefilter is None:
+        return classify_chunk(lines, candidate_langs, cache_path), stats
+    decisions, labels = prefilter.decide(lines)
+    stats["script_accepted"] += int((decisions == ACCEPT).sum())
+    stats["script_rejected"] += int((decisions == REJECT).sum())
+    stats["script_passed"] += int((decisions == PASS).sum())
+    decisions = decisions.tolist()
+    to_classify = [i for i, decision in enumerate(decisions) if decision == PASS or prefilter.audited(lines[i])]
+    predictions = [(label, None) for label in labels]
+    num_sides = len(prefilter.ok_langs)
+    for i, prediction in zip(to_classify, classify_chunk([lines[i] for i in to_classify], candidate_langs,
+                                                         cache_path)):
+        if decisions[i] == PASS:
+            predictions[i] = prediction
+            continue
+        name = "audit_accepted" if decisions[i] == ACCEPT else "audit_rejected"
+        stats[name] += 1
+        stats[name + "_agree"] += (prediction[0] in prefilter.ok_langs[i % num_sides]) == (decisions[i] == ACCEPT)
+    return predictions, stats
+
+
+def classify_chunk_in_worker(lines, candidate_langs, cache_path, prefilter=None):
+    """
+    prefilter_classify plus the prefilter and cache stats from this worker, which would otherwise never reach the
+    main process
+    """
+    predictions, stats = prefilter_classify(lines, prefilter, candidate_langs, cache_path)
+    if cache_path:
+        stats.update(get_cache(cache_path).pop_stats())
+    return predictions, stats
+
+
+def classify_lines(lines, workers=1, chunk_size=2000, candidate_langs=None, cache_path=None, metrics=None,
+                   prefilter=None, mp_context=None):
+    """
+    yields (line, predicted_lang, confidence) for every line, in the original order.
+    Lines are scored chunk_size at a time. With workers > 1 the chunks are classified on a process pool,
+    with at most a couple of chunks per worker in flight so that memory doesn't grow with the size of the input.
+    With a ScriptPrefilter, lines it decides skip langid and get (label, None) instead.
+    Lines read and classified, prefilter and cache stats, and seconds spent reading and classifying (waiting on the
+    pool, with workers) are added to metrics if it is given. The pool is started from mp_context (a
+    multiprocessing context) if one is given, with the default start method otherwise.
+    """
+    if metrics is None:
+        metrics = Metrics()
+    chunks = chunked(lines, chunk_size)
+    if workers <= 1:
+        while True:
+            with metrics.timer("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                break
+            with metrics.timer("classify"):
+                predictions, stats = prefilter_classify(chunk, prefilter, candidate_langs, cache_path)
+            metrics.update(stats)
+            metrics["lines_read"] += len(chunk)
+            metrics["classified"] += len(chunk)
+            for line, (predict_lang, confidence) in zip(chunk, predictions):
+                yield line, predict_lang, confidence
+        if cache_path:
+            metrics.update(get_cache(cache_path).pop_stats())
+        return
+
+    with (mp_context.Pool if mp_context is not None else Pool)(workers) as pool:
+        pending = deque()
+        while True:
+            # keep the pool busy, but bounded
+            with metrics.timer("read"):
+                new_chunks = list(itertools.islice(chunks, workers * 2 - len(pending)))
+            for chunk in new_chunks:
+                metrics["lines_read"] += len(chunk)
+                pending.append((chunk, pool.apply_async(classify_chunk_in_worker,
+                                                        (chunk, candidate_langs, cache_path, prefilter))))
+            if not pending:
+                break
+            chunk, result = pending.popleft()
+            with metrics.timer("classify"):
+                predictions, worker_stats = result.get()
+            metrics["classified"] += len(chunk)
+            metrics.update(worker_stats)
+            for line, (predict_lang, confidence) in zip(chunk, predictions):
+                yield line, predict_lang, confidence
+
+
+def format_prefilter_stats(stats) -> str:
+    total = stats["script_accepted"] + stats["script_rejected"] + stats["script_passed"]
+    if not total:
+        return "script prefilter: no lines"
+    summary = "script prefilter: {:.2f}% accepted, {:.2f}% rejected, {:.2f}% passed on to langid".format(
+        stats["script_accepted"] / total * 100, stats["script_rejected"] / total * 100,
+        stats["script_passed"] / total * 100)
+    for name in ("accepted", "rejected"):
+        checked = stats["audit_" + name]
+        if checked:
+            summary += ", langid agrees with {:.2f}% of {} audited {} lines".format(
+                stats["audit_{}_agree".format(name)] / checked * 100, checked, name)
+    return summary
@@ -0,0 +1,269 @@
+import hashlib
+import json
+import os
+from collections import Counter
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+
+MAX_LOAD = 0.5  # fraction of hash table slots in use before it doubles
+MAX_NODES = np.iinfo(np.int32).max
+
+
+def sentence_key(lang: str, sentence: str) -> int:
+    """64 bit hash of a (language, sentence), never 0 since 0 marks an empty slot"""
+    digest = hashlib.blake2b("{}\t{}".format(lang, sentence).encode("utf8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1
+
+
+def pair_keys(lang1: str, lang2: str, pairs: List[Tuple[str, str]]) -> np.ndarray:
+    """sentence keys for a list of pairs, interleaved lang1, lang2, lang1, ... as add_pairs wants them"""
+    return np.fromiter((sentence_key(lang, sent) for pair in pairs for lang, sent in zip((lang1, lang2), pair)),
+                       dtype=np.uint64, count=2 * len(pairs))
+
+
+def table_capacity(needed: int) -> int:
+    """slots for an open addressing table: a power of two (so probing can mask), at least needed"""
+    return 1 << max(needed - 1, 1).bit_length()
+
+
+def find_slots(table: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """
+    the slot of an open addressing table of uint64 keys (0 for empty) holding each key, or the first empty slot on
+    its probe sequence if it isn't in the table
+    """
+    mask = np.uint64(len(table) - 1)
+    slots = (keys & mask).astype(np.int64)
+    result = np.empty(len(keys), dtype=np.int64)
+    pending = np.arange(len(keys))
+    while pending.size:
+        found = table[slots[pending]]
+        done = (found == keys[pending]) | (found == 0)
+        result[pending[done]] = slots[pending[done]]
+        pending = pending[~done]
+        slots[pending] = (slots[pending] + 1) & (len(table) - 1)
+    return result
+
+
+def claim_slots(table: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """inserts distinct keys that are known not to be in table yet, returns the slot each one went into"""
+    result = np.empty(len(keys), dtype=np.int64)
+    pending = np.arange(len(keys))
+    while pending.size:
+        slots = find_slots(table, keys[pending])
+        # keys in this batch can race for the same empty slot, the first one gets it and the rest probe on
+        taken, winners = np.unique(slots, return_index=True)
+        table[taken] = keys[pending[winners]]
+        result[pending[winners]] = taken
+        lost = np.ones(len(pending), dtype=bool)
+        lost[winners] = False
+        pending = pending[lost]
+    return result
+
+
+def grown_capacity(capacity: int, needed: int) -> int:
+    while needed > capacity * MAX_LOAD:
+        capacity *= 2
+    return capacity
+
+
+class HashInterner(object):
+    """
+    Maps nonzero uint64 keys to consecutive int32 ids with an open addressing hash table held in two numpy arrays,
+    which is a few bytes per key rather than the ~100 a python dict entry costs. Lookups and inserts are done a batch
+    at a time with vectorized linear probing.
+    """
+
+    def __init__(self, capacity: int = 1 << 20):
+        capacity = table_capacity(capacity)
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.full(capacity, -1, dtype=np.int32)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def find_slots(self, keys: np.ndarray) -> np.ndarray:
+        """the slot holding each key, or the first empty slot on its probe sequence if it isn't in the table"""
+        return find_slots(self.keys, keys)
+
+    def insert_new(self, keys: np.ndarray, values: np.ndarray):
+        """inserts distinct keys that are known not to be in the table yet"""
+        self.values[claim_slots(self.keys, keys)] = values
+
+    def grow(self, needed: int):
+        capacity = grown_capacity(len(self.keys), needed)
+        if capacity == len(self.keys):
+            return
+        used = self.keys != 0
+        old_keys, old_values = self.keys[used], self.values[used]
+        self.keys = np.zeros(capacity, dtype=np.uint64)
+        self.values = np.full(capacity, -1, dtype=np.int32)
+        self.insert_new(old_keys, old_values)
+
+    def intern_batch(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns (ids, new_positions): the id of every key, and the positions in keys where new ids first appeared,
+        in id order. New ids are handed out in order of first appearance.
+        """
+        unique_keys, first_positions, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        slots = self.find_slots(unique_keys)
+        unique_ids = self.values[slots].astype(np.int64)
+        unique_ids[self.keys[slots] != unique_keys] = -1
+
+        is_new = unique_ids < 0
+        new_order = np.argsort(first_positions[is_new], kind="stable")
+        new_positions = first_positions[is_new][new_order]
+        num_new = len(new_positions)
+        if self.size + num_new > MAX_NODES:
+            raise OverflowError("more than {} keys interned".format(MAX_NODES))
+        new_ids = np.empty(num_new, dtype=np.int64)
+        new_ids[new_order] = np.arange(self.size, self.size + num_new)
+        unique_ids[is_new] = new_ids
+
+        self.grow(self.size + num_new)
+        self.insert_new(unique_keys[is_new], new_ids.astype(np.int32))
+        self.size += num_new
+        return unique_ids[inverse.ravel()], new_positions
+
+
+class UnionFind(object):
+    """
+    Disjoint sets over int ids in a numpy parent array. Unions are applied a batch at a time: roots are found by
+    pointer jumping and the larger root is hooked under the smaller, so parent[i] <= i always holds and there can
+    be no cycles.
+    """
+
+    def __init__(self):
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.size = 0
+
+    def add(self, num: int):
+        """adds num new singleton sets, with the next consecutive ids"""
+        needed = self.size + num
+        if needed > len(self.parent):
+            parent = np.empty(max(needed, 2 * len(self.parent), 1024), dtype=np.int32)
+            parent[:self.size] = self.parent[:self.size]
+            self.parent = parent
+        self.parent[self.size:needed] = np.arange(self.size, needed, dtype=np.int32)
+        self.size = needed
+
+    def find_batch(self, ids: np.ndarray) -> np.ndarray:
+        roots = self.parent[ids]
+        while True:
+            next_roots = self.parent[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        self.parent[ids] = roots  # path compression for the ids we were asked about
+        return roots
+
+    def union_batch(self, a: np.ndarray, b: np.ndarray):
+        while a.size:
+            root_a, root_b = self.find_batch(a), self.find_batch(b)
+            differ = root_a != root_b
+            a, b, root_a, root_b = a[differ], b[differ], root_a[differ], root_b[differ]
+            # several unions can hook the same root in one go, the smallest wins and the others go round again
+            np.minimum.at(self.parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+    def find_all(self) -> np.ndarray:
+        """the root of every id, with every path fully compressed"""
+        return self.find_batch(np.arange(self.size))
+
+
+class ParallelSentenceGraph(object):
+    """
+    Builds N-way parallel sentence sets out of pairwise bitext. Every (language, sentence) becomes an integer node
+    through a HashInterner, pairs become union-find edges, and the connected components are the parallel sets.
+    Sentence text is never kept in memory: each new node's text is appended to sentences.tsv in out_dir, so the
+    node id is its line number there.
+    """
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        os.makedirs(out_dir, exist_ok=True)
+        self.interner = HashInterner()
+        self.union_find = UnionFind()
+        self.langs, self.lang2idx = [], {}
+        self.node_langs = np.zeros(0, dtype=np.uint16)
+        self.num_edges = 0
+        self.sentence_store = open(self.sentences_path, "w", encoding="utf8")
+
+    @property
+    def sentences_path(self) -> str:
+        return os.path.join(self.out_dir, "sentences.tsv")
+
+    def lang_idx(self, lang: str) -> int:
+        if lang not in self.lang2idx:
+            self.lang2idx[lang] = len(self.langs)
+            self.langs.append(lang)
+        return self.lang2idx[lang]
+
+    def add_pairs(self, lang1: str, lang2: str, pairs: List[Tuple[str, str]], keys: np.ndarray = None):
+        """
+        adds a batch of translation pairs, sentences of lang1 first. keys can be passed in if they were already
+        computed with pair_keys, ie on another process
+        """
+        if not pairs:
+            return
+        texts = [sent for pair in pairs for sent in pair]
+        if keys is None:
+            keys = pair_keys(lang1, lang2, pairs)
+        ids, new_positions = self.interner.intern_batch(keys)
+
+        lang_idxs = (self.lang_idx(lang1), self.lang_idx(lang2))
+        self.union_find.add(len(new_positions))
+        start = len(self.node_langs)
+        self.node_langs = np.resize(self.node_langs, start + len(new_positions))
+        self.node_langs[start:] = np.where(new_positions % 2 == 0, lang_idxs[0], lang_idxs[1])
+        for position in new_positions:
+            lang = lang1 if position % 2 == 0 else lang2
+            self.sentence_store.write("{}\t{}\n".format(lang, " ".join(texts[position].split())))
+
+        self.union_find.union_batch(ids[0::2], ids[1::2])
+        self.num_edges += len(pairs)
+
+    def finish(self) -> np.ndarray:
+        """closes the sentence store and saves and returns the component (root node id) of every node"""
+        self.sentence_store.close()
+        components = self.union_find.find_all()
+        np.save(os.path.join(self.out_dir, "node_components.npy"), components)
+        np.save(os.path.join(self.out_dir, "node_langs.npy"), self.node_langs)
+        with open(os.path.join(self.out_dir, "langs.json"), "w") as fout:
+            json.dump(self.langs, fout)
+        return components
+
+    def languages_per_component(self, components: np.ndarray) -> np.ndarray:
+        """number of distinct languages in the component of every node"""
+        component_langs = components.astype(np.int64) * len(self.langs) + self.node_langs
+        component_of_pair = np.unique(component_langs) // len(self.langs)
+        roots, num_langs = np.unique(component_of_pair, return_counts=True)
+        per_root = np.zeros(len(components), dtype=np.int64)
+        per_root[roots] = num_langs
+        return per_root[components]
+
+    def lang_set_counts(self, components: np.ndarray, min_langs: int = 2) -> Counter:
+        """how many parallel sets there are for each combination of languages spanning at least min_langs"""
+        keep = self.languages_per_component(components) >= min_langs
+        pairs = np.unique(components[keep].astype(np.int64) * len(self.langs) + self.node_langs[keep])
+        counts = Counter()
+        if not pairs.size:
+            return counts
+        roots, lang_idxs = pairs // len(self.langs), pairs % len(self.langs)
+        boundaries = np.flatnonzero(np.diff(roots)) + 1
+        for group in np.split(lang_idxs, boundaries):
+            counts[tuple(self.langs[i] for i in group)] += 1
+        return counts
+
+    def iter_sets(self, components: np.ndarray, min_langs: int = 2) -> Iterator[Tuple[int, str, str]]:
+        """
+        yields (component, lang, sentence) for every node in a component spanning at least min_langs languages, by
+        streaming the sentence store in node order
+        """
+        keep = self.languages_per_component(components) >= min_langs
+        with open(self.sentences_path, encoding="utf8") as fin:
+            for node, line in enumerate(fin):
+                if keep[node]:
+                    lang, sentence = line.rstrip("\n").split("\t", 1)
+                    yield int(components[node]), lang, sentence
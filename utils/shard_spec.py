@@ -0,0 +1,91 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from utils.line_index import iter_line_ends
+
+
+SPEC_VERSION = 2  # 2: open_subs shards are ranges of english document names, not positions
+DONE_NAME = "shard_done"  # written to a shard's output dir once the shard is finished
+
+
+def shard_dir(output_dir: str, shard: int) -> str:
+    """where a node writes the outputs of one shard, for the merge to find"""
+    return os.path.join(output_dir, "part_{:05d}".format(shard))
+
+
+def write_spec(path: str, stage: str, shards: List[dict], **fields):
+    with open(path, "w") as fout:
+        json.dump(dict(version=SPEC_VERSION, stage=stage, shards=shards, **fields), fout, indent=1)
+        fout.write("\n")
+
+
+def load_spec(path: str, stage: Optional[str] = None) -> dict:
+    """a spec written by write_spec, checked to be for stage if one is given"""
+    with open(path) as fin:
+        spec = json.load(fin)
+    if spec.get("version") != SPEC_VERSION:
+        raise ValueError("{} is shard spec version {}, expected {}".format(path, spec.get("version"), SPEC_VERSION))
+    if stage is not None and spec["stage"] != stage:
+        raise ValueError("{} is a shard spec for {}, not {}".format(path, spec["stage"], stage))
+    return spec
+
+
+def load_shard(path: str, stage: str, shard: int) -> Tuple[dict, dict]:
+    """(spec, shard) for one shard of a spec written by scripts/shard_plan.py"""
+    spec = load_spec(path, stage)
+    if not 0 <= shard < len(spec["shards"]):
+        raise ValueError("{} has {} shards, there is no shard {}".format(path, len(spec["shards"]), shard))
+    return spec, spec["shards"][shard]
+
+
+def mark_shard_done(out_dir: str):
+    with open(os.path.join(out_dir, DONE_NAME), "w") as fout:
+        fout.write("done\n")
+
+
+def is_shard_done(out_dir: str) -> bool:
+    return os.path.isfile(os.path.join(out_dir, DONE_NAME))
+
+
+def line_starts_after(filepath: str, targets: List[int]) -> List[Tuple[int, int]]:
+    """
+    for each of the ascending byte offsets in targets, (offset, line number) of the first line that starts at or
+    after it. Past the last line start that is (file size, number of lines)
+    """
+    results, pending = [], [target for target in targets if target > 0]
+    results.extend((0, 0) for _ in range(len(targets) - len(pending)))
+    lines_before, last_end = 0, 0
+    for ends in iter_line_ends(filepath):
+        if len(ends):
+            found = np.searchsorted(ends, pending, side="left")
+            done = int(np.searchsorted(found, len(ends), side="left"))
+            results.extend((int(ends[j]), lines_before + int(j) + 1) for j in found[:done])
+            pending = pending[done:]
+            lines_before, last_end = lines_before + len(ends), int(ends[-1])
+        if not pending:
+            return results
+    size = os.path.getsize(filepath)
+    num_lines = lines_before + (1 if size > last_end else 0)  # a last line without a newline still counts
+    return results + [(size, num_lines)] * len(pending)
+
+
+def count_lines(filepath: str) -> int:
+    """lines in filepath as text mode reads them"""
+    return line_starts_after(filepath, [os.path.getsize(filepath) + 1])[0][1]
+
+
+def line_offsets(filepath: str, line_numbers: List[int]) -> List[int]:
+    """byte offset at which each of the ascending line_numbers starts, or the file size for lines past the end"""
+    results, pending = [], [line for line in line_numbers if line > 0]
+    results.extend(0 for _ in range(len(line_numbers) - len(pending)))
+    lines_before = 0
+    for ends in iter_line_ends(filepath):
+        while pending and pending[0] <= lines_before + len(ends):
+            results.append(int(ends[pending.pop(0) - lines_before - 1]))
+        lines_before += len(ends)
+        if not pending:
+            return results
+    return results + [os.path.getsize(filepath)] * len(pending)